@@ -0,0 +1,426 @@
+"""
+公会战性能测试
+
+用法：python benchmark.py [--groups 3] [--members 30] [--days 6] [--reads 20]
+                         [--baseline 基准文件] [--save-baseline] [--tolerance 0.2]
+
+在临时目录的sqlite数据库中生成模拟公会：每个公会members人，每人每天3刀，
+按天实际执行申请出刀、报刀（约十分之一撤销后重报），得到days天的出刀记录；
+之后测量查询和网页接口（quart测试客户端）。
+输出每项操作的吞吐量和延迟分位数，并与基准文件（默认为benchmark_baseline.json）比较，
+p50或p95变慢超过tolerance时返回1；--save-baseline把本次结果保存为基准。
+
+不连接go-cqhttp，机器人接口由LocalApi代替并立即返回。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from aiocqhttp.api import Api
+from quart import Quart
+
+from ybplugins import battle_archive, db_executor, ybdata
+from ybplugins.clan_battle import ClanBattle
+from ybplugins.clan_battle.exception import ClanBattleError
+from ybplugins.ybdata import Clan_challenge, Clan_group, Clan_member, User
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BASE_DIR, "benchmark_baseline.json")
+FONT_PATH = os.path.join(
+    BASE_DIR, "ybplugins", "clan_battle", "components", "fonts", "msyh.ttf")
+
+GAME_SERVER = "cn"
+FIRST_GROUP_ID = 100000
+FIRST_QQID = 10000000
+BLADES_PER_DAY = 3
+UNDO_RATE = 0.1             # 报刀后撤销再重报的比例
+MIN_REGRESSION_MS = 0.05    # 小于这个差距的变慢视为误差
+CSRF_TOKEN = "benchmark"
+
+
+class LocalApi(Api):
+    """
+    代替go-cqhttp，所有接口立即返回
+    """
+
+    def __init__(self, members: Dict[int, List[int]]):
+        self.members = members
+
+    def _member_info(self, group_id, user_id):
+        return {
+            "group_id": group_id,
+            "user_id": user_id,
+            "nickname": "成员{}".format(user_id),
+            "card": "",
+            "role": "member",
+        }
+
+    async def call_action(self, action: str, **params) -> Any:
+        if action == "get_group_list":
+            return [{"group_id": g, "group_name": "公会{}".format(g)}
+                    for g in self.members]
+        if action == "get_group_member_list":
+            return [self._member_info(params["group_id"], q)
+                    for q in self.members.get(params["group_id"], [])]
+        if action == "get_group_member_info":
+            return self._member_info(params["group_id"], params["user_id"])
+        if action == "get_stranger_info":
+            return {"user_id": params["user_id"],
+                    "nickname": "成员{}".format(params["user_id"])}
+        # send_group_msg、send_private_msg等
+        return None
+
+
+class Recorder:
+    """
+    记录每次调用的耗时，ClanBattleError计为错误
+    """
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def add(self, name: str, seconds: float, ok: bool = True) -> None:
+        self.samples.setdefault(name, []).append(seconds)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def call(self, name: str, fn, *args, **kwargs):
+        start = time.perf_counter()
+        ok = True
+        try:
+            return fn(*args, **kwargs)
+        except ClanBattleError:
+            ok = False
+        finally:
+            self.add(name, time.perf_counter() - start, ok)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        return {name: summarize(values, self.errors.get(name, 0))
+                for name, values in self.samples.items()}
+
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    index = math.ceil(p / 100 * len(sorted_values)) - 1
+    return sorted_values[min(len(sorted_values) - 1, max(0, index))]
+
+
+def summarize(values: List[float], errors: int) -> Dict[str, Any]:
+    """
+    values为每次调用的耗时（秒），结果中的时间为毫秒
+    """
+    values = sorted(values)
+    total = sum(values)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "ops_per_sec": round(len(values) / total, 1) if total > 0 else None,
+        "mean_ms": round(total * 1000 / len(values), 3),
+        "p50_ms": round(_percentile(values, 50) * 1000, 3),
+        "p95_ms": round(_percentile(values, 95) * 1000, 3),
+        "p99_ms": round(_percentile(values, 99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+def load_setting(dirname: str) -> Dict[str, Any]:
+    with open(os.path.join(BASE_DIR, "packedfiles", "default_config.json"),
+              "r", encoding="utf-8") as f:
+        setting = json.load(f)
+    setting.update({
+        "dirname": dirname,
+        "verinfo": {},
+        "db_backend": "sqlite",
+        "public_address": "http://127.0.0.1:{}/".format(setting["port"]),
+    })
+    return setting
+
+
+def create_clans(cb: ClanBattle, groups: int, members: int) -> Dict[int, List[int]]:
+    """
+    Returns:
+        {群号: [成员QQ号, ]}
+    """
+    clans = {}
+    for i in range(groups):
+        group_id = FIRST_GROUP_ID + i
+        qqids = [FIRST_QQID + i * 1000 + m for m in range(members)]
+        cb.create_group(group_id, GAME_SERVER, "公会{}".format(i))
+        with User._meta.database.atomic():
+            User.insert_many([{
+                "qqid": qqid,
+                "nickname": "成员{}".format(qqid),
+                "clan_group_id": group_id,
+            } for qqid in qqids]).execute()
+            Clan_member.insert_many([{
+                "group_id": group_id,
+                "qqid": qqid,
+            } for qqid in qqids]).execute()
+        clans[group_id] = qqids
+    return clans
+
+
+def _pick_boss(cb: ClanBattle, group_id: int):
+    """
+    选择当前周目剩余血量最多的boss
+
+    Returns:
+        (boss编号, 剩余血量, 满血量)
+    """
+    group = Clan_group.get_by_id(group_id)
+    health = json.loads(group.now_cycle_boss_health)
+    boss_num = max(health, key=lambda b: health[b])
+    level = cb._level_by_cycle(group.boss_cycle, group.game_server)
+    full = cb.bossinfo[group.game_server][level][int(boss_num) - 1]
+    return boss_num, health[boss_num], full
+
+
+def _damage(cb: ClanBattle, group_id: int, rng: random.Random):
+    boss_num, remain, full = _pick_boss(cb, group_id)
+    damage = int(full * rng.uniform(0.05, 0.4))
+    defeat = damage >= remain
+    return boss_num, defeat, 0 if defeat else damage
+
+
+def play_day(cb: ClanBattle, rec: Recorder, group_id: int, qqids: List[int],
+             rng: random.Random) -> None:
+    """
+    每人按顺序出3刀：申请出刀，报刀，部分撤销后重报
+    """
+    for _ in range(BLADES_PER_DAY):
+        for qqid in qqids:
+            boss_num, defeat, damage = _damage(cb, group_id, rng)
+            rec.call("apply_for_challenge", cb.apply_for_challenge,
+                     False, group_id, qqid, boss_num)
+            rec.call("challenge", cb.challenge, group_id, qqid, defeat, damage)
+            if rng.random() < UNDO_RATE:
+                rec.call("undo", cb.undo, group_id, qqid)
+                rec.call("challenge", cb.challenge, group_id, qqid, defeat, damage,
+                         boss_num=boss_num)
+
+
+def previous_day(cb: ClanBattle, group_ids: List[int]) -> None:
+    # 把已有记录移到前一天，腾出今天的出刀次数
+    Clan_challenge.update(
+        challenge_pcrdate=Clan_challenge.challenge_pcrdate - 1,
+    ).where(
+        Clan_challenge.gid.in_(group_ids),
+    ).execute()
+    for group_id in group_ids:
+        cb._invalidate_report_cache(group_id)
+
+
+def bench_queries(cb: ClanBattle, rec: Recorder, group_ids: List[int], reads: int) -> None:
+    for _ in range(reads):
+        for group_id in group_ids:
+            rec.call("challenger_info", cb.challenger_info, group_id)
+            rec.call("get_report", cb.get_report, group_id, None, nocache=True)
+            rec.call("score_table", cb.score_table, group_id)
+            group = Clan_group.get_by_id(group_id)
+            rec.call("_boss_data_dict", cb._boss_data_dict, group)
+
+
+async def _post(rec: Recorder, client, url: str, payload: Dict[str, Any]):
+    payload = dict(payload, csrf_token=CSRF_TOKEN)
+    start = time.perf_counter()
+    response = await client.post(url, json=payload)
+    data = await response.get_json()
+    rec.add("api:" + payload["action"], time.perf_counter() - start,
+            response.status_code == 200 and data.get("code") == 0)
+    return data
+
+
+async def _login(client, qqid: int) -> None:
+    async with client.session_transaction() as sess:
+        sess["yobot_user"] = qqid
+        sess["csrf_token"] = CSRF_TOKEN
+
+
+async def bench_web(cb: ClanBattle, rec: Recorder, clans: Dict[int, List[int]],
+                    reads: int, rng: random.Random) -> None:
+    """
+    通过quart测试客户端调用yobot_clan_api
+    """
+    app = Quart(__name__)
+    app.secret_key = os.urandom(16)
+    cb.register_routes(app)
+    client = app.test_client()
+    basepath = cb.setting["public_basepath"]
+    for group_id, qqids in clans.items():
+        url = "{}clan/{}/api/".format(basepath, group_id)
+        await _login(client, qqids[0])
+        for i in range(reads):
+            await _post(rec, client, url, {"action": "get_data"})
+            await _post(rec, client, url, {"action": "update_boss_data"})
+            await _post(rec, client, url, {"action": "get_member_list"})
+            await _post(rec, client, url, {"action": "get_challenge", "ts": int(time.time())})
+            await _post(rec, client, url, {"action": "get_user_challenge",
+                                           "qqid": qqids[i % len(qqids)]})
+        # 今天的刀已出完：由最后一刀的成员撤销，再申请出刀并重新报刀
+        group = Clan_group.get_by_id(group_id)
+        for _ in qqids:
+            qqid = cb._get_group_previous_challenge(group).qqid
+            await _login(client, qqid)
+            await _post(rec, client, url, {"action": "undo"})
+            boss_num, defeat, damage = _damage(cb, group_id, rng)
+            await _post(rec, client, url, {"action": "apply", "is_continue": False,
+                                           "behalf": None, "boss_num": boss_num})
+            await _post(rec, client, url, {"action": "addrecord", "defeat": defeat,
+                                           "damage": damage, "behalf": None,
+                                           "boss_num": boss_num})
+        # 让通知等后台任务执行完
+        await asyncio.sleep(0)
+
+
+async def run(args) -> Dict[str, Any]:
+    tmpdir = tempfile.mkdtemp(prefix="yobot-benchmark-")
+    try:
+        setting = load_setting(tmpdir)
+        with open(os.path.join(BASE_DIR, "packedfiles", "default_BossIdAndName.json"),
+                  "r", encoding="utf-8") as f:
+            boss_id_name = json.load(f)
+        ybdata.init(os.path.join(tmpdir, "yobotdata_new.db"), setting)
+        battle_archive.init(tmpdir)
+        db_executor.configure(setting)
+
+        api = LocalApi({})
+        cb = ClanBattle(setting, api, boss_id_name)
+        # 网页操作每次都会记录日志，不输出到控制台
+        for logger_name in ("ybplugins.clan_battle.components.web_operation",
+                            "ybplugins.clan_battle.components.kernel"):
+            logging.getLogger(logger_name).setLevel(logging.WARNING)
+        if not os.path.exists(FONT_PATH):
+            print("未找到字体{}，不计入生成图片的时间".format(FONT_PATH))
+            cb.text_2_pic = lambda text, *args: text
+
+        rng = random.Random(args.seed)
+        clans = create_clans(cb, args.groups, args.members)
+        api.members = clans
+        rec = Recorder()
+        started = time.perf_counter()
+        for day in range(args.days):
+            if day > 0:
+                previous_day(cb, list(clans))
+            for group_id, qqids in clans.items():
+                play_day(cb, rec, group_id, qqids, rng)
+                await asyncio.sleep(0)
+        bench_queries(cb, rec, list(clans), args.reads)
+        await bench_web(cb, rec, clans, args.reads, rng)
+        elapsed = time.perf_counter() - started
+
+        return {
+            "params": {
+                "groups": args.groups,
+                "members": args.members,
+                "days": args.days,
+                "reads": args.reads,
+                "seed": args.seed,
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": int(time.time()),
+            },
+            "records": Clan_challenge.select().count(),
+            "seconds": round(elapsed, 2),
+            "results": rec.summary(),
+        }
+    finally:
+        ybdata.release_connection()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    在结果中加入与基准的比较
+
+    Returns:
+        变慢的操作
+    """
+    regressions = []
+    for name, current in result["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        slower = []
+        for key in ("p50_ms", "p95_ms"):
+            if base[key] <= 0:
+                continue
+            change = current[key] / base[key] - 1
+            current[key.replace("_ms", "_change")] = round(change, 3)
+            if change > tolerance and current[key] - base[key] > MIN_REGRESSION_MS:
+                slower.append(key)
+        if slower:
+            current["regression"] = slower
+            regressions.append(name)
+    return regressions
+
+
+def _format_change(value) -> str:
+    return "" if value is None else "{:+.0%}".format(value)
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    print("{groups}个公会 × {members}人 × {days}天，共{records}条出刀记录，用时{seconds}秒".format(
+        records=result["records"], seconds=result["seconds"], **result["params"]))
+    header = "{:<24}{:>7}{:>6}{:>10}{:>9}{:>9}{:>9}{:>9}{:>8}{:>8}".format(
+        "操作", "次数", "错误", "次/秒", "平均ms", "p50", "p95", "p99", "p50±", "p95±")
+    print(header)
+    for name, r in sorted(result["results"].items()):
+        print("{:<24}{:>7}{:>6}{:>10}{:>9.2f}{:>9.2f}{:>9.2f}{:>9.2f}{:>8}{:>8}{}".format(
+            name, r["count"], r["errors"], r["ops_per_sec"] or "-", r["mean_ms"],
+            r["p50_ms"], r["p95_ms"], r["p99_ms"],
+            _format_change(r.get("p50_change")), _format_change(r.get("p95_change")),
+            "  变慢" if r.get("regression") else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="公会战性能测试")
+    parser.add_argument("--groups", type=int, default=3, help="公会数")
+    parser.add_argument("--members", type=int, default=30, help="每个公会的成员数")
+    parser.add_argument("--days", type=int, default=6, help="会战天数")
+    parser.add_argument("--reads", type=int, default=20, help="每个公会的查询次数")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基准文件")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基准")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="p50或p95超过基准的比例，超过时视为变慢")
+    parser.add_argument("--output", help="把结果保存为json")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+
+    regressions = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != result["params"]:
+            print("基准的测试规模不同：{}，比较结果仅供参考".format(baseline.get("params")))
+        regressions = compare(result, baseline, args.tolerance)
+    print_result(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+        print("已保存基准：{}".format(args.baseline))
+    elif regressions:
+        print("变慢的操作：{}".format("、".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
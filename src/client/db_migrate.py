@@ -0,0 +1,88 @@
+"""
+数据库迁移工具
+
+用法：python db_migrate.py [--dry-run] [--split-shards] [--rebuild-history] [数据目录]
+不填数据目录时与main.py使用相同的目录；--dry-run只打印需要执行的迁移
+正常启动yobot时也会自动执行迁移
+
+--split-shards：把主库中每个公会的数据移到各自的数据库（shards文件夹），
+需要先停止yobot，之后在配置中开启db_shard_by_group
+
+--rebuild-history：从出刀记录重新生成成员历史汇总，包括冷存档中的会战
+（升级时自动生成的汇总不包括已经冷存档的会战），需要先停止yobot
+"""
+
+import argparse
+import json
+import os
+
+from ybplugins import battle_archive, ybdata
+
+
+def main():
+    parser = argparse.ArgumentParser(description="数据库迁移工具")
+    parser.add_argument("basedir", nargs="?",
+                        help="数据目录，不填时与main.py使用相同的目录")
+    parser.add_argument("--dry-run", action="store_true", help="只打印需要执行的迁移")
+    parser.add_argument("--split-shards", action="store_true",
+                        help="把主库中每个公会的数据移到各自的数据库")
+    parser.add_argument("--rebuild-history", action="store_true",
+                        help="从出刀记录重新生成成员历史汇总")
+    args = parser.parse_args()
+    dry_run = args.dry_run
+    split_shards = args.split_shards
+    rebuild_history = args.rebuild_history
+    if args.basedir:
+        basedir = args.basedir
+    elif os.path.exists("yobot_config.json"):
+        basedir = "."
+    else:
+        basedir = "./yobot_data"
+    if not os.path.isdir(basedir):
+        parser.error("数据目录不存在：{}".format(basedir))
+
+    default_config_path = os.path.join(
+        os.path.dirname(__file__), "packedfiles", "default_config.json")
+    with open(default_config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    config_path = os.path.join(basedir, "yobot_config.json")
+    if os.path.exists(config_path):
+        with open(config_path, "r", encoding="utf-8-sig") as f:
+            config.update(json.load(f))
+
+    if split_shards:
+        config["db_shard_by_group"] = True
+    ybdata.init(os.path.join(basedir, "yobotdata_new.db"), config, dry_run)
+    if not dry_run:
+        battle_archive.init(basedir)
+        # 升级前已存档的会战没有成员历史汇总，从冷存档生成
+        battle_archive.backfill_history()
+    if split_shards and not dry_run:
+        split()
+    if rebuild_history and not dry_run:
+        rebuild()
+
+
+def split():
+    total = 0
+    for group_id, counts, elapsed in ybdata.split_all():
+        print("群{}：{}，耗时{:.2f}秒".format(
+            group_id,
+            "、".join("{} {}条".format(t, n) for t, n in counts.items()) or "已拆分",
+            elapsed))
+        total += 1
+    print("拆分完毕，共{}个公会，请在yobot_config.json中设置db_shard_by_group为true".format(total))
+
+
+
+def rebuild():
+    from ybplugins.clan_battle.components.history import rebuild_all_history
+    total = 0
+    for group_id, count, elapsed in rebuild_all_history():
+        print("群{}：{}条汇总，耗时{:.2f}秒".format(group_id, count, elapsed))
+        total += 1
+    print("成员历史汇总已重新生成，共{}个公会".format(total))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+"""
+消息压力测试
+
+用法：python loadtest.py [--target proc|event|http] [--groups 10] [--members 30]
+                        [--events 2000] [--rate 50] [--noise 0.7]
+                        [--api-latency 20] [--api-jitter 10]
+                        [--replay 事件文件] [--save-events 事件文件] [--output 结果文件]
+
+代替go-cqhttp向yobot发送群消息事件（闲聊和公会战指令混合，分布在多个群），
+按rate条/秒的速度发送，不等待上一条处理完；统计从发送到收到回复的延迟和吞吐量。
+
+- target为proc时直接调用Yobot.proc_async
+- target为event时经aiocqhttp的事件处理（与反向websocket相同），回复通过快速操作接口发送
+- target为http时经aiocqhttp的http上报接口（quart测试客户端），回复在响应中
+
+机器人接口由SimulatedApi代替，每次调用等待api-latency±api-jitter毫秒。
+--replay发送文件中的事件（一行一个go-cqhttp上报的json），--save-events保存本次生成的事件。
+数据在临时目录中，测试前先创建各群的公会并加入成员。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List, Set
+
+from aiocqhttp import CQHttp
+from aiocqhttp.api import AsyncApi
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+import yobot
+from benchmark import FONT_PATH, summarize
+from ybplugins import ybdata
+from ybplugins.clan_battle import ClanBattle
+from ybplugins.clan_battle.components.define import Commands
+from ybplugins.ybdata import Clan_member
+
+SELF_ID = 10000
+FIRST_GROUP_ID = 200000
+FIRST_QQID = 20000000
+SETUP_TIMEOUT = 30          # 等待成员加入公会的时间（秒）
+
+NOISE = [
+    "早上好",
+    "今天打几王",
+    "哈哈哈哈",
+    "有人一起吗",
+    "[CQ:face,id=178]",
+    "刚才那刀出了多少",
+    "晚点再打",
+    "收到",
+    "这期boss好难",
+    "？",
+]
+
+# (指令, 权重)，{boss}和{damage}随机填写
+COMMANDS = [
+    ("申请出刀{boss}", 3),
+    ("报刀 {damage}w", 3),
+    ("尾刀", 1),
+    ("状态", 2),
+    ("查树", 1),
+    ("预约{boss}", 1),
+    ("取消申请出刀", 1),
+    ("报伤害 30s {damage}w", 1),
+    ("撤销", 0.5),
+]
+
+REPLY_ACTIONS = (".handle_quick_operation_async", "send_group_msg",
+                 "send_private_msg", "send_msg")
+
+
+class SimulatedApi(AsyncApi):
+    """
+    代替go-cqhttp的接口，每次调用等待一段时间后返回
+    """
+
+    def __init__(self, clans: Dict[int, List[int]], latency: float, jitter: float,
+                 rng: random.Random):
+        self.clans = clans
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = rng
+        self.samples: Dict[str, List[float]] = {}
+        self.replied: Set[int] = set()   # 通过快速操作回复了的消息
+
+    def _member_info(self, group_id, user_id):
+        return {
+            "group_id": group_id,
+            "user_id": user_id,
+            "nickname": "成员{}".format(user_id),
+            "card": "",
+            "role": "owner" if user_id == self.clans[group_id][0] else "member",
+        }
+
+    def _result(self, action: str, params: Dict[str, Any]) -> Any:
+        if action == "get_group_list":
+            return [{"group_id": g, "group_name": "群{}".format(g)} for g in self.clans]
+        if action == "get_group_member_list":
+            return [self._member_info(params["group_id"], q)
+                    for q in self.clans.get(params["group_id"], [])]
+        if action == "get_group_member_info":
+            return self._member_info(params["group_id"], params["user_id"])
+        if action == "get_stranger_info":
+            return {"user_id": params["user_id"],
+                    "nickname": "成员{}".format(params["user_id"])}
+        if action == "get_login_info":
+            return {"user_id": SELF_ID, "nickname": "yobot"}
+        if action == ".handle_quick_operation_async":
+            self.replied.add(params["context"]["message_id"])
+        if action in REPLY_ACTIONS:
+            return {"message_id": 0}
+        return None
+
+    async def call_action(self, action: str, **params) -> Any:
+        start = time.perf_counter()
+        delay = self.latency + self.rng.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            return self._result(action, params)
+        finally:
+            self.samples.setdefault(action, []).append(time.perf_counter() - start)
+
+
+class EventFactory:
+    """
+    生成go-cqhttp格式的群消息事件
+    """
+
+    def __init__(self, clans: Dict[int, List[int]], noise: float, rng: random.Random):
+        self.clans = clans
+        self.noise = noise
+        self.rng = rng
+        self.message_id = 0
+        self._commands = [c for c, _ in COMMANDS]
+        self._weights = [w for _, w in COMMANDS]
+
+    def message(self, group_id: int, user_id: int, text: str) -> Dict[str, Any]:
+        self.message_id += 1
+        return {
+            "time": int(time.time()),
+            "self_id": SELF_ID,
+            "post_type": "message",
+            "message_type": "group",
+            "sub_type": "normal",
+            "message_id": self.message_id,
+            "group_id": group_id,
+            "user_id": user_id,
+            "anonymous": None,
+            "message": text,
+            "raw_message": text,
+            "font": 0,
+            "sender": {
+                "user_id": user_id,
+                "nickname": "成员{}".format(user_id),
+                "card": "",
+                "role": "owner" if user_id == self.clans[group_id][0] else "member",
+            },
+        }
+
+    def random_message(self) -> Dict[str, Any]:
+        group_id = self.rng.choice(list(self.clans))
+        user_id = self.rng.choice(self.clans[group_id])
+        if self.rng.random() < self.noise:
+            text = self.rng.choice(NOISE)
+        else:
+            text = self.rng.choices(self._commands, self._weights)[0].format(
+                boss=self.rng.randint(1, 5),
+                damage=self.rng.randint(50, 400),
+            )
+        return self.message(group_id, user_id, text)
+
+
+def is_command(event: Dict[str, Any]) -> bool:
+    return event.get("raw_message", "")[:2] in Commands
+
+
+class LoadTest:
+    def __init__(self, bot: yobot.Yobot, cqbot: CQHttp, api: SimulatedApi, target: str):
+        self.bot = bot
+        self.cqbot = cqbot
+        self.api = api
+        self.target = target
+        self.client = cqbot.server_app.test_client() if target == "http" else None
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.max_schedule_delay = 0.0
+
+    async def _send(self, event: Dict[str, Any]) -> bool:
+        """
+        Returns:
+            是否有回复
+        """
+        if self.target == "proc":
+            # proc_async会修改消息，与aiocqhttp一样传入副本
+            reply = await self.bot.proc_async(dict(event, sender=dict(event["sender"])))
+            return bool(reply)
+        if self.target == "event":
+            await self.cqbot._handle_event_with_response(dict(event))
+            return event["message_id"] in self.api.replied
+        response = await self.client.post(
+            "/", json=event, headers={"X-Self-ID": str(event["self_id"])})
+        if response.status_code >= 500:
+            raise RuntimeError("http上报返回{}".format(response.status_code))
+        # 没有回复时为204
+        return response.status_code == 200
+
+    async def dispatch(self, event: Dict[str, Any]) -> None:
+        kind = "指令" if is_command(event) else "闲聊"
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        ok = True
+        try:
+            replied = await self._send(event)
+        except Exception as e:
+            logging.getLogger(__name__).exception("处理消息出错：{}".format(e))
+            ok = False
+            replied = False
+        finally:
+            self.in_flight -= 1
+        name = "{}（{}）".format(kind, "有回复" if replied else "无回复")
+        self.samples.setdefault(name, []).append(time.perf_counter() - start)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def run(self, events: List[Dict[str, Any]], rate: float) -> float:
+        """
+        按rate条/秒发送，等待全部处理完
+
+        Returns:
+            用时（秒）
+        """
+        loop = asyncio.get_event_loop()
+        tasks = []
+        start = loop.time()
+        for i, event in enumerate(events):
+            due = start + i / rate
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # 事件循环忙，没能按时发送
+                self.max_schedule_delay = max(self.max_schedule_delay, -delay)
+            tasks.append(asyncio.ensure_future(self.dispatch(event)))
+        await asyncio.gather(*tasks)
+        return loop.time() - start
+
+
+def build_bot(dirname: str, api: SimulatedApi):
+    with open(os.path.join(dirname, "yobot_config.json"), "w", encoding="utf-8") as f:
+        json.dump({"public_address": "http://127.0.0.1:9222/"}, f)
+    cqbot = CQHttp(enable_http_post=False)
+    # 快速操作经由这个接口发送
+    cqbot._api = api
+    bot = yobot.Yobot(data_path=dirname,
+                      scheduler=AsyncIOScheduler(),
+                      quart_app=cqbot.server_app,
+                      bot_api=api,
+                      verinfo={"ver_name": "loadtest"},
+                      )
+    cqbot.on_message(bot.handle_msg_async)
+    if not os.path.exists(FONT_PATH):
+        print("未找到字体{}，不生成图片".format(FONT_PATH))
+        for plugin in bot.plug_active:
+            if isinstance(plugin, ClanBattle):
+                plugin.text_2_pic = lambda text, *args: text
+    # 每条指令都会记录日志，不输出到控制台
+    logging.getLogger("ybplugins.clan_battle.components.kernel").setLevel(logging.WARNING)
+    return bot, cqbot
+
+
+async def setup_clans(bot: yobot.Yobot, factory: EventFactory) -> None:
+    """
+    群主创建公会，成员各自加入
+    """
+    for group_id, qqids in factory.clans.items():
+        await bot.proc_async(factory.message(group_id, qqids[0], "创建国服公会"))
+        for qqid in qqids:
+            await bot.proc_async(factory.message(group_id, qqid, "加入公会"))
+    total = sum(len(q) for q in factory.clans.values())
+    deadline = time.perf_counter() + SETUP_TIMEOUT
+    # 加入公会在后台查询群名片，等待全部写入
+    while Clan_member.select().count() < total and time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+
+
+def load_events(path: str) -> List[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    return [e for e in events
+            if e.get("post_type") == "message" and e.get("message_type") == "group"]
+
+
+def clans_of(events: List[Dict[str, Any]]) -> Dict[int, List[int]]:
+    clans: Dict[int, List[int]] = {}
+    for event in events:
+        members = clans.setdefault(event["group_id"], [])
+        if event["user_id"] not in members:
+            members.append(event["user_id"])
+    return clans
+
+
+async def main_async(args) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    if args.replay:
+        events = load_events(args.replay)
+        clans = clans_of(events)
+    else:
+        clans = {FIRST_GROUP_ID + i: [FIRST_QQID + i * 1000 + m for m in range(args.members)]
+                 for i in range(args.groups)}
+        events = None
+
+    tmpdir = tempfile.mkdtemp(prefix="yobot-loadtest-")
+    try:
+        api = SimulatedApi(clans, args.api_latency / 1000, args.api_jitter / 1000, rng)
+        bot, cqbot = build_bot(tmpdir, api)
+        factory = EventFactory(clans, args.noise, rng)
+        await setup_clans(bot, factory)
+        if events is None:
+            events = [factory.random_message() for _ in range(args.events)]
+        else:
+            # 回放的消息编号可能与准备阶段重复
+            for event in events:
+                event["message_id"] = factory.message_id = factory.message_id + 1
+        if args.save_events:
+            with open(args.save_events, "w", encoding="utf-8") as f:
+                for event in events:
+                    f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+        api.samples.clear()
+        test = LoadTest(bot, cqbot, api, args.target)
+        elapsed = await test.run(events, args.rate)
+        # 等待通知等后台任务
+        await asyncio.sleep(args.api_latency / 1000 + 0.1)
+
+        return {
+            "params": {
+                "target": args.target,
+                "groups": len(clans),
+                "events": len(events),
+                "rate": args.rate,
+                "noise": args.noise,
+                "api_latency_ms": args.api_latency,
+                "api_jitter_ms": args.api_jitter,
+                "replay": args.replay,
+            },
+            "seconds": round(elapsed, 2),
+            "throughput": round(len(events) / elapsed, 1),
+            "max_in_flight": test.max_in_flight,
+            "max_schedule_delay_ms": round(test.max_schedule_delay * 1000, 1),
+            "messages": {name: summarize(values, test.errors.get(name, 0))
+                         for name, values in test.samples.items()},
+            "api_calls": {action: summarize(values, 0)
+                          for action, values in api.samples.items()},
+        }
+    finally:
+        ybdata.release_connection()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    params = result["params"]
+    print("{target}：{groups}个群，{events}条消息，目标{rate}条/秒，接口延迟{api_latency_ms}±{api_jitter_ms}ms".format(
+        **params))
+    print("用时{}秒，吞吐{}条/秒，最多同时处理{}条，发送最多推迟{}ms".format(
+        result["seconds"], result["throughput"], result["max_in_flight"],
+        result["max_schedule_delay_ms"]))
+    line = "{:<20}{:>7}{:>6}{:>9}{:>9}{:>9}{:>9}{:>9}"
+    print(line.format("消息", "条数", "错误", "平均ms", "p50", "p95", "p99", "max"))
+    for name, r in sorted(result["messages"].items()):
+        print(line.format(name, r["count"], r["errors"], r["mean_ms"],
+                          r["p50_ms"], r["p95_ms"], r["p99_ms"], r["max_ms"]))
+    print(line.format("机器人接口", "次数", "", "平均ms", "p50", "p95", "p99", "max"))
+    for name, r in sorted(result["api_calls"].items()):
+        print(line.format(name, r["count"], "", r["mean_ms"],
+                          r["p50_ms"], r["p95_ms"], r["p99_ms"], r["max_ms"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="消息压力测试")
+    parser.add_argument("--target", choices=("proc", "event", "http"), default="event",
+                        help="proc：Yobot.proc_async；event：aiocqhttp事件处理；http：aiocqhttp的http上报")
+    parser.add_argument("--groups", type=int, default=10, help="群数")
+    parser.add_argument("--members", type=int, default=30, help="每个群的成员数")
+    parser.add_argument("--events", type=int, default=2000, help="发送的消息数")
+    parser.add_argument("--rate", type=float, default=50, help="每秒发送的消息数")
+    parser.add_argument("--noise", type=float, default=0.7, help="闲聊消息的比例")
+    parser.add_argument("--api-latency", type=float, default=20, help="机器人接口的延迟（毫秒）")
+    parser.add_argument("--api-jitter", type=float, default=10, help="机器人接口延迟的波动（毫秒）")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子")
+    parser.add_argument("--replay", help="回放的事件文件，一行一个json")
+    parser.add_argument("--save-events", help="保存发送的事件，可用于--replay")
+    parser.add_argument("--output", help="把结果保存为json")
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    print_result(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == "__main__":
+    main()
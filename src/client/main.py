@@ -30,13 +30,20 @@ done
 
 import asyncio
 import json
+import multiprocessing
+import multiprocessing.connection
+import signal
+import socket
 import time
 
+import hypercorn.asyncio
+import hypercorn.config
 import tzlocal
 from aiocqhttp import CQHttp
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import yobot
+from ybplugins import accounts, cluster, metrics
 
 
 def main():
@@ -69,6 +76,7 @@ def main():
             print("警告：没有设置access_token，这会直接暴露机器人接口")
             print("详见https://yobot.win/usage/access-token/")
     else:
+        config = {}
         token = None
 
     try:
@@ -77,45 +85,126 @@ def main():
         print("无法获取系统时区，请将系统时区设置为北京/上海时区")
         sys.exit()
 
+    workers = config.get("workers", 1)
+    if workers > 1 and not hasattr(os, "fork"):
+        print("多进程部署只支持Linux，将以单进程运行")
+        workers = 1
+    if workers > 1:
+        run_workers(basedir, token, config, workers)
+    else:
+        run(basedir, token)
+
+
+def run_workers(basedir, token, config, workers):
+    """
+    主进程只监听端口，fork出的工作进程共用这个socket处理请求
+
+    任一工作进程退出时结束所有进程，和单进程时一样由yobotg.sh重启
+    """
+    host = config.get("host", "0.0.0.0")
+    port = config.get("port", 9222)
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    # 各个进程的session使用相同的密钥
+    secret_key = os.urandom(16)
+
+    context = multiprocessing.get_context("fork")
+    ready = context.Event()
+    processes = []
+    for index in range(workers):
+        process = context.Process(
+            target=run,
+            name="yobot-worker-{}".format(index),
+            args=(basedir, token, (index, workers, sock.fileno(), secret_key, ready)),
+        )
+        process.start()
+        processes.append(process)
+        if index == 0:
+            # 第一个进程完成初始化（生成配置文件、升级数据库）后再启动其他进程
+            while not ready.wait(1):
+                if not process.is_alive():
+                    sys.exit(process.exitcode)
+    print("已启动{}个工作进程".format(workers))
+    try:
+        multiprocessing.connection.wait([p.sentinel for p in processes])
+        exitcode = next(p.exitcode for p in processes if not p.is_alive())
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+    sys.exit(exitcode)
+
+
+def run(basedir, token, worker=None):
+    """
+    Args:
+        worker: 多进程部署时为(序号, 进程数, 监听socket的fd, session密钥, 初始化完成的Event)
+    """
     cqbot = CQHttp(access_token=token,
                    enable_http_post=False)
+    # 可以有多个账号连接，调用时按群选择账号
+    router = accounts.AccountRouter(cqbot._api, lambda: list(cqbot._wsr_api_clients))
+    cqbot.on_websocket_connection(router.on_connect)
+    bot_api = router
+    if worker is not None:
+        index, workers, fd, secret_key, ready = worker
+        cluster.init(basedir, index, workers)
+        cqbot.server_app.secret_key = secret_key
+        # go-cqhttp只连接其中一个进程，其他进程的api调用转发给它
+        bot_api = cluster.ClusterApi(router, lambda: list(cqbot._wsr_api_clients))
+        cqbot.server_app.before_serving(cluster.start)
+        cqbot.server_app.after_serving(cluster.stop)
     sche = AsyncIOScheduler()
     bot = yobot.Yobot(data_path=basedir,
                       scheduler=sche,
                       quart_app=cqbot.server_app,
-                      bot_api=cqbot._api,
+                      bot_api=bot_api,
                       )
     host = bot.glo_setting.get("host", "0.0.0.0")
     port = bot.glo_setting.get("port", 9222)
+    router.set_budget(bot.glo_setting.get("bot_send_rate", 0),
+                      bot.glo_setting.get("bot_send_burst", 5))
 
     @cqbot.on_message
     async def handle_msg(context):
-        if context["message_type"] == "group" or context["message_type"] == "private":
-            reply = await bot.proc_async(context)
-        else:
-            reply = None
-        if isinstance(reply, str) and reply != "":
-            return {'reply': reply,
-                    'at_sender': False}
-        else:
+        if not router.accept(context):
+            # 多个账号在同一个群里，这条消息已经处理过
             return None
+        return await bot.handle_msg_async(context)
 
-    async def send_it(func):
+    async def send_it(func, leader_only=True):
+        if leader_only and not cluster.is_leader():
+            # 多进程部署时定时任务只在leader执行
+            return
         if asyncio.iscoroutinefunction(func):
             to_sends = await func()
         else:
             to_sends = func()
         if to_sends is None:
             return
-        for kwargs in to_sends:
-            await asyncio.sleep(5)
-            await cqbot.send_msg(**kwargs)
-
-    jobs = bot.active_jobs()
+        to_sends = list(to_sends)
+        remaining = len(to_sends)
+        metrics.PENDING_MESSAGES.inc(remaining)
+        try:
+            for kwargs in to_sends:
+                await asyncio.sleep(5)
+                remaining -= 1
+                metrics.PENDING_MESSAGES.dec()
+                await bot_api.send_msg(**kwargs)
+        finally:
+            metrics.PENDING_MESSAGES.dec(remaining)
+
+    # 进程内的任务（写入登录记录缓存、导出指标等）每个进程都要执行
+    jobs = [(trigger, job, True) for trigger, job in bot.active_jobs()]
+    jobs += [(trigger, job, False) for trigger, job in bot.process_jobs()]
     if jobs:
-        for trigger, job in jobs:
+        for trigger, job, leader_only in jobs:
             sche.add_job(func=send_it,
-                         args=(job,),
+                         args=(job, leader_only),
                          trigger=trigger,
                          coalesce=True,
                          max_instances=1,
@@ -124,13 +213,24 @@ def main():
 
     print("初始化完成，启动服务...")
 
-    cqbot.run(
-        host=host,
-        port=port,
-        debug=False,
-        use_reloader=False,
-        loop=asyncio.get_event_loop(),
-    )
+    if worker is None:
+        cqbot.run(
+            host=host,
+            port=port,
+            debug=False,
+            use_reloader=False,
+            loop=asyncio.get_event_loop(),
+        )
+        return
+    ready.set()
+    hypercorn_config = hypercorn.config.Config()
+    hypercorn_config.bind = ["fd://{}".format(fd)]
+    loop = asyncio.get_event_loop()
+    shutdown = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, shutdown.set)
+    loop.run_until_complete(hypercorn.asyncio.serve(
+        cqbot.server_app, hypercorn_config, shutdown_trigger=shutdown.wait))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+var vm = new Vue({
+    el: '#app',
+    data: {
+        enabled: true,
+        worker: null,
+        profileData: [],
+    },
+    mounted() {
+        this.refresh();
+    },
+    methods: {
+        refresh: function (event) {
+            var thisvue = this;
+            axios.post(api_path, {
+                action: 'get_data',
+                csrf_token: csrf_token,
+            }).then(function (res) {
+                if (res.data.code == 0) {
+                    thisvue.enabled = res.data.enabled;
+                    thisvue.worker = res.data.worker;
+                    thisvue.profileData = res.data.data;
+                } else {
+                    thisvue.$alert(res.data.message, '加载数据错误');
+                }
+            }).catch(function (error) {
+                thisvue.$alert(error, '加载数据错误');
+            });
+        },
+        reset: function (event) {
+            var thisvue = this;
+            axios.post(api_path, {
+                action: 'reset',
+                csrf_token: csrf_token,
+            }).then(function (res) {
+                if (res.data.code == 0) {
+                    thisvue.profileData = [];
+                } else {
+                    thisvue.$message.error('清空失败' + res.data.message);
+                }
+            }).catch(function (error) {
+                thisvue.$message.error(error);
+            });
+        },
+    },
+    delimiters: ['[[', ']]'],
+})
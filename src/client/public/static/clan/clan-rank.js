@@ -4,6 +4,7 @@ var vm = new Vue({
     data: {
         isLoading: true,
         challengeData: [],
+        historyData: [],
         activeIndex: '6',
         qqid: 0,
         nickname: '',
@@ -27,8 +28,27 @@ var vm = new Vue({
         // }).catch(function (error) {
         //     thisvue.$alert(error, '获取数据失败');
         // });
+        axios.post('../api/', {
+            action: 'get_history',
+            csrf_token: csrf_token,
+        }).then(function (res) {
+            if (res.data.code != 0) {
+                thisvue.$alert(res.data.message, '获取历次会战失败');
+                return;
+            }
+            thisvue.historyData = res.data.history;
+            thisvue.isLoading = false;
+        }).catch(function (error) {
+            thisvue.$alert(error, '获取历次会战失败');
+        });
     },
     methods: {
+        battleDate: function (row) {
+            // 会战第一次出刀的日期，pcrdate为天数
+            var d = new Date();
+            d.setTime(row.pcrdate * 86400 * 1000);
+            return d.getFullYear() + '/' + String(d.getMonth() + 1).padStart(2, '0') + '/' + String(d.getDate()).padStart(2, '0');
+        },
         handleSelect(key, keyPath) {
             switch (key) {
                 case '1':
@@ -12,6 +12,7 @@ var vm = new Vue({
     data: {
         isLoading: true,
         challengeData: [],
+        historyData: [],
         activeIndex: '5',
         qqid: 0,
         nickname: '',
@@ -35,8 +36,32 @@ var vm = new Vue({
         }).catch(function (error) {
             thisvue.$alert(error, '获取数据失败');
         });
+        axios.post('../api/', {
+            action: 'get_history',
+            csrf_token: csrf_token,
+            qqid: thisvue.qqid,
+        }).then(function (res) {
+            if (res.data.code != 0) {
+                thisvue.$alert(res.data.message, '获取历次会战失败');
+                return;
+            }
+            thisvue.historyData = res.data.history;
+        }).catch(function (error) {
+            thisvue.$alert(error, '获取历次会战失败');
+        });
     },
     methods: {
+        battleDate: function (row) {
+            // 会战第一次出刀的日期，pcrdate为天数
+            return ts2ds(row.pcrdate * 86400);
+        },
+        bossAverage: function (row) {
+            var s = [];
+            for (var num in row.bosses) {
+                s.push(num + '号：' + row.bosses[num].average + '（' + row.bosses[num].challenges + '刀）');
+            }
+            return s.join('\n');
+        },
         csummary: function (cha) {
             if (cha == undefined) {
                 return '';
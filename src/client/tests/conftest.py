@@ -0,0 +1,72 @@
+import os
+import sys
+
+import pytest
+
+# 测试从src/client导入ybplugins
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def data_dir(request, tmp_path):
+    """
+    临时数据目录，其中的sqlite数据库已建表，冷存档已启用
+
+    用`@pytest.mark.parametrize("data_dir", [配置], indirect=True)`传入ybdata.init的配置
+    """
+    from ybplugins import battle_archive, ybdata
+    config = getattr(request, "param", None) or {}
+    ybdata.init(str(tmp_path / "yobotdata_new.db"), config)
+    battle_archive.init(str(tmp_path))
+    yield tmp_path
+    battle_archive._archive_dir = None
+    for db in ybdata._shards.values():
+        db.close()
+    ybdata._shards.clear()
+    ybdata._shard_dir = None
+    ybdata._db.close()
+
+
+class FakeApi:
+    """只实现公会战用到的几个接口，群1里有qq号1000~1029的30个成员"""
+
+    async def call_action(self, action, **params):
+        return await getattr(self, action)(**params)
+
+    async def get_group_member_list(self, group_id):
+        return [{"user_id": 1000 + i, "nickname": "n%d" % i, "card": "",
+                 "role": "owner" if i == 0 else "member"} for i in range(30)]
+
+    async def get_group_member_info(self, group_id, user_id):
+        return {"nickname": "n%d" % user_id, "card": "", "role": "member"}
+
+    async def get_group_list(self):
+        return [{"group_id": 1, "group_name": "g1"}]
+
+    async def send_group_msg(self, **kwargs):
+        pass
+
+    async def send_private_msg(self, **kwargs):
+        pass
+
+
+@pytest.fixture
+def clan_battle(data_dir, monkeypatch):
+    """
+    使用临时数据目录的ClanBattle，不生成图片（text_2_pic直接返回文字）
+    """
+    import json
+
+    from ybplugins import log_util
+    from ybplugins.clan_battle import ClanBattle
+    packedfiles = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "packedfiles")
+    with open(os.path.join(packedfiles, "default_config.json"), encoding="utf-8-sig") as f:
+        setting = json.load(f)
+    with open(os.path.join(packedfiles, "default_BossIdAndName.json"), encoding="utf-8-sig") as f:
+        boss_id_name = json.load(f)
+    setting.update(dirname=str(data_dir), verinfo={}, public_address="http://localhost/",
+                   public_basepath="/")
+    monkeypatch.setattr(ClanBattle, "text_2_pic", lambda self, text, *args: text)
+    cb = ClanBattle(setting, FakeApi(), boss_id_name)
+    yield cb
+    log_util.stop_queue(cb._log_listener)
@@ -0,0 +1,145 @@
+"""
+冷存档：存档、还原、删除，以及在只读连接上ATTACH存档文件查询
+"""
+import asyncio
+import os
+import time
+
+import peewee
+import pytest
+
+from ybplugins import battle_archive, ybdata
+from ybplugins.db_executor import run_in_reader
+from ybplugins.ybdata import Clan_challenge, Clan_challenge_archive, Clan_group, Clan_member_history
+
+SHARDED = [{}, {"db_shard_by_group": True}]
+
+
+def _setup(battles=(0, 1), per_battle=3, pcrdate=None):
+    # 公会10当前是2号档案，battles中的档案各有per_battle刀
+    if pcrdate is None:
+        pcrdate = int(time.time()) // 86400 - 30
+    with ybdata.group_scope(10, create=True):
+        Clan_group.create(group_id=10, battle_id=2)
+        for battle_id in battles:
+            for i in range(per_battle):
+                Clan_challenge.create(
+                    bid=battle_id, gid=10, qqid=100 + i, challenge_pcrdate=pcrdate,
+                    challenge_pcrtime=i, boss_cycle=1, boss_num=1,
+                    boss_health_remain=1000, challenge_damage=100 * (i + 1),
+                    is_continue=False)
+
+
+def _count(battle_id):
+    # 所有来源中某一期的出刀记录数
+    with battle_archive.challenge_sources(10, battle_id) as sources:
+        return sum(model.select().where(model.gid == 10, model.bid == battle_id, *exprs).count()
+                   for model, exprs in sources)
+
+
+@pytest.mark.parametrize("data_dir", SHARDED, indirect=True)
+def test_archive_and_restore(data_dir):
+    _setup()
+    with ybdata.group_scope(10):
+        assert battle_archive.archive_battle(10, 0) == 3
+        assert os.path.exists(os.path.join(data_dir, "archive", "clan_10.db"))
+        assert battle_archive.archived_battles(10) == {0: 3}
+        assert Clan_challenge.select().where(Clan_challenge.bid == 0).count() == 0
+        assert _count(0) == 3
+        assert _count(1) == 3
+        with battle_archive.challenge_sources(10, "all") as sources:
+            assert sum(m.select().where(m.gid == 10, *e).count() for m, e in sources) == 6
+
+        assert battle_archive.restore_battle(10, 0) == 3
+        assert battle_archive.archived_battles(10) == {}
+        damages = [c.challenge_damage for c in Clan_challenge.select().where(
+            Clan_challenge.bid == 0).order_by(Clan_challenge.cid)]
+        assert damages == [100, 200, 300]
+        # 存档文件中不再有这一期
+        assert _count(0) == 3
+        assert battle_archive.restore_battle(10, 0) == 0
+
+
+@pytest.mark.parametrize("data_dir", SHARDED, indirect=True)
+def test_drop_archived_battle(data_dir):
+    _setup()
+    with ybdata.group_scope(10):
+        battle_archive.archive_battle(10, 0)
+        battle_archive.drop_battle(10, 0)
+        assert battle_archive.archived_battles(10) == {}
+        assert _count(0) == 0
+        assert _count(1) == 3
+
+
+def test_archive_interrupted_before_commit(data_dir, monkeypatch):
+    _setup()
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("interrupted")
+
+    # 存档文件中的副本已提交，主库登记之前中断
+    monkeypatch.setattr(Clan_challenge_archive, "insert", fail)
+    with pytest.raises(RuntimeError):
+        battle_archive.archive_battle(10, 0)
+    monkeypatch.undo()
+
+    assert battle_archive.archived_battles(10) == {}
+    assert Clan_challenge.select().where(Clan_challenge.bid == 0).count() == 3
+    # 残留的副本在下次存档时清除，不会重复
+    assert battle_archive.archive_battle(10, 0) == 3
+    assert _count(0) == 3
+
+
+def test_archive_finished_battles(data_dir):
+    _setup(battles=(0, 1, 2))
+    today = int(time.time()) // 86400
+    Clan_challenge.update(challenge_pcrdate=today).where(
+        Clan_challenge.bid == 1).execute()
+    archived = battle_archive.archive_finished_battles(7)
+    # 1号最近还有出刀，2号是当前档案
+    assert archived == [(10, 0, 3)]
+    assert battle_archive.archived_battles(10) == {0: 3}
+    assert battle_archive.archive_finished_battles(7) == []
+
+
+@pytest.mark.parametrize("data_dir", SHARDED, indirect=True)
+def test_read_archive_on_reader(data_dir):
+    _setup()
+    with ybdata.group_scope(10):
+        battle_archive.archive_battle(10, 0)
+
+    def read():
+        return _count(0), _count(1)
+
+    def write():
+        Clan_challenge.delete().execute()
+
+    async def main():
+        # 只读连接（query_only）上可以ATTACH存档文件
+        counts = await run_in_reader(read)
+        with pytest.raises(peewee.OperationalError):
+            await run_in_reader(write)
+        return counts
+
+    # 和web请求一样，在公会的上下文中交给只读线程
+    with ybdata.group_scope(10):
+        assert asyncio.run(main()) == (3, 3)
+
+
+@pytest.mark.parametrize("data_dir", SHARDED, indirect=True)
+def test_backfill_history(data_dir):
+    # 升级前已经存档的会战没有成员历史汇总
+    _setup()
+    with ybdata.group_scope(10):
+        battle_archive.archive_battle(10, 0)
+        Clan_member_history.delete().execute()
+
+    assert battle_archive.backfill_history() == 3
+    with ybdata.group_scope(10):
+        rows = list(Clan_member_history.select(
+            Clan_member_history.bid, Clan_member_history.qqid,
+            Clan_member_history.challenges, Clan_member_history.damage,
+        ).order_by(Clan_member_history.qqid).tuples())
+    # 主库中的1号由迁移生成，这里只补冷存档
+    assert rows == [(0, 100, 1, 100), (0, 101, 1, 200), (0, 102, 1, 300)]
+    assert battle_archive.backfill_history() == 0
@@ -0,0 +1,151 @@
+"""
+cache_util的过期、按前缀删除和single-flight
+"""
+import asyncio
+import threading
+import time
+
+from ybplugins import cache_util
+from ybplugins.cache_util import LRUCache, cached_func
+
+
+def test_ttl_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    cache = LRUCache(4, ttl=10)
+    cache.set((1,), "a")
+    assert cache.get((1,)) == (True, "a")
+    now[0] += 10
+    assert cache.get((1,)) == (False, None)
+    assert cache.expirations == 1
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.set((1,), 1)
+    cache.set((2,), 2)
+    cache.get((1,))
+    cache.set((3,), 3)
+    assert cache.get((2,)) == (False, None)
+    assert cache.get((1,)) == (True, 1)
+    assert cache.evictions == 1
+
+
+def test_invalidate_prefix():
+    cache = LRUCache(8)
+    cache.set((1, "a"), 1)
+    cache.set((1, "b"), 2)
+    cache.set((2, "a"), 3)
+    assert cache.invalidate(1) == 2
+    assert cache.get((1, "a")) == (False, None)
+    assert cache.get((2, "a")) == (True, 3)
+    cache.invalidate()
+    assert cache.get((2, "a")) == (False, None)
+
+
+def test_invalidate_only_drops_stale_keys():
+    cache = LRUCache(8)
+    # 计算期间删除了其他公会的缓存，结果照常写入
+    generation = cache.generation
+    cache.invalidate(2)
+    cache.set((1, "a"), 1, generation)
+    assert cache.get((1, "a")) == (True, 1)
+    # 删除了这个键的前缀，计算开始前的结果不写入
+    generation = cache.generation
+    cache.invalidate(1)
+    cache.set((1, "a"), 2, generation)
+    assert cache.get((1, "a")) == (False, None)
+    # 清空时丢弃所有计算中的结果
+    generation = cache.generation
+    cache.invalidate()
+    cache.set((3,), 3, generation)
+    assert cache.get((3,)) == (False, None)
+
+
+def test_invalidate_hook():
+    calls = []
+    cache_util.add_invalidate_hook(lambda name, prefix: calls.append((name, prefix)))
+    try:
+        LRUCache(4, name="test_hook").invalidate(1)
+        LRUCache(4).invalidate(2)
+    finally:
+        cache_util._invalidate_hooks.pop()
+        cache_util._registry.pop("test_hook", None)
+    assert calls == [("test_hook", (1,))]
+
+
+def test_sync_single_flight():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    @cached_func(8)
+    def slow(x):
+        calls.append(x)
+        started.set()
+        release.wait(5)
+        return x * 2
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow(3))) for _ in range(4)]
+    threads[0].start()
+    started.wait(5)
+    for t in threads[1:]:
+        t.start()
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert results == [6] * 4
+    assert calls == [3]
+    assert slow(3) == 6
+    assert calls == [3]
+    assert slow(3, nocache=True) == 6
+    assert calls == [3, 3]
+
+
+def test_sync_invalidate_during_call():
+    @cached_func(8)
+    def load(group_id):
+        # 计算期间这个公会的缓存被删除
+        load.invalidate(group_id)
+        return group_id
+
+    assert load(1) == 1
+    assert load.cache.get((1,)) == (False, None)
+
+
+def test_async_single_flight():
+    calls = []
+
+    @cached_func(8, ttl=60)
+    async def fetch(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x + 1
+
+    async def main():
+        return await asyncio.gather(*(fetch(1) for _ in range(5)))
+
+    assert asyncio.run(main()) == [2] * 5
+    assert calls == [1]
+    assert fetch.cache.get((1,)) == (True, 2)
+
+
+def test_async_error_not_cached():
+    calls = []
+
+    @cached_func(8)
+    async def fail(x):
+        calls.append(x)
+        raise ValueError(x)
+
+    async def main():
+        for _ in range(2):
+            try:
+                await fail(1)
+            except ValueError:
+                pass
+
+    asyncio.run(main())
+    assert calls == [1, 1]
@@ -0,0 +1,95 @@
+"""
+每日出刀汇总：日期切换时汇总前一天，补报昨天的刀和撤销时重新汇总
+"""
+import asyncio
+
+import pytest
+
+from ybplugins import ybdata
+from ybplugins.clan_battle.util import pcr_today
+from ybplugins.ybdata import Clan_challenge, Clan_daily, Clan_group, Clan_member
+
+SHARDED = [{}, {"db_shard_by_group": True}]
+
+
+async def _setup(cb):
+    with ybdata.group_scope(1, create=True):
+        cb.create_group(1, "cn")
+    with ybdata.group_scope(1):
+        await cb._update_all_group_members_async(1)
+
+
+def _daily(pcrdate):
+    with ybdata.group_scope(1):
+        return {d.qqid: (d.challenges, bool(d.sl)) for d in Clan_daily.select().where(
+            Clan_daily.gid == 1, Clan_daily.challenge_pcrdate == pcrdate)}
+
+
+async def _summary(cb, pcrdate):
+    with ybdata.group_scope(1):
+        group = Clan_group.get(group_id=1)
+        return await cb.get_daily_summary_async(group, pcrdate)
+
+
+def _move_to_yesterday(today, *slot_qqids):
+    # 把已有的刀和SL挪到昨天
+    with ybdata.group_scope(1):
+        Clan_challenge.update(challenge_pcrdate=today - 1).execute()
+        Clan_member.update(last_save_slot=today - 1).where(
+            Clan_member.qqid.in_(slot_qqids)).execute()
+
+
+@pytest.mark.parametrize("data_dir", SHARDED, indirect=True)
+def test_rollover_finalizes_yesterday(clan_battle):
+    cb = clan_battle
+    today = pcr_today("cn")
+
+    async def main():
+        await _setup(cb)
+        with ybdata.group_scope(1):
+            for qqid in (1000, 1001):
+                cb.challenge(1, qqid, False, 100000, boss_num="1")
+            cb.save_slot(1, 1001)
+        _move_to_yesterday(today, 1001)
+        with ybdata.group_scope(1):
+            cb.challenge(1, 1002, False, 100000, boss_num="1")
+
+        await cb.pcr_rollover("cn")
+        assert _daily(today - 1) == {1000: (1, False), 1001: (1, True)}
+        summary = await _summary(cb, today - 1)
+        assert summary["finalized"]
+        assert summary["challenges"] == 2
+        # 当天的刀不汇总
+        assert _daily(today) == {}
+        assert not (await _summary(cb, today))["finalized"]
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("data_dir", SHARDED, indirect=True)
+def test_previous_day_challenge_refinalizes(clan_battle):
+    cb = clan_battle
+    today = pcr_today("cn")
+
+    async def main():
+        await _setup(cb)
+        with ybdata.group_scope(1):
+            cb.challenge(1, 1000, False, 100000, boss_num="1")
+            cb.save_slot(1, 1000)
+        _move_to_yesterday(today, 1000)
+        await cb.pcr_rollover("cn")
+        # 汇总已缓存
+        assert (await _summary(cb, today - 1))["challenges"] == 1
+
+        with ybdata.group_scope(1):
+            cb.challenge(1, 1001, False, 100000, boss_num="1", previous_day=True)
+        assert _daily(today - 1) == {1000: (1, True), 1001: (1, False)}
+        assert (await _summary(cb, today - 1))["challenges"] == 2
+
+        # 撤销补报的刀后重新汇总，已有的SL不受影响
+        with ybdata.group_scope(1):
+            cb.undo(1, 1001)
+        assert _daily(today - 1) == {1000: (1, True)}
+        assert (await _summary(cb, today - 1))["challenges"] == 1
+
+    asyncio.run(main())
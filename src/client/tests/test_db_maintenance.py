@@ -0,0 +1,115 @@
+"""
+sqlite数据库维护：在线备份、WAL检查点、PRAGMA optimize和增量vacuum
+"""
+import os
+import sqlite3
+
+import pytest
+
+from ybplugins import battle_archive, db_maintenance, ybdata
+from ybplugins.db_maintenance import DBMaintenance
+from ybplugins.ybdata import Clan_challenge, Clan_group
+
+
+def _fill(group_id=10, battle_id=0, count=50):
+    with ybdata.group_scope(group_id, create=True):
+        if not Clan_group.select().where(Clan_group.group_id == group_id).exists():
+            Clan_group.create(group_id=group_id, battle_id=1)
+        Clan_challenge.insert_many([dict(
+            bid=battle_id, gid=group_id, qqid=100 + i, challenge_pcrdate=1,
+            challenge_pcrtime=i, boss_cycle=1, boss_num=1, boss_health_remain=1000,
+            challenge_damage=100, is_continue=False, message="x" * 200,
+        ) for i in range(count)]).execute()
+
+
+def _rows(path, table="clan_challenge"):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("data_dir", [{"db_shard_by_group": True}], indirect=True)
+def test_backup_includes_shards_and_archives(data_dir):
+    _fill(10)
+    with ybdata.group_scope(10):
+        battle_archive.archive_battle(10, 0)
+        _fill(10, battle_id=1, count=5)
+    maintenance = DBMaintenance({"dirname": str(data_dir)})
+
+    report = maintenance.backup()
+    target = os.path.join(data_dir, "backup", report["file"])
+    assert (report["shards"], report["archives"]) == (1, 1)
+    assert _rows(target, "clan_group") == 0
+    assert _rows(os.path.join(target + ".shards", "clan_10.db")) == 5
+    assert _rows(os.path.join(target + ".archive", "clan_10.db")) == 50
+    assert not [f for f in os.listdir(os.path.dirname(target)) if f.endswith(".tmp")]
+
+
+def test_backup_removes_old(data_dir):
+    _fill()
+    battle_archive.archive_battle(10, 0)
+    maintenance = DBMaintenance({"dirname": str(data_dir), "db_backup_keep": 1})
+    backup_dir = os.path.join(data_dir, "backup")
+    old = os.path.join(backup_dir, "yobotdata_20000101-000000.db")
+    os.makedirs(old + ".archive")
+    open(old, "wb").close()
+
+    report = maintenance.backup()
+    assert report["removed"] == 1
+    assert sorted(os.listdir(backup_dir)) == [report["file"], report["file"] + ".archive"]
+
+
+class _RestartingSource:
+    # 分步复制时每复制一步就被写入打断，remaining回到开头
+    def __init__(self):
+        self.calls = []
+
+    def backup(self, target, pages, progress=None, sleep=0):
+        self.calls.append(pages)
+        if pages == -1:
+            return
+        for _ in range(10):
+            progress(0, 90, 100)
+            progress(0, 100, 100)
+
+
+def test_stepped_backup_falls_back():
+    source = _RestartingSource()
+    DBMaintenance({"dirname": ""})._stepped_backup(source, None)
+    assert source.calls == [db_maintenance.BACKUP_PAGES, -1]
+
+
+def test_backup_non_wal_database(tmp_path):
+    path = str(tmp_path / "plain.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE t (x)")
+    conn.executemany("INSERT INTO t VALUES (?)", [("x" * 2000,)] * 100)
+    conn.commit()
+    conn.close()
+    DBMaintenance({"dirname": str(tmp_path)})._backup_file(path, str(tmp_path / "plain.bak"))
+    assert _rows(str(tmp_path / "plain.bak"), "t") == 100
+
+
+def test_checkpoint_truncates_wal(data_dir):
+    _fill()
+    wal = ybdata.sqlite_path() + "-wal"
+    assert os.path.getsize(wal) > 0
+    report = DBMaintenance({"dirname": str(data_dir)}).checkpoint()
+    assert not report["busy"]
+    assert report["wal_size_before"] > 0
+    assert report["wal_size_after"] == 0
+
+
+def test_optimize_incremental_vacuum(data_dir):
+    _fill(count=500)
+    Clan_challenge.delete().execute()
+    maintenance = DBMaintenance({"dirname": str(data_dir)})
+    maintenance.checkpoint()
+
+    report = maintenance.optimize()
+    # 新数据库的auto_vacuum为INCREMENTAL，删除后的空闲页被回收
+    assert report["incremental_vacuum"]
+    assert report["freelist_pages_before"] > 0
+    assert report["freelist_pages_after"] < report["freelist_pages_before"]
@@ -0,0 +1,182 @@
+"""
+多账号
+
+多个go-cqhttp账号可以同时连接到yobot（反向WebSocket按X-Self-ID区分）。
+只连接了一个账号时行为不变；有多个账号且调用时没有指定self_id时：
+
+- 在消息事件中调用时，优先使用收到消息的账号
+- 带group_id的调用（发群消息、获取群成员等）交给在这个群里的账号
+- 私聊在和这个用户同群的账号之间均衡，优先选择发送额度剩余多的账号
+- get_group_list合并所有账号的群
+
+每个账号的发送速率单独限制：每秒bot_send_rate条，最多积攒bot_send_burst条，
+超出时等待，为0时不限制。同一条群消息被多个账号收到时只处理一次。
+"""
+import asyncio
+import collections
+import logging
+import time
+from typing import Any, Callable, Collection, Dict, List, Optional, Set
+
+from aiocqhttp.api import AsyncApi
+from quart import has_websocket_context, websocket
+
+from . import metrics
+
+_logger = logging.getLogger(__name__)
+
+SEND_ACTIONS = {"send_msg", "send_group_msg", "send_private_msg"}
+DEDUP_SECONDS = 10      # 多个账号收到同一条群消息的时间差
+DEDUP_SIZE = 1024
+
+
+def _int(value) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SendBudget:
+    """
+    令牌桶，rate为0时不限制
+    """
+
+    def __init__(self):
+        self.tokens: Optional[float] = None
+        self.updated = time.monotonic()
+        self.sent = 0
+
+    def available(self, rate: float, burst: float) -> float:
+        if rate <= 0:
+            return float("inf")
+        now = time.monotonic()
+        if self.tokens is None:
+            self.tokens = burst
+        else:
+            self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        return self.tokens
+
+    def reserve(self, rate: float, burst: float) -> float:
+        """
+        占用一条消息的额度，返回需要等待的秒数
+        """
+        self.sent += 1
+        if rate <= 0:
+            return 0
+        self.tokens = self.available(rate, burst) - 1
+        return max(0.0, -self.tokens / rate)
+
+
+class AccountRouter(AsyncApi):
+    def __init__(self, api: AsyncApi, accounts: Callable[[], Collection[str]]):
+        """
+        Args:
+            api: aiocqhttp的接口
+            accounts: 返回已连接账号（self_id字符串）的函数
+        """
+        super().__init__()
+        self._api = api
+        self.accounts = accounts
+        self.rate = 0.0
+        self.burst = 5.0
+        self._groups: Dict[int, Set[str]] = {}  # 群 -> 在群里的账号
+        self._users: Dict[int, Set[str]] = {}   # 用户 -> 和这个用户同群的账号
+        self._budgets: Dict[str, SendBudget] = collections.defaultdict(SendBudget)
+        self._recent: "collections.OrderedDict[tuple, tuple]" = collections.OrderedDict()
+
+    def set_budget(self, rate: float, burst: float) -> None:
+        self.rate = max(float(rate), 0.0)
+        self.burst = max(float(burst), 1.0)
+
+    def accept(self, event: Dict[str, Any]) -> bool:
+        """
+        记录账号所在的群和认识的用户
+
+        Returns:
+            同一条群消息已经由其他账号收到时为False
+        """
+        self_id = str(event["self_id"])
+        user_id = event.get("user_id")
+        group_id = event.get("group_id")
+        if user_id is not None:
+            self._users.setdefault(user_id, set()).add(self_id)
+        if group_id is None:
+            return True
+        self._groups.setdefault(group_id, set()).add(self_id)
+        now = time.monotonic()
+        while self._recent and (
+                len(self._recent) >= DEDUP_SIZE
+                or next(iter(self._recent.values()))[1] < now - DEDUP_SECONDS):
+            self._recent.popitem(last=False)
+        key = (group_id, user_id, event.get("time"), event.get("raw_message"))
+        return self._recent.setdefault(key, (self_id, now))[0] == self_id
+
+    async def refresh(self, self_id: str) -> List[Dict[str, Any]]:
+        """
+        重新获取账号所在的群
+        """
+        groups = await self._api.call_action("get_group_list", self_id=self_id)
+        for accounts in self._groups.values():
+            accounts.discard(self_id)
+        for group in groups:
+            self._groups.setdefault(group["group_id"], set()).add(self_id)
+        return groups
+
+    async def on_connect(self, event) -> None:
+        # 作为aiocqhttp的websocket连接事件
+        try:
+            await self.refresh(str(event.self_id))
+        except Exception as e:
+            _logger.warning("获取账号{}的群列表失败：{}".format(event.self_id, e))
+
+    def _choose(self, params: Dict[str, Any], accounts: List[str]) -> str:
+        group_id = _int(params.get("group_id"))
+        user_id = _int(params.get("user_id"))
+        if group_id is not None:
+            known = self._groups.get(group_id, ())
+        elif user_id is not None:
+            known = self._users.get(user_id, ())
+        else:
+            known = ()
+        candidates = [a for a in accounts if a in known] or accounts
+        if has_websocket_context():
+            current = websocket.headers.get("X-Self-ID")
+            if current in candidates:
+                return current
+        return max(candidates, key=lambda a: (
+            self._budgets[a].available(self.rate, self.burst), -self._budgets[a].sent))
+
+    async def _group_list(self, accounts: List[str]) -> List[Dict[str, Any]]:
+        results = await asyncio.gather(
+            *(self.refresh(a) for a in accounts), return_exceptions=True)
+        merged = {}
+        for account, result in zip(accounts, results):
+            if isinstance(result, Exception):
+                _logger.warning("获取账号{}的群列表失败：{}".format(account, result))
+                continue
+            for group in result:
+                merged.setdefault(group["group_id"], group)
+        if not merged and all(isinstance(r, Exception) for r in results):
+            raise results[0]
+        return list(merged.values())
+
+    async def _throttle(self, self_id: str) -> None:
+        wait = self._budgets[self_id].reserve(self.rate, self.burst)
+        metrics.ACCOUNT_MESSAGES.inc(account=self_id)
+        if wait > 0:
+            metrics.ACCOUNT_THROTTLED_SECONDS.inc(wait, account=self_id)
+            await asyncio.sleep(wait)
+
+    async def call_action(self, action: str, **params) -> Any:
+        accounts = list(self.accounts())
+        if params.get("self_id") is None and len(accounts) > 1:
+            if action == "get_group_list":
+                return await self._group_list(accounts)
+            params["self_id"] = self._choose(params, accounts)
+        if action in SEND_ACTIONS:
+            self_id = params.get("self_id") or (accounts[0] if accounts else None)
+            if self_id is not None:
+                await self._throttle(str(self_id))
+        return await self._api.call_action(action, **params)
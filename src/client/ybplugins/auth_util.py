@@ -0,0 +1,186 @@
+import functools
+from collections import namedtuple
+from typing import Optional
+
+from quart import g, jsonify, redirect, request, session, url_for
+
+from . import ybdata
+from .cache_util import LRUCache
+from .templating import render_template
+from .ybdata import Clan_group, Clan_member, User
+
+# authority_group
+ROLE_OWNER = 1      # 主人
+ROLE_ADMIN = 10     # 公会战管理员
+ROLE_MEMBER = 100   # 成员
+
+AUTH_CACHE_TTL = 30
+
+_role_names = {
+    ROLE_OWNER: '主人',
+    ROLE_ADMIN: '公会战管理员',
+    ROLE_MEMBER: '成员',
+}
+
+# 只缓存鉴权需要的字段，boss状态等经常变化的数据不缓存
+GroupInfo = namedtuple('GroupInfo', [
+    'group_id', 'group_name', 'game_server', 'privacy', 'apikey'])
+
+_user_cache = LRUCache(1024, AUTH_CACHE_TTL, 'auth_user')
+_group_cache = LRUCache(256, AUTH_CACHE_TTL, 'auth_group')
+_membership_cache = LRUCache(4096, AUTH_CACHE_TTL, 'auth_membership')
+
+
+def role_name(authority_group: int) -> str:
+    if authority_group < ROLE_ADMIN:
+        return _role_names[ROLE_OWNER]
+    if authority_group < ROLE_MEMBER:
+        return _role_names[ROLE_ADMIN]
+    return _role_names[ROLE_MEMBER]
+
+
+def _request_cached(name, key, loader):
+    # 同一个请求内只查一次
+    store = g.__dict__.setdefault('_yobot_auth', {})
+    if (name, key) not in store:
+        store[(name, key)] = loader()
+    return store[(name, key)]
+
+
+def _cached(cache: LRUCache, key, loader):
+    hit, value = cache.get(key)
+    if not hit:
+        value = loader()
+        cache.set(key, value)
+    return value
+
+
+def get_user(qqid) -> Optional[User]:
+    """
+    获取用户（只读，请勿修改后保存）
+    """
+    qqid = int(qqid)
+    return _request_cached('user', qqid, lambda: _cached(
+        _user_cache, (qqid,), lambda: User.get_or_none(User.qqid == qqid)))
+
+
+def get_login_user() -> Optional[User]:
+    """
+    获取当前登录的用户，未登录返回None
+    """
+    if 'yobot_user' not in session:
+        return None
+    return get_user(session['yobot_user'])
+
+
+def get_group_info(group_id) -> Optional[GroupInfo]:
+    group_id = int(group_id)
+
+    def load():
+        with ybdata.group_scope(group_id):
+            group = Clan_group.get_or_none(group_id=group_id)
+        if group is None:
+            return None
+        return GroupInfo(group.group_id, group.group_name,
+                         group.game_server, group.privacy, group.apikey)
+    return _request_cached('group', group_id, lambda: _cached(
+        _group_cache, (group_id,), load))
+
+
+def get_membership(group_id, qqid) -> Optional[int]:
+    """
+    获取成员在公会内的role，不是成员返回None
+    """
+    group_id, qqid = int(group_id), int(qqid)
+
+    def load():
+        with ybdata.group_scope(group_id):
+            membership = Clan_member.get_or_none(group_id=group_id, qqid=qqid)
+        return membership and membership.role
+    return _request_cached('membership', (group_id, qqid), lambda: _cached(
+        _membership_cache, (group_id, qqid), load))
+
+
+def can_view_group(user: User, group_id) -> bool:
+    """
+    公会成员和公会战管理员以上可以查看公会
+    """
+    return (get_membership(group_id, user.qqid) is not None
+            or user.authority_group < ROLE_ADMIN)
+
+
+def invalidate_user(qqid=None):
+    if qqid is None:
+        _user_cache.clear()
+    else:
+        _user_cache.invalidate(int(qqid))
+
+
+def invalidate_group(group_id=None):
+    if group_id is None:
+        _group_cache.clear()
+        _membership_cache.clear()
+    else:
+        _group_cache.invalidate(int(group_id))
+        _membership_cache.invalidate(int(group_id))
+
+
+def invalidate_membership(group_id, qqid=None):
+    if qqid is None:
+        _membership_cache.invalidate(int(group_id))
+    else:
+        _membership_cache.invalidate(int(group_id), int(qqid))
+
+
+def require_role(authority_group: int = ROLE_MEMBER, api: bool = False):
+    """
+    登录且authority_group不高于指定值才能访问
+
+    Args:
+        authority_group: 允许的最低权限（数字越小权限越高）
+        api: 为True时返回json，否则返回页面
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            user = get_login_user()
+            if user is None:
+                if api:
+                    return jsonify(code=10, message='Not logged in')
+                return redirect(url_for('yobot_login', callback=request.path))
+            if user.authority_group > authority_group:
+                if api:
+                    return jsonify(code=11, message='Insufficient authority')
+                return await render_template(
+                    'unauthorized.html',
+                    limit=role_name(authority_group),
+                    uath=role_name(user.authority_group),
+                )
+            return await fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def require_clan_member(api: bool = False):
+    """
+    路由需要有group_id参数，公会成员和公会战管理员以上才能访问
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, group_id, **kwargs):
+            user = get_login_user()
+            if user is None:
+                if api:
+                    return jsonify(code=10, message='Not logged in')
+                return redirect(url_for('yobot_login', callback=request.path))
+            if get_group_info(group_id) is None:
+                if api:
+                    return jsonify(code=20, message='Group not exists')
+                return await render_template('404.html', item='公会'), 404
+            if not can_view_group(user, group_id):
+                if api:
+                    return jsonify(code=11, message='Insufficient authority')
+                return await render_template('clan/unauthorized.html')
+            return await fn(*args, group_id=group_id, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,310 @@
+"""
+已结束会战的冷存档
+
+不是当前档案号的出刀记录可以移到`archive/clan_<群号>.db`，查询时临时ATTACH，
+主库只保留正在进行的会战，sqlite的页缓存只需要覆盖这部分数据。只支持sqlite。
+
+一个(公会, 档案号)登记在Clan_challenge_archive后，主库中不再有它的出刀记录；
+切换回已存档的档案号之前需要先用restore_battle还原。
+"""
+import contextlib
+import logging
+import os
+import time
+from typing import Dict, List, Set, Tuple, Union
+
+from peewee import IntegerField, fn
+
+from . import ybdata
+from .ybdata import (Clan_challenge, Clan_challenge_archive, Clan_group,
+                     Clan_member_history, member_history_insert)
+
+_logger = logging.getLogger(__name__)
+
+ARCHIVE_SCHEMA = "yobot_archive"
+
+_archive_dir = None
+
+# 存档文件中记录的字段，cid保留原值，仅用于排序
+_fields = [
+    "cid", "bid", "gid", "qqid", "challenge_pcrdate", "challenge_pcrtime",
+    "boss_cycle", "boss_num", "boss_health_remain", "challenge_damage",
+    "is_continue", "message", "behalf",
+]
+
+
+class Archived_challenge(Clan_challenge):
+    # 主库的自增id可能被重用，存档中不把cid作为主键
+    cid = IntegerField()
+
+    class Meta:
+        schema = ARCHIVE_SCHEMA
+        table_name = "clan_challenge"
+        primary_key = False
+        indexes = (
+            (("gid", "bid", "cid"), False),
+        )
+
+
+def init(dirname: str):
+    """
+    Args:
+        dirname: 数据目录，存档文件放在其下的archive文件夹
+    """
+    global _archive_dir
+    _archive_dir = os.path.join(dirname, "archive")
+
+
+def enabled() -> bool:
+    return _archive_dir is not None and not ybdata.is_pooled()
+
+
+def _archive_file(group_id) -> str:
+    return os.path.join(_archive_dir, "clan_{}.db".format(group_id))
+
+
+def archive_files() -> List[str]:
+    """
+    所有公会的存档文件
+    """
+    if not enabled() or not os.path.isdir(_archive_dir):
+        return []
+    return sorted(
+        os.path.join(_archive_dir, f) for f in os.listdir(_archive_dir)
+        if f.startswith("clan_") and f.endswith(".db"))
+
+
+@contextlib.contextmanager
+def _attached(group_id):
+    # ATTACH只对当前线程的连接有效，且不能在事务中执行
+    ybdata._db.execute_sql(
+        "ATTACH DATABASE ? AS " + ARCHIVE_SCHEMA, (_archive_file(group_id),))
+    try:
+        yield
+    finally:
+        ybdata._db.execute_sql("DETACH DATABASE " + ARCHIVE_SCHEMA)
+
+
+def archived_battles(group_id) -> Dict[int, int]:
+    """
+    已存档的档案号及其记录数
+
+    Returns:
+        {档案号: 记录数, }
+    """
+    if not enabled():
+        return {}
+    return dict(Clan_challenge_archive.select(
+        Clan_challenge_archive.battle_id,
+        Clan_challenge_archive.record_count,
+    ).where(
+        Clan_challenge_archive.group_id == group_id,
+    ).tuples())
+
+
+@contextlib.contextmanager
+def challenge_sources(group_id, battle_id: Union[int, str]):
+    """
+    出刀记录所在的表，需要时ATTACH存档文件，退出时DETACH
+
+    Args:
+        group_id: QQ群号
+        battle_id: 档案号，或'all'
+
+    Yields:
+        [(模型, 附加条件列表), ]，存档在前，主库在后
+    """
+    archived: Set[int] = set(archived_battles(group_id))
+    if not archived or (battle_id != "all" and battle_id not in archived):
+        yield [(Clan_challenge, [])]
+        return
+    with _attached(group_id):
+        if battle_id == "all":
+            yield [
+                (Archived_challenge, [Archived_challenge.bid.in_(archived)]),
+                (Clan_challenge, []),
+            ]
+        else:
+            yield [(Archived_challenge, [])]
+
+
+def archive_battle(group_id, battle_id: int) -> int:
+    """
+    把一期会战的出刀记录移到存档文件
+
+    先在存档文件中提交副本，再在主库中登记并删除，
+    两步之间中断时主库不变，存档中的残留副本在下次存档时清除
+
+    Returns:
+        移动的记录数
+    """
+    os.makedirs(_archive_dir, exist_ok=True)
+    db = ybdata._db
+    with _attached(group_id):
+        Archived_challenge.create_table(safe=True)
+        with db.atomic():
+            Archived_challenge.delete().where(
+                Archived_challenge.gid == group_id,
+                Archived_challenge.bid == battle_id,
+            ).execute()
+            # insert_from的execute返回的是最后的rowid，记录数要从游标取
+            count = db.execute(Archived_challenge.insert_from(
+                Clan_challenge.select(
+                    *[getattr(Clan_challenge, f) for f in _fields]
+                ).where(
+                    Clan_challenge.gid == group_id,
+                    Clan_challenge.bid == battle_id,
+                ).order_by(Clan_challenge.cid),
+                [getattr(Archived_challenge, f) for f in _fields],
+            )).rowcount
+        with db.atomic():
+            Clan_challenge_archive.insert(
+                group_id=group_id,
+                battle_id=battle_id,
+                record_count=count,
+                archive_time=int(time.time()),
+            ).on_conflict_replace().execute()
+            Clan_challenge.delete().where(
+                Clan_challenge.gid == group_id,
+                Clan_challenge.bid == battle_id,
+            ).execute()
+    return count
+
+
+def restore_battle(group_id, battle_id: int) -> int:
+    """
+    把已存档的会战移回主库，未存档时不做任何事
+
+    Returns:
+        移回的记录数
+    """
+    if battle_id not in archived_battles(group_id):
+        return 0
+    db = ybdata._db
+    fields = _fields[1:]  # 移回时重新分配cid
+    with _attached(group_id):
+        with db.atomic():
+            count = db.execute(Clan_challenge.insert_from(
+                Archived_challenge.select(
+                    *[getattr(Archived_challenge, f) for f in fields]
+                ).where(
+                    Archived_challenge.gid == group_id,
+                    Archived_challenge.bid == battle_id,
+                ).order_by(Archived_challenge.cid),
+                [getattr(Clan_challenge, f) for f in fields],
+            )).rowcount
+            Clan_challenge_archive.delete().where(
+                Clan_challenge_archive.group_id == group_id,
+                Clan_challenge_archive.battle_id == battle_id,
+            ).execute()
+        with db.atomic():
+            Archived_challenge.delete().where(
+                Archived_challenge.gid == group_id,
+                Archived_challenge.bid == battle_id,
+            ).execute()
+    _logger.info(f"群{group_id}的{battle_id}号存档已从冷存档还原")
+    return count
+
+
+def drop_battle(group_id, battle_id: int) -> None:
+    """
+    删除已存档的会战，未存档时不做任何事
+    """
+    if battle_id not in archived_battles(group_id):
+        return
+    Clan_challenge_archive.delete().where(
+        Clan_challenge_archive.group_id == group_id,
+        Clan_challenge_archive.battle_id == battle_id,
+    ).execute()
+    with _attached(group_id):
+        Archived_challenge.delete().where(
+            Archived_challenge.gid == group_id,
+            Archived_challenge.bid == battle_id,
+        ).execute()
+
+
+def _history_missing(group_id, battle_ids: List[int]) -> List[int]:
+    done = {battle_id for battle_id, in Clan_member_history.select(
+        Clan_member_history.bid,
+    ).where(
+        Clan_member_history.gid == group_id,
+        Clan_member_history.bid.in_(battle_ids),
+    ).distinct().tuples()}
+    return [battle_id for battle_id in battle_ids if battle_id not in done]
+
+
+def backfill_history() -> int:
+    """
+    为冷存档中没有成员历史汇总的会战生成汇总
+
+    升级到有成员历史汇总的版本时只能从主库的出刀记录生成，
+    已经移到冷存档的会战在启动时由这里补上。已有汇总的会战跳过，可以重复执行
+
+    Returns:
+        生成的汇总记录数
+    """
+    if not enabled():
+        return 0
+    db = ybdata._db
+    archived: Dict[int, List[int]] = {}
+    # 存档登记表在主库，按公会分库时公会的出刀记录和汇总在公会数据库中
+    for group_id, battle_id in Clan_challenge_archive.select(
+        Clan_challenge_archive.group_id,
+        Clan_challenge_archive.battle_id,
+    ).tuples():
+        archived.setdefault(group_id, []).append(battle_id)
+    count = 0
+    for group_id, battle_ids in archived.items():
+        with ybdata.group_scope(group_id):
+            if not _history_missing(group_id, battle_ids):
+                continue
+            with _attached(group_id):
+                with db.atomic():
+                    # 多个进程同时启动时，在事务中重新检查
+                    missing = _history_missing(group_id, battle_ids)
+                    if not missing:
+                        continue
+                    added = member_history_insert(
+                        Archived_challenge,
+                        Archived_challenge.gid == group_id,
+                        Archived_challenge.bid.in_(missing),
+                    ).as_rowcount().execute()
+        _logger.info("群{}的冷存档{}生成了{}条成员历史汇总".format(group_id, missing, added))
+        count += added
+    return count
+
+
+def archive_finished_battles(idle_days: int) -> List[Tuple[int, int, int]]:
+    """
+    存档所有公会中不是当前档案号、且最后一刀在idle_days天以前的会战
+
+    Returns:
+        [(群号, 档案号, 记录数), ]
+    """
+    if not enabled():
+        return []
+    today = int(time.time()) // 86400
+    archived = []
+    # 按公会分库时逐个数据库查找，存档在所在的数据库中进行
+    for _ in ybdata.each_database():
+        candidates = Clan_challenge.select(
+            Clan_challenge.gid,
+            Clan_challenge.bid,
+        ).join(
+            Clan_group,
+            on=(Clan_challenge.gid == Clan_group.group_id),
+        ).where(
+            Clan_challenge.bid != Clan_group.battle_id,
+        ).group_by(
+            Clan_challenge.gid,
+            Clan_challenge.bid,
+        ).having(
+            fn.MAX(Clan_challenge.challenge_pcrdate) < today - idle_days,
+        ).tuples()
+        for group_id, battle_id in list(candidates):
+            start = time.perf_counter()
+            count = archive_battle(group_id, battle_id)
+            _logger.info("群{}的{}号存档已移到冷存档，{}条记录，耗时{:.2f}秒".format(
+                group_id, battle_id, count, time.perf_counter() - start))
+            archived.append((group_id, battle_id, count))
+    return archived
@@ -0,0 +1,252 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+_registry: Dict[str, "LRUCache"] = {}
+# 有名字的缓存删除条目后调用，参数为(缓存名, prefix)，用于通知其他进程
+_invalidate_hooks: List[Callable[[str, tuple], None]] = []
+
+
+class LRUCache:
+    """
+    带过期时间的LRU缓存，线程安全，可以缓存None
+
+    Args:
+        maxsize: 最大条目数，超出时淘汰最久未使用的条目
+        ttl: 过期秒数，None为永不过期
+        name: 缓存名，填写后会登记到统计中
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: Optional[float] = None, name: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # 每次删除条目加一，用于丢弃删除之前开始计算的结果
+        self.generation = 0
+        # 每个前缀最近一次被删除时的generation，只丢弃被删除的键上的结果
+        self._invalidated: Dict[tuple, int] = {}
+        # 前缀记录过多时清空，早于这个generation开始的结果都不写入
+        self._invalidated_floor = 0
+        if name:
+            _registry[name] = self
+
+    def get(self, key) -> Tuple[bool, Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return False, None
+            expire_at, value = item
+            if expire_at and expire_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def set(self, key, value, generation: Optional[int] = None) -> None:
+        """
+        写入条目，传入generation时，若期间删除过这个键（按前缀）则不写入
+        """
+        expire_at = (time.monotonic() + self.ttl) if self.ttl else 0
+        with self._lock:
+            if generation is not None and self._stale(key, generation):
+                return
+            self._data[key] = (expire_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def _stale(self, key, generation: int) -> bool:
+        # 需要持有_lock
+        if generation < self._invalidated_floor:
+            return True
+        invalidated = self._invalidated
+        if not invalidated or not isinstance(key, tuple):
+            return False
+        return any(invalidated.get(key[:n], -1) >= generation
+                   for n in range(1, len(key) + 1))
+
+    def invalidate(self, *prefix) -> int:
+        """
+        删除键以prefix开头的条目，不传参数则清空
+
+        Returns:
+            删除的条目数
+        """
+        count = self._invalidate(prefix)
+        if self.name:
+            for hook in _invalidate_hooks:
+                hook(self.name, prefix)
+        return count
+
+    def _invalidate(self, prefix: tuple) -> int:
+        n = len(prefix)
+        with self._lock:
+            if n == 0 or len(self._invalidated) >= self.maxsize * 4:
+                self._invalidated.clear()
+                self._invalidated_floor = self.generation + 1
+            else:
+                self._invalidated[prefix] = self.generation
+            self.generation += 1
+            if n == 0:
+                count = len(self._data)
+                self._data.clear()
+                return count
+            keys = [k for k in self._data if k[:n] == prefix]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def clear(self) -> None:
+        self.invalidate()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'name': self.name,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': (self.hits / total) if total else 0.0,
+        }
+
+
+class _SyncCall:
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def cached_func(maxsize: int = 128, ttl: Optional[float] = None, ignore_self: bool = False, name: str = None):
+    """
+    同步/异步通用的缓存装饰器
+
+    并发的相同未命中请求只会执行一次被装饰函数（single-flight）。
+    计算期间这个键被删除时（包括按前缀删除），结果只返回给调用者，不写入缓存。
+    被装饰函数可以传入`nocache=True`强制刷新；
+    `fn.invalidate(*prefix)`按参数前缀删除缓存；`fn.cache.stats()`查看命中统计。
+
+    Args:
+        maxsize: 最大条目数
+        ttl: 过期秒数，None为永不过期
+        ignore_self: 计算缓存键时忽略第一个参数（用于方法）
+        name: 缓存名，默认为函数名
+    """
+    def decorator(fn):
+        cache = LRUCache(maxsize, ttl, name or fn.__qualname__)
+
+        def make_key(args, kwargs):  # args must be hashable
+            key = tuple(args[1:]) if ignore_self else tuple(args)
+            if kwargs:
+                key += (tuple(sorted(kwargs.items())),)
+            return key
+
+        if asyncio.iscoroutinefunction(fn):
+            inflight: Dict[Hashable, asyncio.Future] = {}
+
+            @functools.wraps(fn)
+            async def wrapper(*args, nocache=False, **kwargs):
+                key = make_key(args, kwargs)
+                if not nocache:
+                    hit, value = cache.get(key)
+                    if hit:
+                        return value
+                    if key in inflight:
+                        return await asyncio.shield(inflight[key])
+                fut = asyncio.get_event_loop().create_future()
+                inflight[key] = fut
+                generation = cache.generation
+                try:
+                    value = await fn(*args, **kwargs)
+                except BaseException as e:
+                    fut.set_exception(e)
+                    fut.exception()  # 标记异常已被取出，避免无人等待时告警
+                    raise
+                else:
+                    cache.set(key, value, generation)
+                    fut.set_result(value)
+                    return value
+                finally:
+                    if inflight.get(key) is fut:
+                        del inflight[key]
+        else:
+            inflight_sync: Dict[Hashable, _SyncCall] = {}
+            inflight_lock = threading.Lock()
+
+            @functools.wraps(fn)
+            def wrapper(*args, nocache=False, **kwargs):
+                key = make_key(args, kwargs)
+                if not nocache:
+                    hit, value = cache.get(key)
+                    if hit:
+                        return value
+                    with inflight_lock:
+                        call = inflight_sync.get(key)
+                        leader = call is None
+                        if leader:
+                            call = inflight_sync[key] = _SyncCall()
+                    if not leader:
+                        call.event.wait()
+                        if call.error is not None:
+                            raise call.error
+                        return call.value
+                else:
+                    call = _SyncCall()
+                generation = cache.generation
+                try:
+                    call.value = fn(*args, **kwargs)
+                    cache.set(key, call.value, generation)
+                    return call.value
+                except BaseException as e:
+                    call.error = e
+                    raise
+                finally:
+                    call.event.set()
+                    with inflight_lock:
+                        if inflight_sync.get(key) is call:
+                            del inflight_sync[key]
+
+        wrapper.cache = cache
+        wrapper.invalidate = cache.invalidate
+        return wrapper
+    return decorator
+
+
+def add_invalidate_hook(hook: Callable[[str, tuple], None]) -> None:
+    _invalidate_hooks.append(hook)
+
+
+def invalidate_local(name: str, prefix: Optional[tuple]) -> None:
+    """
+    只删除本进程中的缓存条目，不调用hook，prefix为None时清空
+    """
+    cache = _registry.get(name)
+    if cache is not None:
+        cache._invalidate(prefix or ())
+
+
+def cache_stats():
+    """
+    所有缓存的统计信息
+    """
+    return [c.stats() for c in _registry.values()]
@@ -1,23 +1,35 @@
 import asyncio
-from typing import Any, Dict
+from typing import Any, Dict, Optional, Set
 from aiocqhttp.api import Api
 
 from .components.web_operation import register_routes
-from .components.kernel import init, execute, jobs, match
-from .components.score import score_table
-from .components.realize import (_level_by_cycle, _get_nickname_by_qqid,
+from .components.kernel import init, execute, execute_async, jobs, match
+from .components.score import score_table, score_table_picture
+from .components.daily import get_daily_summary, get_daily_summary_async, pcr_rollover
+from .components.history import get_member_history, get_member_history_async
+from .components.query_async import (get_group_async, get_user_async, get_report_async,
+				get_battle_member_list_async, get_member_list_async)
+from .components.nickname import (_get_nickname_by_qqid, _get_nicknames_by_qqids,
+				_preload_group_nicknames, _set_nickname_cache, _forget_group_nicknames,
+				_queue_nickname_lookup, _nickname_lookup_worker)
+from .components.realize import (_level_by_cycle,
 				_get_group_previous_challenge, _update_group_list_async, 
-				_fetch_member_list_async, _update_all_group_members_async,
-				_update_user_nickname_async, _boss_data_dict,
+				_fetch_member_list_async, _update_all_group_members_async, _update_all_groups_members_async,
+				_update_user_nickname_async, _boss_data_dict, _invalidate_report_cache,
+				_get_group, _notify_boss_status, _set_boss_status, _activate_group, _evict_idle_groups,
 
 				create_group, bind_group, drop_member, boss_status_summary, challenge,
-				undo, challenger_info, challenger_info_small, modify, change_game_server,
+				undo, challenger_info, challenger_info_picture, challenger_info_small, modify, change_game_server,
 				get_data_slot_record_count, clear_data_slot, switch_data_slot,
 				send_private_remind, send_remind, apply_for_challenge, behelf_remind,
 				put_on_the_tree, take_it_of_the_tree, check_blade, subscribe,subscribe_cancel,
 				cancel_blade, save_slot, get_in_boss_num, report_hurt, text_2_pic,
 
-				get_report, get_battle_member_list, get_member_list, get_subscribe_list)
+				get_report, get_battle_member_list, get_member_list, get_subscribe_list,
+
+				challenge_async, undo_async, modify_async, drop_member_async, apply_for_challenge_async,
+				cancel_blade_async, put_on_the_tree_async, take_it_of_the_tree_async, subscribe_async,
+				subscribe_cancel_async, save_slot_async, clear_data_slot_async, switch_data_slot_async)
 
 
 class ClanBattle:
@@ -28,6 +40,7 @@ class ClanBattle:
 	#### 核心
 	init = init			#初始化
 	execute = execute	#执行
+	execute_async = execute_async	#执行（数据库线程）
 	jobs = jobs			#验证
 	match = match		#匹配
 	#### 核心
@@ -36,22 +49,40 @@ class ClanBattle:
 	def __init__(self, glo_setting:Dict[str, Any], bot_api:Api, boss_id_name:Dict, *args, **kwargs):
 		# data initialize
 		self._boss_status:Dict[str, asyncio.Future] = {}
+		self._group_access:Dict[str, float] = {}	# 激活的公会最后一次访问的时间
+		self._last_eviction = 0.0
+		self._nickname_pending:Set[int] = set()
+		self._nickname_worker:Optional[asyncio.Future] = None
 		self.init(glo_setting, bot_api, boss_id_name, args, kwargs)
 		
 	
 	register_routes = register_routes #网页端操作
 
 	score_table = score_table	#业绩
+	score_table_picture = score_table_picture	#业绩（未生成图片）
 	text_2_pic = text_2_pic		#文字转图片
 
 	_level_by_cycle = _level_by_cycle									##等级周目
 	_get_nickname_by_qqid = _get_nickname_by_qqid						##通过qq号获取成员名字
+	_get_nicknames_by_qqids = _get_nicknames_by_qqids					##批量获取成员名字
+	_preload_group_nicknames = _preload_group_nicknames					##预加载公会成员名字
+	_set_nickname_cache = _set_nickname_cache							##更新名字缓存
+	_forget_group_nicknames = _forget_group_nicknames					##清除公会名字预加载
+	_queue_nickname_lookup = _queue_nickname_lookup						##排队查询名字
+	_nickname_lookup_worker = _nickname_lookup_worker					##批量查询名字
 	_get_group_previous_challenge = _get_group_previous_challenge		##获取上一个出刀记录
 	_update_group_list_async = _update_group_list_async					##更新群列表
 	_fetch_member_list_async = _fetch_member_list_async					##获取群成员列表
 	_update_all_group_members_async = _update_all_group_members_async	##更新所有群成员
+	_update_all_groups_members_async = _update_all_groups_members_async	##更新所有公会的群成员
 	_update_user_nickname_async = _update_user_nickname_async			##更新成员名字
 	_boss_data_dict = _boss_data_dict									##获取boss当前数据
+	_invalidate_report_cache = _invalidate_report_cache					##清除报告缓存
+	_get_group = _get_group												##获取公会（修改操作中共用）
+	_notify_boss_status = _notify_boss_status							##通知web面板boss状态变化
+	_set_boss_status = _set_boss_status									##唤醒等待boss状态的长轮询
+	_activate_group = _activate_group									##激活公会
+	_evict_idle_groups = _evict_idle_groups								##移出闲置公会
 
 	create_group = create_group								##创建公会
 	bind_group = bind_group									##加入公会
@@ -73,6 +104,7 @@ class ClanBattle:
 	save_slot = save_slot									##SL
 	report_hurt = report_hurt								##报伤害/记录伤害
 	challenger_info = challenger_info						##当前出刀信息
+	challenger_info_picture = challenger_info_picture		##当前出刀信息（未生成图片）
 	challenger_info_small = challenger_info_small			##单个boss出刀信息
 	check_blade = check_blade								##检查是否已申请出刀
 	put_on_the_tree = put_on_the_tree						##挂树
@@ -85,5 +117,32 @@ class ClanBattle:
 	get_report = get_report										##获取报告
 	get_battle_member_list = get_battle_member_list				##从会战记录里获取成员列表
 	get_member_list = get_member_list							##获取所有成员列表
+
+	get_group_async = get_group_async										##获取公会（数据库线程）
+	get_user_async = get_user_async											##获取用户（数据库线程）
+	get_report_async = get_report_async										##获取报告（数据库线程）
+	get_battle_member_list_async = get_battle_member_list_async				##从会战记录里获取成员列表（数据库线程）
+	get_member_list_async = get_member_list_async							##获取所有成员列表（数据库线程）
+
+	challenge_async = challenge_async						##报刀（数据库线程）
+	undo_async = undo_async									##撤销（数据库线程）
+	modify_async = modify_async								##修改boss状态（数据库线程）
+	drop_member_async = drop_member_async					##删除成员（数据库线程）
+	apply_for_challenge_async = apply_for_challenge_async	##申请出刀（数据库线程）
+	cancel_blade_async = cancel_blade_async					##取消申请出刀（数据库线程）
+	put_on_the_tree_async = put_on_the_tree_async			##挂树（数据库线程）
+	take_it_of_the_tree_async = take_it_of_the_tree_async	##下树（数据库线程）
+	subscribe_async = subscribe_async						##预约（数据库线程）
+	subscribe_cancel_async = subscribe_cancel_async			##取消预约（数据库线程）
+	save_slot_async = save_slot_async						##SL（数据库线程）
+	clear_data_slot_async = clear_data_slot_async			##清空会战数据记录档案（数据库线程）
+	switch_data_slot_async = switch_data_slot_async			##切换会战数据记录档案（数据库线程）
+
+	get_daily_summary = get_daily_summary					##获取一天的出刀总结
+	get_daily_summary_async = get_daily_summary_async		##获取一天的出刀总结（数据库线程）
+	pcr_rollover = pcr_rollover								##pcr日期切换
+
+	get_member_history = get_member_history					##获取成员每期会战的出刀趋势
+	get_member_history_async = get_member_history_async		##获取成员每期会战的出刀趋势（数据库线程）
 	
 
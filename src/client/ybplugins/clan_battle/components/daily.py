@@ -0,0 +1,162 @@
+import logging
+import time
+from typing import Any, Dict, List
+
+from peewee import JOIN, Case, fn
+
+from ... import ybdata
+from ...cache_util import cached_func
+from ...db_executor import run_in_db, run_in_reader
+from ...ybdata import Clan_challenge, Clan_daily, Clan_group, Clan_member, User
+from ..exception import GroupNotExist
+from ..typing import Groupid, Pcr_date
+from ..util import pcr_today
+
+_logger = logging.getLogger(__name__)
+
+_DAILY_FIELDS = [
+	Clan_daily.gid, Clan_daily.bid, Clan_daily.challenge_pcrdate, Clan_daily.qqid,
+	Clan_daily.challenges, Clan_daily.blades, Clan_daily.damage, Clan_daily.sl,
+]
+
+#按成员汇总一天的出刀记录
+def _daily_query(group_id: Groupid, pcrdate: Pcr_date):
+	# 字段顺序同_DAILY_FIELDS；不是尾刀的刀和补偿刀算完整刀
+	blade = Case(None, [(
+		(Clan_challenge.boss_health_remain > 0) | (Clan_challenge.is_continue == True), 1)], 0)
+	sl = Case(None, [(Clan_member.last_save_slot == Clan_challenge.challenge_pcrdate, 1)], 0)
+	return Clan_challenge.select(
+		Clan_challenge.gid,
+		Clan_challenge.bid,
+		Clan_challenge.challenge_pcrdate,
+		Clan_challenge.qqid,
+		fn.COUNT(Clan_challenge.cid),
+		fn.SUM(blade),
+		fn.SUM(Clan_challenge.challenge_damage),
+		fn.MAX(sl),
+	).join(
+		Clan_member,
+		JOIN.LEFT_OUTER,
+		on=((Clan_member.group_id == Clan_challenge.gid) & (Clan_member.qqid == Clan_challenge.qqid)),
+	).where(
+		Clan_challenge.gid == group_id,
+		Clan_challenge.challenge_pcrdate == pcrdate,
+	).group_by(
+		Clan_challenge.gid,
+		Clan_challenge.bid,
+		Clan_challenge.challenge_pcrdate,
+		Clan_challenge.qqid,
+	)
+
+#生成公会一天的汇总
+def _finalize_group_day(group_id: Groupid, pcrdate: Pcr_date) -> int:
+	"""
+	已汇总过的重新生成，在修改操作中调用时与修改在同一个事务中
+
+	Returns:
+		汇总的成员数
+	"""
+	where = ((Clan_daily.gid == group_id) & (Clan_daily.challenge_pcrdate == pcrdate))
+	with Clan_daily._meta.database.atomic():
+		# SL记录只保存最后一次的日期，重新生成时保留原来的
+		sl_members = [qqid for qqid, in Clan_daily.select(Clan_daily.qqid).where(
+			where, Clan_daily.sl > 0).tuples()]
+		Clan_daily.delete().where(where).execute()
+		count = Clan_daily.insert_from(
+			_daily_query(group_id, pcrdate), _DAILY_FIELDS).as_rowcount().execute()
+		if sl_members:
+			Clan_daily.update(sl=1).where(where, Clan_daily.qqid.in_(sl_members)).execute()
+	return count
+
+#生成所有公会一天的汇总
+def _finalize_day(area: str, pcrdate: Pcr_date) -> List[Groupid]:
+	"""
+	Args:
+		area: 服务器，只汇总这个服务器的公会
+		pcrdate: 日期
+
+	Returns:
+		当天有出刀记录的公会
+	"""
+	finalized = []
+	for _ in ybdata.each_database():
+		group_ids = [group_id for group_id, in Clan_group.select(Clan_group.group_id).where(
+			Clan_group.game_server == area,
+			Clan_group.deleted == False,
+		).tuples()]
+		for group_id in group_ids:
+			if _finalize_group_day(group_id, pcrdate):
+				finalized.append(group_id)
+	return finalized
+
+#公会一天的出刀总结
+def _summarize_day(group_id: Groupid, pcrdate: Pcr_date) -> Dict[str, Any]:
+	"""
+	已汇总的日期从每日汇总表读取，没有汇总的（当天）从出刀记录计算
+	"""
+	if not Clan_group.select().where(Clan_group.group_id == group_id).exists():
+		raise GroupNotExist
+	rows = list(Clan_daily.select(*_DAILY_FIELDS).where(
+		Clan_daily.gid == group_id,
+		Clan_daily.challenge_pcrdate == pcrdate,
+	).tuples())
+	finalized = bool(rows)
+	if not finalized:
+		rows = list(_daily_query(group_id, pcrdate).tuples())
+	members = {}
+	for _, _, _, qqid, challenges, blades, damage, sl in rows:
+		# 同一天切换过档案时合并
+		member = members.setdefault(qqid, {
+			'qqid': qqid, 'challenges': 0, 'blades': 0, 'damage': 0, 'sl': False})
+		member['challenges'] += challenges
+		member['blades'] += blades
+		member['damage'] += damage
+		member['sl'] = member['sl'] or bool(sl)
+	nicknames = dict(User.select(User.qqid, User.nickname).where(
+		User.qqid.in_(list(members))).tuples()) if members else {}
+	for qqid, member in members.items():
+		member['nickname'] = nicknames.get(qqid) or str(qqid)
+	members = sorted(members.values(), key=lambda m: m['damage'], reverse=True)
+	return {
+		'pcrdate': pcrdate,
+		'finalized': finalized,
+		'members': members,
+		'challenges': sum(m['challenges'] for m in members),
+		'blades': sum(m['blades'] for m in members),
+		'damage': sum(m['damage'] for m in members),
+	}
+
+#获取一天的出刀总结（已结束的日期）
+@cached_func(256, ttl=86400, ignore_self=True)
+def get_daily_summary(self, group_id: Groupid, pcrdate: Pcr_date) -> Dict[str, Any]:
+	"""
+	Args:
+		group_id: QQ群号
+		pcrdate: 日期，当天的总结用get_daily_summary_async，不缓存
+	"""
+	return _summarize_day(group_id, pcrdate)
+
+#获取一天的出刀总结（只读连接）
+async def get_daily_summary_async(self, group: Clan_group, pcrdate: Pcr_date) -> Dict[str, Any]:
+	if pcrdate >= pcr_today(group.game_server):
+		# 当天的出刀还在变化
+		return await run_in_reader(_summarize_day, group.group_id, pcrdate)
+	return await run_in_reader(self.get_daily_summary, group.group_id, pcrdate)
+
+#pcr日期切换
+async def pcr_rollover(self, area: str):
+	"""
+	各服务器当地5点执行：汇总前一天的出刀，预先生成各公会前一天的总结
+
+	Args:
+		area: 服务器
+	"""
+	start = time.perf_counter()
+	yesterday = pcr_today(area) - 1
+	group_ids = await run_in_db(_finalize_day, area, yesterday)
+	for group_id in group_ids:
+		self.get_daily_summary.invalidate(group_id, yesterday)
+		with ybdata.group_scope(group_id):
+			await run_in_reader(self.get_daily_summary, group_id, yesterday)
+	_logger.info('{}服日期切换，汇总了{}个公会的出刀，耗时{:.2f}秒'.format(
+		area, len(group_ids), time.perf_counter() - start))
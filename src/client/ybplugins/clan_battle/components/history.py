@@ -0,0 +1,137 @@
+import time
+from typing import Any, Dict, List, Optional
+
+from ... import battle_archive, ybdata
+from ...cache_util import cached_func
+from ...db_executor import run_in_reader
+from ...ybdata import Clan_challenge, Clan_group, Clan_member_history, member_history_insert
+from ..exception import GroupNotExist
+from ..typing import Groupid, QQid
+
+#报刀和撤销时更新成员历史汇总
+def _record_history(challenge: Clan_challenge, sign: int):
+	"""
+	在报刀、撤销的事务中调用
+
+	Args:
+		challenge: 新增或撤销的出刀记录
+		sign: 新增为1，撤销为-1
+	"""
+	key = (
+		(Clan_member_history.gid == challenge.gid)
+		& (Clan_member_history.bid == challenge.bid)
+		& (Clan_member_history.qqid == challenge.qqid)
+		& (Clan_member_history.boss_num == challenge.boss_num)
+	)
+	blade = int(bool(challenge.boss_health_remain > 0 or challenge.is_continue))
+	updated = Clan_member_history.update(
+		challenges=Clan_member_history.challenges + sign,
+		blades=Clan_member_history.blades + sign * blade,
+		damage=Clan_member_history.damage + sign * challenge.challenge_damage,
+	).where(key).execute()
+	if sign > 0 and not updated:
+		Clan_member_history.insert(
+			gid=challenge.gid,
+			bid=challenge.bid,
+			qqid=challenge.qqid,
+			boss_num=challenge.boss_num,
+			challenges=1,
+			blades=blade,
+			damage=challenge.challenge_damage,
+			first_pcrdate=challenge.challenge_pcrdate,
+		).execute()
+	elif sign < 0:
+		Clan_member_history.delete().where(key, Clan_member_history.challenges <= 0).execute()
+
+#从出刀记录重新生成公会的历史汇总
+def rebuild_history(group_id: Groupid) -> int:
+	"""
+	包括冷存档中的会战，需要在公会所在的数据库中执行
+
+	Returns:
+		汇总的记录数
+	"""
+	db = Clan_member_history._meta.database
+	# 冷存档要ATTACH，不能在事务中
+	with battle_archive.challenge_sources(group_id, 'all') as sources:
+		with db.atomic():
+			Clan_member_history.delete().where(Clan_member_history.gid == group_id).execute()
+			count = 0
+			for model, expressions in sources:
+				count += member_history_insert(
+					model, model.gid == group_id, *expressions).as_rowcount().execute()
+	return count
+
+#重新生成所有公会的历史汇总
+def rebuild_all_history():
+	"""
+	Yields:
+		(群号, 汇总的记录数, 耗时秒数)
+	"""
+	for _ in ybdata.each_database():
+		group_ids = [group_id for group_id, in Clan_group.select(Clan_group.group_id).tuples()]
+		for group_id in group_ids:
+			start = time.perf_counter()
+			count = rebuild_history(group_id)
+			yield group_id, count, time.perf_counter() - start
+
+#获取成员每期会战的出刀趋势
+@cached_func(64, ttl=600, ignore_self=True)
+def get_member_history(self, group_id: Groupid, qqid: Optional[QQid] = None) -> List[Dict[str, Any]]:
+	"""
+	从历史汇总表读取，不扫描出刀记录
+
+	Args:
+		group_id: QQ群号
+		qqid: 成员QQ号，为None时汇总全公会
+
+	Returns:
+		按档案号排序的列表，每期包括出刀数、完整刀数、总伤害、平均伤害和每个boss的数据
+	"""
+	if not Clan_group.select().where(Clan_group.group_id == group_id).exists():
+		raise GroupNotExist
+	query = Clan_member_history.select().where(Clan_member_history.gid == group_id)
+	if qqid is not None:
+		query = query.where(Clan_member_history.qqid == qqid)
+	battles = {}
+	for row in query:
+		battle = battles.get(row.bid)
+		if battle is None:
+			battle = battles[row.bid] = {
+				'battle_id': row.bid,
+				'pcrdate': row.first_pcrdate,
+				'challenges': 0,
+				'blades': 0,
+				'damage': 0,
+				'members': set(),
+				'bosses': {},
+			}
+		battle['pcrdate'] = min(battle['pcrdate'], row.first_pcrdate)
+		battle['challenges'] += row.challenges
+		battle['blades'] += row.blades
+		battle['damage'] += row.damage
+		battle['members'].add(row.qqid)
+		boss = battle['bosses'].setdefault(row.boss_num, {'challenges': 0, 'damage': 0})
+		boss['challenges'] += row.challenges
+		boss['damage'] += row.damage
+	series = []
+	for battle_id in sorted(battles):
+		battle = battles[battle_id]
+		# 平均伤害按出刀记录计算
+		battle['average'] = battle['damage'] // battle['challenges'] if battle['challenges'] else 0
+		for boss in battle['bosses'].values():
+			boss['average'] = boss['damage'] // boss['challenges'] if boss['challenges'] else 0
+		battle['bosses'] = {str(n): battle['bosses'][n] for n in sorted(battle['bosses'])}
+		members = battle.pop('members')
+		if qqid is None:
+			battle['members'] = len(members)
+		series.append(battle)
+	return series
+
+#获取成员每期会战的出刀趋势（只读连接）
+async def get_member_history_async(self,
+									group_id: Groupid,
+									qqid: Optional[QQid] = None,
+									) -> List[Dict[str, Any]]:
+	# 参数按位置传入，与同步调用共用缓存
+	return await run_in_reader(self.get_member_history, group_id, qqid)
@@ -2,18 +2,39 @@ import asyncio
 import logging
 import os
 import re
+import time
 from typing import Any, Dict
 from urllib.parse import urljoin
 
 from aiocqhttp.api import Api
 from apscheduler.triggers.cron import CronTrigger
 
-from ...ybdata import Clan_group, Clan_member, User
+from ... import battle_archive, cluster, log_util, metrics, sql_profiler, ybdata
+from ...auth_util import invalidate_membership, invalidate_user
+from ...db_executor import run_in_db, run_in_reader, spawn
+from ...ybdata import Clan_member, User
 from ..exception import ClanBattleError
-from ..util import atqq
+from ..util import atqq, pcr_time_offset, pcr_tzinfo
 from .define import Commands, Server
+from .realize import Picture
 
 _logger = logging.getLogger(__name__)
+# 每条指令一条结构化记录，只写入json日志
+_audit_logger = logging.getLogger(__name__ + '.audit')
+_audit_logger.propagate = False
+
+# 同一个编号的多个指令取第一个作为名字
+_command_names = {}
+for _name, _num in Commands.items():
+	_command_names.setdefault(_num, _name)
+
+# 只查询不修改的指令：状态、业绩、面板
+_QUERY_COMMANDS = {3, 8, 15}
+
+COMMANDS = metrics.Counter(
+	'yobot_clan_commands_total', '处理的公会战指令数', ('command',))
+COMMAND_SECONDS = metrics.Histogram(
+	'yobot_clan_command_seconds', '处理公会战指令的耗时', ('command',))
 
 
 #初始化
@@ -31,20 +52,32 @@ def init(self,
 	if not os.path.exists(os.path.join(glo_setting['dirname'], 'log')):
 		os.mkdir(os.path.join(glo_setting['dirname'], 'log'))
 
+	# 由后台线程写入，文件按大小和日期轮转并压缩；多进程部署时每个进程写自己的文件
 	formater = logging.Formatter('[%(asctime)s] %(levelname)s: %(message)s')
-	filehandler = logging.FileHandler(
-		os.path.join(glo_setting['dirname'], 'log', '公会战日志.log'),
-		encoding='utf-8',
+	not_audit = lambda record: record.name != _audit_logger.name
+	filehandler = log_util.rotating_file_handler(
+		cluster.worker_filename(os.path.join(glo_setting['dirname'], 'log', '公会战日志.log')),
+		glo_setting,
 	)
 	filehandler.setFormatter(formater)
+	filehandler.addFilter(not_audit)
 	consolehandler = logging.StreamHandler()
 	consolehandler.setFormatter(formater)
-	_logger.addHandler(filehandler)
-	_logger.addHandler(consolehandler)
-	_logger.setLevel(logging.INFO)
+	consolehandler.addFilter(not_audit)
+	self.audit_log_path = os.path.join(glo_setting['dirname'], 'log', '公会战日志.jsonl')
+	audithandler = log_util.rotating_file_handler(
+		cluster.worker_filename(self.audit_log_path), glo_setting)
+	audithandler.setFormatter(log_util.JsonFormatter())
+	web_logger = logging.getLogger(__name__.rsplit('.', 1)[0] + '.web_operation')
+	for logger in (_logger, _audit_logger, web_logger):
+		logger.setLevel(logging.INFO)
+	self._log_listener = log_util.attach_queue(
+		(_logger, _audit_logger, web_logger),
+		(filehandler, consolehandler, audithandler),
+	)
 
-	for group in Clan_group.select().where(Clan_group.deleted == False):
-		self._boss_status[group.group_id] = asyncio.get_event_loop().create_future()
+	# 公会在网页第一次访问时激活（_activate_group），启动时不载入
+	cluster.subscribe('boss_status', self._set_boss_status)
 
 	# super-admin initialize
 	User.update({User.authority_group: 100}).where(
@@ -61,8 +94,24 @@ def jobs(self):
 
 	def ensure_future_update_all_group_members():
 		asyncio.ensure_future(self._update_group_list_async())
+		asyncio.ensure_future(self._update_all_groups_members_async())
+
+	jobs = [(trigger, ensure_future_update_all_group_members)]
+
+	# 各服务器的日期在当地5点切换（pcr日期的0点），稍晚几秒执行
+	for area in pcr_time_offset:
+		async def rollover(area=area):
+			await self.pcr_rollover(area)
+		jobs.append((CronTrigger(hour=0, minute=0, second=10, timezone=pcr_tzinfo(area)), rollover))
+
+	archive_days = self.setting.get('battle_archive_days', 0)
+	if archive_days > 0 and battle_archive.enabled():
+		async def archive_finished_battles():
+			# 在数据库线程中移动，不阻塞事件循环
+			await run_in_db(battle_archive.archive_finished_battles, archive_days)
+		jobs.append((CronTrigger(hour=4, minute=30), archive_finished_battles))
 
-	return ((trigger, ensure_future_update_all_group_members),)
+	return tuple(jobs)
 
 #匹配
 def match(self, cmd):
@@ -73,9 +122,49 @@ def match(self, cmd):
 	return Commands.get(cmd[0:2], 0)
 
 
+#执行（数据库线程）
+async def execute_async(self, match_num, ctx):
+	# 修改与网页的修改操作在同一个线程中依次执行，同一个公会的修改不会交错；
+	# 只查询的指令在只读连接上执行，图片在默认线程池中生成，都不占用数据库线程
+	run = run_in_reader if match_num in _QUERY_COMMANDS else run_in_db
+	reply = await run(_execute_command, self, match_num, ctx)
+	if isinstance(reply, Picture):
+		reply = await asyncio.get_event_loop().run_in_executor(None, reply.render)
+	return reply
+
 #执行
 def execute(self, match_num, ctx):
+	reply = _execute_command(self, match_num, ctx)
+	if isinstance(reply, Picture): reply = reply.render()
+	return reply
+
+def _execute_command(self, match_num, ctx):
 	if ctx['message_type'] != 'group': return None
+	command = _command_names.get(match_num, str(match_num))
+	start = time.perf_counter()
+	reply = error = None
+	with log_util.log_context(group_id=ctx['group_id'], user_id=ctx['user_id'], command=command):
+		try:
+			# 只有创建公会时新建公会数据库
+			with sql_profiler.profile('指令 ' + command), \
+					ybdata.group_scope(ctx['group_id'], create=(match_num == 1)):
+				reply = _execute(self, match_num, ctx)
+			return reply
+		except Exception as e:
+			error = e
+			raise
+		finally:
+			latency = time.perf_counter() - start
+			COMMANDS.inc(command=command)
+			COMMAND_SECONDS.observe(latency, command=command)
+			# 没有回复的是不符合格式的普通聊天，不记录
+			if reply is not None or error is not None:
+				_audit_logger.info(ctx['raw_message'], extra={
+					'latency_ms': round(latency * 1000, 1),
+					'result': str(reply if error is None else error)[:200],
+				})
+
+def _execute(self, match_num, ctx):
 	cmd = ctx['raw_message']
 	group_id = ctx['group_id']
 	user_id = ctx['user_id']
@@ -103,7 +192,7 @@ def execute(self, match_num, ctx):
 			if ctx['sender']['role'] == 'member':
 				return '只有管理员才可以加入全部成员'
 			_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
-			asyncio.ensure_future(self._update_all_group_members_async(group_id))
+			spawn(self._update_all_group_members_async(group_id))
 			return '本群所有成员已添加记录'
 		match = re.match(r'^加入[公工行]会 *(?:\[CQ:at,qq=(\d+)\])? *$', cmd)
 		if match:
@@ -114,14 +203,14 @@ def execute(self, match_num, ctx):
 				nickname = None
 			else:
 				nickname = (ctx['sender'].get('card') or ctx['sender'].get('nickname'))
-			asyncio.ensure_future(self.bind_group(group_id, user_id, nickname))
+			spawn(self.bind_group(group_id, user_id, nickname))
 			_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
 			return '{}已加入本公会'.format(atqq(user_id))
 
 
 	elif match_num == 3:  # 状态
 		if cmd != '状态': return
-		try: boss_summary = self.boss_status_summary(group_id)
+		try: boss_summary = self.challenger_info_picture(group_id)
 		except ClanBattleError as e: return str(e)
 		return boss_summary
 
@@ -201,7 +290,7 @@ def execute(self, match_num, ctx):
 		match = re.match(r'^业绩(表) *$', cmd)
 		if not match: return
 		try:
-			back_msg = self.score_table(group_id)
+			back_msg = self.score_table_picture(group_id)
 		except ClanBattleError as e:
 			_logger.info('群聊 失败 {} {} {}'.format(user_id, group_id, cmd))
 			return str(e)
@@ -254,19 +343,23 @@ def execute(self, match_num, ctx):
 		msg = ''
 		if behalf:
 			user_id = behalf
-		if b == '挂树':
-			msg = self.take_it_of_the_tree(group_id, user_id)
-		elif b == '出刀' or b == '申请' or b == '申请出刀':
-			msg =  self.cancel_blade(group_id, user_id)
-		elif b == '出刀all':
-			msg =  self.cancel_blade(group_id, user_id, cancel_type=0)
-		elif b == '报伤害':
-			msg =  self.report_hurt(0, 0, group_id, user_id, 1)
-		elif b == 'sl' or b == 'SL':
-			msg =  self.save_slot(group_id, user_id, clean_flag = True)
-		elif b == '预约':
-			msg = self.subscribe_cancel(group_id, boss_num, user_id)
-		else: return
+		try:
+			if b == '挂树':
+				msg = self.take_it_of_the_tree(group_id, user_id)
+			elif b == '出刀' or b == '申请' or b == '申请出刀':
+				msg =  self.cancel_blade(group_id, user_id)
+			elif b == '出刀all':
+				msg =  self.cancel_blade(group_id, user_id, cancel_type=0)
+			elif b == '报伤害':
+				msg =  self.report_hurt(0, 0, group_id, user_id, 1)
+			elif b == 'sl' or b == 'SL':
+				msg =  self.save_slot(group_id, user_id, clean_flag = True)
+			elif b == '预约':
+				msg = self.subscribe_cancel(group_id, boss_num, user_id)
+			else: return
+		except ClanBattleError as e:
+			_logger.info('群聊 失败 {} {} {}'.format(user_id, group_id, cmd))
+			return str(e)
 		_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
 		return msg
 
@@ -327,6 +420,8 @@ def execute(self, match_num, ctx):
 				membership.role = user.authority_group
 			user.save()
 			membership.save()
+			invalidate_user(user_id)
+			invalidate_membership(group_id, user_id)
 			_logger.info('群聊 成功 {} {} {}'.format(user_id, group_id, cmd))
 			return '{}已成功申请权限'.format(atqq(user_id))
 	
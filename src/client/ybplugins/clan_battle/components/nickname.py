@@ -0,0 +1,128 @@
+import asyncio
+import logging
+from typing import Dict, Iterable
+
+from ...cache_util import LRUCache
+from ...db_executor import call_in_loop, run_in_db
+from ...ybdata import Clan_member, User
+from ..typing import Groupid, QQid
+
+_logger = logging.getLogger(__name__)
+
+NICKNAME_TTL = 3600			# 名字缓存时间
+NEGATIVE_TTL = 6 * 3600		# 接口查不到名字的qq号，这段时间内不再查询
+LOOKUP_INTERVAL = 0.5		# 两次接口调用之间的间隔（秒）
+LOOKUP_BATCH = 20			# 每批查询的qq号数量，每批写一次数据库
+_IN_CHUNK = 500				# sqlite单条语句的参数个数有上限
+
+# 键为(qqid,)，值为数据库中的名字，没有名字则缓存None
+_nickname_cache = LRUCache(4096, NICKNAME_TTL, 'nickname')
+_group_loaded = LRUCache(256, NICKNAME_TTL, 'nickname_group')
+_lookup_failed = LRUCache(4096, NEGATIVE_TTL, 'nickname_negative')
+
+
+#通过qq号获取名字（只读）
+def _get_nickname_by_qqid(self, qqid) -> str:
+	qqid = int(qqid)
+	hit, nickname = _nickname_cache.get((qqid,))
+	if hit: return nickname or str(qqid)
+	return self._get_nicknames_by_qqids((qqid,))[qqid]
+
+#批量获取名字
+def _get_nicknames_by_qqids(self, qqids: Iterable[QQid]) -> Dict[QQid, str]:
+	"""
+	未缓存的qq号合并为一次查询，数据库中没有名字的会排队向接口查询
+
+	Args:
+		qqids: qq号列表
+	"""
+	result = {}
+	missing = []
+	for qqid in set(map(int, qqids)):
+		hit, nickname = _nickname_cache.get((qqid,))
+		if hit: result[qqid] = nickname or str(qqid)
+		else: missing.append(qqid)
+
+	for i in range(0, len(missing), _IN_CHUNK):
+		chunk = missing[i:i+_IN_CHUNK]
+		found = dict(User.select(User.qqid, User.nickname).where(
+			User.qqid.in_(chunk)
+		).tuples())
+		for qqid in chunk:
+			nickname = found.get(qqid)
+			_nickname_cache.set((qqid,), nickname)
+			if nickname is None: self._queue_nickname_lookup(qqid)
+			result[qqid] = nickname or str(qqid)
+	return result
+
+#预加载整个公会的名字
+def _preload_group_nicknames(self, group_id: Groupid):
+	"""
+	一次查询载入公会所有成员的名字，之后的单个查询直接命中缓存
+
+	Args:
+		group_id: QQ群号
+	"""
+	if _group_loaded.get((group_id,))[0]: return
+	query = User.select(User.qqid, User.nickname).join(
+		Clan_member,
+		on=(User.qqid == Clan_member.qqid),
+	).where(
+		Clan_member.group_id == group_id,
+	).tuples()
+	for qqid, nickname in query:
+		_nickname_cache.set((qqid,), nickname)
+		if nickname is None: self._queue_nickname_lookup(qqid)
+	_group_loaded.set((group_id,), True)
+
+#更新缓存中的名字
+def _set_nickname_cache(self, qqid: QQid, nickname: str):
+	_nickname_cache.set((int(qqid),), nickname)
+	if nickname: _lookup_failed.invalidate(int(qqid))
+
+#公会成员变动后需要重新预加载
+def _forget_group_nicknames(self, group_id: Groupid):
+	_group_loaded.invalidate(group_id)
+
+#排队向接口查询名字
+def _queue_nickname_lookup(self, qqid: QQid):
+	# 可能在数据库线程中调用，等待队列只在事件循环中修改
+	call_in_loop(_enqueue_nickname_lookup, self, qqid)
+
+def _enqueue_nickname_lookup(self, qqid: QQid):
+	if qqid in self._nickname_pending: return
+	if _lookup_failed.get((qqid,))[0]: return
+	self._nickname_pending.add(qqid)
+	if self._nickname_worker is None or self._nickname_worker.done():
+		self._nickname_worker = asyncio.ensure_future(self._nickname_lookup_worker())
+
+#逐批查询名字，限制接口调用频率
+async def _nickname_lookup_worker(self):
+	while self._nickname_pending:
+		batch = []
+		while self._nickname_pending and len(batch) < LOOKUP_BATCH:
+			batch.append(self._nickname_pending.pop())
+		found = {}
+		for qqid in batch:
+			try:
+				userinfo = await self.api.get_stranger_info(user_id=qqid)
+				nickname = userinfo and userinfo.get('nickname')
+			except Exception as e:
+				_logger.warning(f'获取{qqid}的昵称失败：{e}')
+				nickname = None
+			if nickname: found[qqid] = nickname
+			else: _lookup_failed.set((qqid,), True)
+			await asyncio.sleep(LOOKUP_INTERVAL)
+		if not found: continue
+		await run_in_db(_fill_nicknames, found)
+		for qqid, nickname in found.items():
+			_nickname_cache.set((qqid,), nickname)
+
+#补全已有用户的空名字，不创建用户（数据库线程）
+def _fill_nicknames(found: Dict[QQid, str]):
+	with User._meta.database.atomic():
+		for qqid, nickname in found.items():
+			User.update({User.nickname: nickname}).where(
+				User.qqid == qqid,
+				User.nickname.is_null(),
+			).execute()
@@ -0,0 +1,37 @@
+from typing import Any, Dict, List, Optional, Union
+
+from ...db_executor import run_in_reader
+from ...ybdata import Clan_group, User
+from ..typing import ClanBattleReport, Groupid, Pcr_date, QQid
+
+# 以下查询都在只读连接上执行，供web处理函数使用
+# 报刀等修改操作见realize中的*_async，与群聊指令一起在唯一的写入线程（run_in_db）中执行
+
+#获取公会
+async def get_group_async(self, group_id: Groupid) -> Optional[Clan_group]:
+	return await run_in_reader(Clan_group.get_or_none, Clan_group.group_id == group_id)
+
+#获取用户
+async def get_user_async(self, qqid: QQid) -> Optional[User]:
+	return await run_in_reader(User.get_or_none, User.qqid == qqid)
+
+#获取报告
+async def get_report_async(self,
+							group_id: Groupid,
+							battle_id: Union[str, int, None],
+							qqid: Optional[QQid] = None,
+							pcrdate: Optional[Pcr_date] = None,
+							) -> ClanBattleReport:
+	# 参数按位置传入，与同步调用共用缓存
+	return await run_in_reader(self.get_report, group_id, battle_id, qqid, pcrdate)
+
+#从会战记录里获取成员列表
+async def get_battle_member_list_async(self,
+										group_id: Groupid,
+										battle_id: Union[str, int, None],
+										) -> List[Dict[str, Any]]:
+	return await run_in_reader(self.get_battle_member_list, group_id, battle_id)
+
+#获取所有成员列表
+async def get_member_list_async(self, group_id: Groupid) -> List[Dict[str, Any]]:
+	return await run_in_reader(self.get_member_list, group_id)
@@ -5,36 +5,124 @@ import peewee
 import base64
 import random
 import string
+import time
 import asyncio
 import logging
+import functools
+import threading
 from io import BytesIO
 from PIL import Image, ImageFont, ImageDraw
 from typing import Any, Dict, List, Optional, Union, Tuple
 
 from ..typing import ClanBattleReport, Groupid, Pcr_date, QQid
-from ...web_util import async_cached_func
-from ..util import atqq, pcr_datetime, pcr_timestamp, timed_cached_func
-
-from ...ybdata import Clan_challenge, Clan_group, Clan_member, User, Clan_group_backups
+from ... import battle_archive, cluster, metrics, ybdata
+from ...auth_util import invalidate_group, invalidate_membership, invalidate_user
+from ...cache_util import cached_func, invalidate_local
+from ...db_executor import call_in_loop, run_in_db, spawn
+from ..util import atqq, pcr_datetime, pcr_timestamp, pcr_today
+
+from ...ybdata import (Clan_challenge, Clan_daily, Clan_group, Clan_member, Clan_member_history, User,
+	Clan_group_backups)
 from ..exception import GroupError, GroupNotExist, InputError, UserError, UserNotInGroup
+from .daily import _finalize_group_day
+from .history import _record_history
 
 _logger = logging.getLogger(__name__)
 FILE_PATH = os.path.dirname(__file__)
+EVICT_INTERVAL = 60	# 检查闲置公会的间隔（秒）
+
+ACTIVE_GROUPS = metrics.Gauge(
+	'yobot_clan_active_groups', '内存中激活的公会数')
 
 def safe_load_json(text, back = None):
 	return text and json.loads(text) or back
+
+# 当前线程正在进行的修改操作
+_mutation_state = threading.local()
+
+#修改操作
+def _mutation(fn):
+	"""
+	整个修改操作（包括其中调用的其他修改操作）在一个事务中完成
+
+	- 操作中通过_get_group获取的公会是同一个对象，结束时只保存改动过的字段
+	- 用_after_commit登记的缓存清除和web面板通知在提交后执行，出错回滚时不执行
+	- 群聊指令和网页（*_async）都在数据库线程中调用，修改操作之间不会交错
+	"""
+	@functools.wraps(fn)
+	def wrapper(self, *args, **kwargs):
+		if getattr(_mutation_state, 'groups', None) is not None:
+			return fn(self, *args, **kwargs)
+		_mutation_state.groups = {}
+		_mutation_state.callbacks = {}
+		try:
+			with Clan_group._meta.database.atomic():
+				result = fn(self, *args, **kwargs)
+				for group in _mutation_state.groups.values():
+					if group is not None and group.is_dirty():
+						group.save(only=group.dirty_fields)
+			callbacks = _mutation_state.callbacks
+		finally:
+			_mutation_state.groups = None
+			_mutation_state.callbacks = None
+		for callback in callbacks.values():
+			callback()
+		return result
+	return wrapper
+
+#提交后执行
+def _after_commit(key, callback):
+	"""
+	在修改操作中调用时，等事务提交后再执行，同一个key只执行最后登记的一次；
+	不在修改操作中则立即执行
+	"""
+	callbacks = getattr(_mutation_state, 'callbacks', None)
+	if callbacks is None: callback()
+	else: callbacks[key] = callback
+
+#在数据库线程中执行的版本
+def _mutation_async(fn):
+	"""
+	供网页处理函数await，和群聊指令一样在数据库线程中执行，
+	其中的web面板通知和消息发送由call_in_loop、spawn转回事件循环
+	"""
+	@functools.wraps(fn)
+	async def wrapper(self, *args, **kwargs):
+		return await run_in_db(fn, self, *args, **kwargs)
+	wrapper.__name__ = wrapper.__qualname__ = fn.__name__ + '_async'
+	return wrapper
+
 def text_2_pic(self, text:string, weight:int, height:int, bg_color:Tuple, text_color:string, font_size:int, text_offset:Tuple):
-	im = Image.new("RGB", (weight, height), bg_color)
-	dr = ImageDraw.Draw(im)
-	FONTS_PATH = os.path.join(FILE_PATH,'fonts')
-	FONTS = os.path.join(FONTS_PATH,'msyh.ttf')
-	font = ImageFont.truetype(FONTS, font_size)
-	dr.text(text_offset, text, font=font, fill=text_color)
-	bio = BytesIO()
-	im.save(bio, format='PNG')
-	base64_str = 'base64://' + base64.b64encode(bio.getvalue()).decode()
+	with metrics.RENDER_SECONDS.time(kind='text_2_pic'):
+		im = Image.new("RGB", (weight, height), bg_color)
+		dr = ImageDraw.Draw(im)
+		FONTS_PATH = os.path.join(FILE_PATH,'fonts')
+		FONTS = os.path.join(FONTS_PATH,'msyh.ttf')
+		font = ImageFont.truetype(FONTS, font_size)
+		dr.text(text_offset, text, font=font, fill=text_color)
+		bio = BytesIO()
+		im.save(bio, format='PNG')
+		base64_str = 'base64://' + base64.b64encode(bio.getvalue()).decode()
 	return f"[CQ:image,file={base64_str}]"
 
+#待生成的图片
+class Picture:
+	"""
+	查询得到的文字和text_2_pic的参数
+
+	生成图片较慢，由调用者决定在哪个线程中render，不占用数据库线程
+	"""
+	def __init__(self, owner, text: str, *args):
+		self.owner = owner
+		self.text = text
+		self.args = args
+
+	def render(self) -> str:
+		return self.owner.text_2_pic(self.text, *self.args)
+
+	def __str__(self):
+		return self.text
+
 
 #阶段周目
 def _level_by_cycle(self, cycle, game_server=None):
@@ -44,15 +132,6 @@ def _level_by_cycle(self, cycle, game_server=None):
 		level += 1
 	return level
 
-#通过qq号获取名字
-@timed_cached_func(128, 3600, ignore_self=True)
-def _get_nickname_by_qqid(self, qqid) -> Union[str, None]:
-	user = User.get_or_create(qqid=qqid)[0]
-	if user.nickname is None:
-		asyncio.ensure_future(self._update_user_nickname_async(
-			qqid = qqid, group_id = None))
-	return user.nickname or str(qqid)
-
 #获取上一个出刀记录
 def _get_group_previous_challenge(self, group: Clan_group):
 	Clan_challenge_alias = Clan_challenge.alias()
@@ -74,56 +153,192 @@ async def _update_group_list_async(self):
 		_logger.exception('获取群列表错误'+str(e))
 		return False
 
-	for group_info in group_list:
-		group = Clan_group.get_or_none(group_id=group_info['group_id'],)
-		if group is None : continue
-		group.group_name = group_info['group_name']
-		group.save()
+	def save_group_names():
+		for group_info in group_list:
+			with ybdata.group_scope(group_info['group_id']):
+				group = Clan_group.get_or_none(group_id=group_info['group_id'],)
+				if group is None : continue
+				group.group_name = group_info['group_name']
+				group.save()
+	await run_in_db(save_group_names)
 	return True
 
 #获取群成员列表
-@async_cached_func(16)
-async def _fetch_member_list_async(self, group_id):
+@cached_func(16, ttl=60, ignore_self=True)
+async def _fetch_member_list_async(self, group_id, quiet = False):
+	"""
+	Args:
+		quiet: 出错时只记录日志，不在群里提示（定时任务）
+	"""
 	try:
 		group_member_list = await self.api.get_group_member_list(group_id=group_id)
 	except Exception as e:
 		_logger.exception('获取群成员列表错误' + str(type(e)) + str(e))
-		asyncio.ensure_future(self.api.send_group_msg(
-			group_id = group_id, message = '获取群成员错误，这可能是缓存问题，请重启go-cqhttp后再试'))
+		if not quiet:
+			asyncio.ensure_future(self.api.send_group_msg(
+				group_id = group_id, message = '获取群成员错误，这可能是缓存问题，请重启go-cqhttp后再试'))
 		return []
 	return group_member_list
 
 #更新所有群成员
-async def _update_all_group_members_async(self, group_id):
-	group_member_list = await self._fetch_member_list_async(group_id)
+async def _update_all_group_members_async(self, group_id, quiet = False) -> Dict[str, int]:
+	"""
+	对比群成员列表与数据库，差异部分在一个事务内批量写入
+
+	Args:
+		group_id: QQ群号
+		quiet: 获取群成员出错时不在群里提示
+	Returns:
+		{'inserted': 新增人数, 'updated': 修改人数, 'unchanged': 未变人数}
+	"""
+	group_member_list = await self._fetch_member_list_async(group_id, quiet = quiet, nocache = True)
+	wanted = {}
 	for member in group_member_list:
-		user = User.get_or_create(qqid=member['user_id'])[0]
-		membership = Clan_member.get_or_create(group_id = group_id, qqid = member['user_id'])[0]
-		user.nickname = member.get('card') or member['nickname']
-		user.clan_group_id = group_id
-		if user.authority_group >= 10:
-			user.authority_group = (100 if member['role'] == 'member' else 10)
-			membership.role = user.authority_group
-		user.save()
-		membership.save()
+		wanted[member['user_id']] = (
+			member.get('card') or member['nickname'],
+			100 if member['role'] == 'member' else 10,
+		)
+	counts, changed_qqids = await run_in_db(_apply_member_list, group_id, wanted)
+
+	for qqid, (nickname, _) in wanted.items():
+		self._set_nickname_cache(qqid, nickname)
+	for qqid in changed_qqids:
+		invalidate_user(qqid)
+	invalidate_membership(group_id)
 
 	# refresh member list
-	self.get_member_list(group_id, nocache = True)
+	self.get_member_list.invalidate(group_id)
+	self._forget_group_nicknames(group_id)
+	_logger.info('群{}成员同步完成 新增{} 修改{} 未变{}'.format(
+		group_id, counts['inserted'], counts['updated'], counts['unchanged']))
+	return counts
+
+#写入群成员列表与数据库的差异（数据库线程）
+def _apply_member_list(group_id, wanted) -> Tuple[Dict[str, int], List[QQid]]:
+	"""
+	Args:
+		wanted: {qq号: (名字, 权限), }
+	Returns:
+		(各类人数, 修改过的用户)
+	"""
+	qqids = list(wanted.keys())
+
+	users = {}
+	memberships = {}
+	for chunk in peewee.chunked(qqids, 500):
+		for user in User.select().where(User.qqid.in_(chunk)):
+			users[user.qqid] = user
+		for qqid, role in Clan_member.select(Clan_member.qqid, Clan_member.role).where(
+			Clan_member.group_id == group_id,
+			Clan_member.qqid.in_(chunk),
+		).tuples():
+			memberships[qqid] = role
+
+	new_users = []
+	changed_users = []
+	new_memberships = []
+	changed_roles = {}	# {role: [qqid, ]}
+	counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+	for qqid, (nickname, role) in wanted.items():
+		user = users.get(qqid)
+		inserted = updated = False
+		if user is None:
+			new_users.append({
+				'qqid': qqid,
+				'nickname': nickname,
+				'clan_group_id': group_id,
+				'authority_group': role,
+			})
+			authority_group = role
+			inserted = True
+		else:
+			authority_group = role if user.authority_group >= 10 else user.authority_group
+			if (user.nickname, user.clan_group_id, user.authority_group) != (nickname, group_id, authority_group):
+				user.nickname = nickname
+				user.clan_group_id = group_id
+				user.authority_group = authority_group
+				changed_users.append(user)
+				updated = True
+
+		if qqid not in memberships:
+			new_memberships.append({
+				'group_id': group_id,
+				'qqid': qqid,
+				'role': authority_group if authority_group >= 10 else 100,
+			})
+			inserted = True
+		elif authority_group >= 10 and memberships[qqid] != authority_group:
+			changed_roles.setdefault(authority_group, []).append(qqid)
+			updated = True
+
+		if inserted: counts['inserted'] += 1
+		elif updated: counts['updated'] += 1
+		else: counts['unchanged'] += 1
+
+	with User._meta.database.atomic():
+		for rows in peewee.chunked(new_users, 100):
+			User.insert_many(rows).on_conflict_ignore().execute()
+		if changed_users:
+			User.bulk_update(changed_users,
+				fields = [User.nickname, User.clan_group_id, User.authority_group],
+				batch_size = 100)
+		for rows in peewee.chunked(new_memberships, 100):
+			Clan_member.insert_many(rows).on_conflict_ignore().execute()
+		for role, role_qqids in changed_roles.items():
+			for chunk in peewee.chunked(role_qqids, 500):
+				Clan_member.update({Clan_member.role: role}).where(
+					Clan_member.group_id == group_id,
+					Clan_member.qqid.in_(chunk),
+				).execute()
+	return counts, [user.qqid for user in changed_users]
+
+#更新所有公会的群成员
+async def _update_all_groups_members_async(self):
+	"""
+	并发同步所有公会的群成员，并发数由member_sync_concurrency限制
+
+	定时任务调用，出错时只记录日志，不在群里提示；跳过机器人已经不在的群
+	"""
+	try: joined = {g['group_id'] for g in await self.api.get_group_list()}
+	except Exception as e:
+		_logger.exception('获取群列表错误，跳过群成员同步：' + str(e))
+		return
+
+	semaphore = asyncio.Semaphore(self.setting.get('member_sync_concurrency', 4))
+
+	async def sync(group_id):
+		async with semaphore:
+			try:
+				with ybdata.group_scope(group_id):
+					return await self._update_all_group_members_async(group_id, quiet = True)
+			except Exception as e: _logger.exception(e)
+
+	group_ids = []
+	for _ in ybdata.each_database():
+		group_ids.extend(g.group_id for g in Clan_group.select(Clan_group.group_id).where(
+			Clan_group.deleted == False,
+		))
+	left = [group_id for group_id in group_ids if group_id not in joined]
+	if left: _logger.info('机器人不在这些群中，跳过群成员同步：{}'.format(left))
+	await asyncio.gather(*(sync(group_id) for group_id in group_ids if group_id in joined))
 
 #更新成员名字
 async def _update_user_nickname_async(self, qqid, group_id = None):
 	try:
-		user = User.get_or_create(qqid=qqid)[0]
 		if group_id is None:
 			userinfo = await self.api.get_stranger_info(user_id=qqid)
-			user.nickname = userinfo['nickname']
+			nickname = userinfo['nickname']
 		else:
 			userinfo = await self.api.get_group_member_info(group_id=group_id, user_id=qqid)
-			user.nickname = userinfo['card'] or userinfo['nickname']
-		user.save()
+			nickname = userinfo['card'] or userinfo['nickname']
+		def save_nickname():
+			user = User.get_or_create(qqid=qqid)[0]
+			user.nickname = nickname
+			user.save()
+		await run_in_db(save_nickname)
 
 		# refresh
-		if user.nickname is not None : self._get_nickname_by_qqid(qqid, nocache=True)
+		if nickname is not None : self._set_nickname_cache(qqid, nickname)
 	except Exception as e : _logger.exception(e)
 
 #获取boss当前数据
@@ -155,7 +370,84 @@ def _boss_data_dict(self, group: Clan_group) -> Dict[str, Any]:
 
 
 
+#出刀记录变化后清除报告缓存
+def _invalidate_report_cache(self, group_id: Groupid):
+	# 提交前清除的话，只读线程可能把提交前的数据重新放进缓存
+	def invalidate():
+		self.get_report.invalidate(group_id)
+		self.get_battle_member_list.invalidate(group_id)
+		self.get_member_history.invalidate(group_id)
+	_after_commit(('report', group_id), invalidate)
+
+#获取公会
+def _get_group(self, group_id: Groupid) -> Optional[Clan_group]:
+	"""
+	修改操作中同一个公会只查询一次，修改后不需要save，由_mutation统一保存
+	"""
+	groups = getattr(_mutation_state, 'groups', None)
+	if groups is None:
+		return Clan_group.get_or_none(group_id=group_id)
+	group_id = int(group_id)
+	if group_id not in groups:
+		groups[group_id] = Clan_group.get_or_none(group_id=group_id)
+	return groups[group_id]
+
+#通知web面板boss状态变化
+def _notify_boss_status(self, group_id: Groupid, group: Clan_group, msg):
+	def notify():
+		status = (self._boss_data_dict(group), group.boss_cycle, msg)
+		# 在数据库线程中提交时，future要在事件循环中唤醒
+		call_in_loop(self._set_boss_status, group_id, status)
+		# 多进程部署时其他进程的长轮询
+		cluster.publish('boss_status', group_id=group_id, status=status)
+	_after_commit(('boss_status', group_id), notify)
+
+#唤醒等待boss状态的长轮询
+def _set_boss_status(self, group_id: Groupid, status):
+	future = self._boss_status.get(group_id)
+	if future is None:
+		# 未激活的公会没有网页在等待
+		return
+	if not future.done():
+		future.set_result(tuple(status))
+	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+
+#激活公会
+def _activate_group(self, group_id: Groupid) -> asyncio.Future:
+	"""
+	网页第一次等待公会的boss状态时创建future，
+	超过group_idle_minutes分钟没有访问的公会移出内存
+
+	Returns:
+		boss状态变化时完成的future
+	"""
+	now = time.monotonic()
+	self._group_access[group_id] = now
+	if now - self._last_eviction > EVICT_INTERVAL:
+		self._last_eviction = now
+		self._evict_idle_groups(now)
+	future = self._boss_status.get(group_id)
+	if future is None:
+		future = self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+		ACTIVE_GROUPS.set(len(self._boss_status))
+	return future
+
+#移出闲置公会
+def _evict_idle_groups(self, now: float):
+	idle = self.setting.get('group_idle_minutes', 60) * 60
+	if idle <= 0: return
+	for group_id, last_access in list(self._group_access.items()):
+		if last_access > now - idle: continue
+		del self._group_access[group_id]
+		# 正在等待的长轮询持有自己的引用，不受影响
+		self._boss_status.pop(group_id, None)
+		invalidate_local('nickname_group', (group_id,))
+	ACTIVE_GROUPS.set(len(self._boss_status))
+
+
+
 #创建公会
+@_mutation
 def create_group(self, group_id: Groupid, game_server, group_name=None) -> None:
 	"""
 	Args:
@@ -163,7 +455,7 @@ def create_group(self, group_id: Groupid, game_server, group_name=None) -> None:
 		group_name: QQ群名，用作公会名
 		game_server: 服务器名("jp" "tw" "cn" "kr")
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None:
 		now_cycle_boss_health = {}
 		level = self._level_by_cycle(1, game_server)
@@ -183,12 +475,11 @@ def create_group(self, group_id: Groupid, game_server, group_name=None) -> None:
 	elif group.deleted:
 		group.deleted = False
 		group.game_server = game_server
-		group.save()
 	else : raise GroupError('群已经存在')
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+	_after_commit(('auth_group', group_id), lambda: invalidate_group(group_id))
 
 	# refresh group list
-	asyncio.ensure_future(self._update_group_list_async())
+	spawn(self._update_group_list_async())
 
 #加入公会
 async def bind_group(self, group_id:Groupid, qqid:QQid, nickname:str):
@@ -198,29 +489,38 @@ async def bind_group(self, group_id:Groupid, qqid:QQid, nickname:str):
 		qqid: 加入公会的成员QQ号
 		nickname: 用来显示的名字
 	"""
-	user = User.get_or_create(qqid=qqid)[0]
-	user.clan_group_id = group_id
-	user.nickname = nickname
-	user.deleted = False
 	try:
 		groupmember = await self.api.get_group_member_info(group_id = group_id, user_id = qqid)
 		role = 100 if groupmember['role'] == 'member' else 10
 	except Exception as e:
 		_logger.exception(e)
 		role = 100
-	membership = Clan_member.get_or_create(
-		group_id = group_id,
-		qqid = qqid,
-		defaults = {'role': role})[0]
-	user.save()
+	# 事务中不能await，查询完权限再写入
+	def save_membership():
+		with User._meta.database.atomic():
+			user = User.get_or_create(qqid=qqid)[0]
+			user.clan_group_id = group_id
+			user.nickname = nickname
+			user.deleted = False
+			membership = Clan_member.get_or_create(
+				group_id = group_id,
+				qqid = qqid,
+				defaults = {'role': role})[0]
+			user.save()
+		return membership
+	membership = await run_in_db(save_membership)
 
 	# refresh
-	self.get_member_list(group_id, nocache=True)
+	self.get_member_list.invalidate(group_id)
+	self._forget_group_nicknames(group_id)
+	invalidate_user(qqid)
+	invalidate_membership(group_id, qqid)
 	if nickname is None:
 		asyncio.ensure_future(self._update_user_nickname_async(qqid = qqid, group_id = group_id))
 	return membership
 
 #删除成员
+@_mutation
 def drop_member(self, group_id: Groupid, member_list: List[QQid]):
 	"""
 	删除公会里的成员（一般在面板里操作，可同时删除多个）
@@ -235,17 +535,18 @@ def drop_member(self, group_id: Groupid, member_list: List[QQid]):
 		Clan_member.qqid.in_(member_list)
 	).execute()
 
-	for user_id in member_list:
-		user = User.get_or_none(qqid=user_id)
-		if user is not None:
-			user.clan_group_id = None
-			user.save()
+	User.update(clan_group_id=None).where(User.qqid.in_(member_list)).execute()
 
 	# refresh member list
-	self.get_member_list(group_id, nocache=True)
+	def refresh():
+		self.get_member_list.invalidate(group_id)
+		self._forget_group_nicknames(group_id)
+		invalidate_membership(group_id)
+	_after_commit(('members', group_id), refresh)
 	return delete_count
 
 #修改boss状态
+@_mutation
 def modify(self, group_id: Groupid, cycle=None, bossData=None):
 	"""
 	在调用此函数之前，要先检查操作者权限。
@@ -258,7 +559,7 @@ def modify(self, group_id: Groupid, cycle=None, bossData=None):
 	if cycle and cycle < 1:
 		raise InputError('周目数不能为负')
 
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 
 	next_cycle_level = self._level_by_cycle(cycle and cycle+1 or group.boss_cycle+1, group.game_server)
@@ -278,14 +579,12 @@ def modify(self, group_id: Groupid, cycle=None, bossData=None):
 	group.next_cycle_boss_health = json.dumps(next_health)
 	group.boss_cycle = cycle
 
-	group.save()
-
 	msg = 'boss状态已修改'
-	self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, msg))
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+	self._notify_boss_status(group_id, group, msg)
 	return msg
 
 #修改服务器
+@_mutation
 def change_game_server(self, group_id: Groupid, game_server):
 	"""
 	在调用此函数之前，要先检查操作者权限。
@@ -296,10 +595,9 @@ def change_game_server(self, group_id: Groupid, game_server):
 	"""
 	if game_server not in ("jp", "tw", "cn", "kr"):
 		raise InputError(f'不存在{game_server}游戏服务器')
-	group = Clan_group.get_or_none(group_id=group_id)
+	group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	group.game_server = game_server
-	group.save()
 
 #获取当期会战数据记录档案的编号
 def get_data_slot_record_count(self, group_id: Groupid):
@@ -319,6 +617,10 @@ def get_data_slot_record_count(self, group_id: Groupid):
 		peewee.fn.COUNT(Clan_challenge.cid).alias('record_count'),
 	).where(Clan_challenge.gid == group_id).group_by(Clan_challenge.bid,):
 		counts.append({'battle_id': c.bid, 'record_count': c.record_count})
+	# 冷存档的记录数在登记时已经统计好
+	for battle_id, record_count in battle_archive.archived_battles(group_id).items():
+		counts.append({'battle_id': battle_id, 'record_count': record_count})
+	counts.sort(key=lambda c: c['battle_id'])
 	return counts
 
 #清空会战数据记录档案
@@ -332,7 +634,14 @@ def clear_data_slot(self, group_id: Groupid, battle_id: Optional[int] = None):
 		group_id: QQ群号
 		battle_id: 选择的档案号
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	battle_id = _clear_data_slot(self, group_id, battle_id)
+	# 冷存档要ATTACH，在事务提交后删除
+	battle_archive.drop_battle(group_id, battle_id)
+	_logger.info(f'群{group_id}的{battle_id}号存档已清空')
+
+@_mutation
+def _clear_data_slot(self, group_id: Groupid, battle_id: Optional[int]) -> int:
+	group:Clan_group = self._get_group(group_id)
 	if group is None:
 		raise GroupNotExist
 
@@ -352,10 +661,14 @@ def clear_data_slot(self, group_id: Groupid, battle_id: Optional[int] = None):
 	group.subscribe_list = None
 	group.challenging_start_time = 0
 
-	group.save()
 	if battle_id is None: battle_id = group.battle_id
 	Clan_challenge.delete().where(Clan_challenge.gid == group_id, Clan_challenge.bid == battle_id).execute()
-	_logger.info(f'群{group_id}的{battle_id}号存档已清空')
+	Clan_daily.delete().where(Clan_daily.gid == group_id, Clan_daily.bid == battle_id).execute()
+	Clan_member_history.delete().where(
+		Clan_member_history.gid == group_id, Clan_member_history.bid == battle_id).execute()
+	self._invalidate_report_cache(group_id)
+	_after_commit(('daily', group_id), lambda: self.get_daily_summary.invalidate(group_id))
+	return battle_id
 
 #切换会战数据记录档案
 def switch_data_slot(self, group_id: Groupid, battle_id: int):
@@ -368,7 +681,14 @@ def switch_data_slot(self, group_id: Groupid, battle_id: int):
 		group_id: QQ群号
 		battle_id：选择的档案号
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	# 冷存档要ATTACH，在事务开始前还原
+	battle_archive.restore_battle(group_id, battle_id)
+	_switch_data_slot(self, group_id, battle_id)
+	_logger.info(f'群{group_id}切换至{battle_id}号存档')
+
+@_mutation
+def _switch_data_slot(self, group_id: Groupid, battle_id: int):
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	backups:Clan_group_backups = Clan_group_backups.get_or_create(
 		group_id = group_id, 
@@ -426,8 +746,7 @@ def switch_data_slot(self, group_id: Groupid, battle_id: int):
 		group.subscribe_list = None
 		group.challenging_start_time = 0
 
-	group.save()
-	_logger.info(f'群{group_id}切换至{battle_id}号存档')
+	self._invalidate_report_cache(group_id)
 
 #向指定个人私聊发送提醒
 async def send_private_remind(self, member_list:List[QQid] = None, member_id:QQid = None, content: str = None):
@@ -463,20 +782,20 @@ def send_remind(self,
 	"""
 	sender_name = self._get_nickname_by_qqid(sender)
 	if send_private_msg:
-		asyncio.ensure_future(self.send_private_remind(
+		spawn(self.send_private_remind(
 			member_list=member_list,
 			content=f'{sender_name}提醒您及时完成今日出刀',
 		))
 	else:
 		message = ' '.join(atqq(qqid) for qqid in member_list)
-		asyncio.ensure_future(self.api.send_group_msg(
+		spawn(self.api.send_group_msg(
 			group_id=group_id,
 			message=message+f'\n=======\n{sender_name}提醒您及时完成今日出刀',
 		))
 
 #发送代刀提醒给被代刀的玩家
 def behelf_remind(self, member_id, msg):
-	asyncio.ensure_future(self.send_private_remind(member_id = member_id,content = msg))
+	spawn(self.send_private_remind(member_id = member_id,content = msg))
 #当前的boss状态
 def boss_status_summary(self, group_id:Groupid) -> str:
 	boss_summary = self.challenger_info(group_id)
@@ -485,6 +804,7 @@ def boss_status_summary(self, group_id:Groupid) -> str:
 
 
 #报刀
+@_mutation
 def challenge(self,
 				group_id: Groupid,
 				qqid: QQid,
@@ -534,7 +854,7 @@ def challenge(self,
 		else:
 			self.apply_for_challenge(is_continue, group_id, qqid, boss_num, behalf, False)
 
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 
 	boss_num = str(boss_num)
@@ -607,6 +927,11 @@ def challenge(self,
 		is_continue=is_continue,
 		behalf=behalf,
 	)
+	_record_history(challenge, 1)
+	if d < pcr_today(group.game_server):
+		# 补报到昨日，该日期已经汇总过
+		_finalize_group_day(group_id, d)
+		_after_commit(('daily', group_id), lambda: self.get_daily_summary.invalidate(group_id))
 
 	if defeat:
 		all_clear = 0
@@ -624,8 +949,7 @@ def challenge(self,
 
 	group.now_cycle_boss_health = json.dumps(now_cycle_boss_health)
 	group.next_cycle_boss_health = json.dumps(next_cycle_boss_health)
-	challenge.save()
-	group.save()
+	self._invalidate_report_cache(group_id)
 
 	# 取消申请出刀
 	if defeat: 
@@ -645,15 +969,14 @@ def challenge(self,
 	else:
 		msg = '{}{}对{}号boss造成了{:,}点伤害\n（今日第{}刀，{}）\n'.format(
 			nik, behalf_nik, boss_num, challenge_damage, finished+1, '剩余刀' if is_continue else '完整刀')
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
 	msg += '\n'.join(self.challenger_info_small(group, boss_num))
 
-	self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, msg))
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+	self._notify_boss_status(group_id, group, msg)
 
 	return msg
 
 #撤销上一刀的伤害
+@_mutation
 def undo(self, group_id: Groupid, qqid: QQid) :
 	"""
 	删除上一刀的记录
@@ -662,7 +985,7 @@ def undo(self, group_id: Groupid, qqid: QQid) :
 		group_id: QQ群号
 		qqid: 发起撤销请求的成员QQ号
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	user:User = User.get_or_create(qqid = qqid, defaults = {'clan_group_id': group_id})[0]
 	last_challenge:Clan_challenge = self._get_group_previous_challenge(group)
@@ -691,17 +1014,22 @@ def undo(self, group_id: Groupid, qqid: QQid) :
 		if real_cycle_boss_health[last_num] > full_health: real_cycle_boss_health[last_num] = full_health
 
 	last_challenge.delete_instance()
+	_record_history(last_challenge, -1)
 	group.now_cycle_boss_health = json.dumps(now_cycle_boss_health)
 	group.next_cycle_boss_health = json.dumps(next_cycle_boss_health)
-	group.save()
+	self._invalidate_report_cache(group_id)
+	if last_challenge.challenge_pcrdate < pcr_today(group.game_server):
+		# 撤销的一刀所在的日期已经汇总过
+		_finalize_group_day(group_id, last_challenge.challenge_pcrdate)
+		_after_commit(('daily', group_id), lambda: self.get_daily_summary.invalidate(group_id))
 
 	nik = self._get_nickname_by_qqid(last_challenge.qqid)
 	msg = f'{nik}的出刀记录已被撤销'
-	self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, msg))
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+	self._notify_boss_status(group_id, group, msg)
 	return msg
 
 #预约x/预约表
+@_mutation
 def subscribe(self, group_id:Groupid, qqid:QQid, msg):
 	"""
 	预约某个boss或查看所有已预约的玩家
@@ -709,13 +1037,14 @@ def subscribe(self, group_id:Groupid, qqid:QQid, msg):
 	Args:
 		msg: 第几个王 or '表'
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	if not msg: GroupError('您预约了一个空气')
 	if msg == '表':
 		back_msg = []
 		if group.subscribe_list is None:
 			raise GroupError('目前没有人预约任意一个boss')
+		self._preload_group_nicknames(group_id)
 		subscribe_list = safe_load_json(group.subscribe_list, {})
 		for boss_num in range(5):
 			real_num = str(boss_num + 1)
@@ -737,22 +1066,22 @@ def subscribe(self, group_id:Groupid, qqid:QQid, msg):
 		else:
 			subscribe_list[boss_num] = [qqid]
 		group.subscribe_list = json.dumps(subscribe_list)
-		group.save()
 		return f'预约{boss_num}王成功！下个{boss_num}王出现时会at提醒。'
 
 #预约提醒
 def subscribe_remind(self, group_id:Groupid, boss_num):
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	subscribe_list = safe_load_json(group.subscribe_list, {})
 	if len(subscribe_list) == 0 or boss_num not in subscribe_list: return
 	qqid_list = subscribe_list[boss_num]
-	asyncio.ensure_future(self.api.send_group_msg(
+	spawn(self.api.send_group_msg(
 		group_id = group_id,
 		message = f'船新的{boss_num}王来惹~ _(:з)∠)_\n' + ' '.join(atqq(qqid) for qqid in qqid_list),
 	))
 	subscribe_cancel(self, group_id, boss_num)
 
 #取消预约
+@_mutation
 def subscribe_cancel(self, group_id:Groupid, boss_num, qqid = None):
 	'''
 	取消预约特定boss
@@ -761,7 +1090,7 @@ def subscribe_cancel(self, group_id:Groupid, boss_num, qqid = None):
 		boss_num: 几王
 		qqid: 不填为删除特定boss的整个预约记录，填则删除特定用户的单个预约记录
 	'''
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	subscribe_list = safe_load_json(group.subscribe_list, {})
 	if not boss_num: GroupError('您取消了个寂寞')
 	if len(subscribe_list) == 0 or boss_num not in subscribe_list:
@@ -775,7 +1104,6 @@ def subscribe_cancel(self, group_id:Groupid, boss_num, qqid = None):
 		if len(subscribe_list[boss_num]) == 0:
 			del subscribe_list[boss_num]
 	group.subscribe_list = json.dumps(subscribe_list)
-	group.save()
 	return '取消成功~'
 
 #获取预约列表
@@ -786,7 +1114,7 @@ def get_subscribe_list(self, group_id: Groupid):
 	Args:
 		group_id: QQ群号
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	subscribe_list = safe_load_json(group.subscribe_list, {})
 	back_info = []
 	for boss_num, qqid_list in subscribe_list.items():
@@ -798,6 +1126,7 @@ def get_subscribe_list(self, group_id: Groupid):
 	return back_info
 
 #挂树
+@_mutation
 def put_on_the_tree(self, group_id: Groupid, qqid: QQid, message=None):
 	"""
 	放在树上
@@ -807,7 +1136,7 @@ def put_on_the_tree(self, group_id: Groupid, qqid: QQid, message=None):
 		qqid: 挂树的霉b/菜b的QQ号
 		message: 留言
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	user = User.get_or_none(qqid=qqid)
 	if user is None: raise GroupError('请先加入公会')
@@ -824,12 +1153,11 @@ def put_on_the_tree(self, group_id: Groupid, qqid: QQid, message=None):
 	challenging_member_list[boss_num][str(qqid)]['tree'] = True
 	challenging_member_list[boss_num][str(qqid)]['msg'] = message
 	group.challenging_member_list = json.dumps(challenging_member_list)
-	group.save()
-	self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, '挂树惹~ (っ °Д °;)っ'))
-	self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+	self._notify_boss_status(group_id, group, '挂树惹~ (っ °Д °;)っ')
 	return '挂树惹~ (っ °Д °;)っ'
 
 #下树
+@_mutation
 def take_it_of_the_tree(self, group_id: Groupid, qqid: QQid, boss_num=0, take_it_type = 0, send_web = True):
 	"""
 	把ta从树上取下来
@@ -841,7 +1169,7 @@ def take_it_of_the_tree(self, group_id: Groupid, qqid: QQid, boss_num=0, take_it
 		take_it_type: 0下一个人 1下一棵树
 		send_web:是否更新web面板数据
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	
 	user = User.get_or_none(qqid=qqid)
@@ -857,24 +1185,22 @@ def take_it_of_the_tree(self, group_id: Groupid, qqid: QQid, boss_num=0, take_it
 		challenging_member_list[boss_num][qqid]['tree'] = False
 		challenging_member_list[boss_num][qqid]['msg'] = None
 		group.challenging_member_list = json.dumps(challenging_member_list)
-		group.save()
 	elif take_it_type == 1:
 		notice = []
 		for challenger, info in challenging_member_list[boss_num].items():
 			if info['tree']: notice.append(atqq(challenger))
 		if len(notice) > 0:
-			asyncio.ensure_future(self.api.send_group_msg(
+			spawn(self.api.send_group_msg(
 				group_id = group_id,
 				message = '可以下树惹~ _(:з)∠)_\n'+'\n'.join(notice),
 			))
 	if send_web:
-		self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, '下树惹~ _(:з)∠)_'))
-		self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+		self._notify_boss_status(group_id, group, '下树惹~ _(:з)∠)_')
 	return '下树惹~ _(:з)∠)_'
 
 #检查能否继续挑战下个boss
 def check_next_boss(self, group_id:Groupid, boss_num):
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	boss_cycle = group.boss_cycle
 	now_cycle_boss_health = safe_load_json(group.now_cycle_boss_health, {})
 	next_cycle_boss_health = safe_load_json(group.next_cycle_boss_health, {})
@@ -885,6 +1211,7 @@ def check_next_boss(self, group_id:Groupid, boss_num):
 	return True
 
 #申请出刀
+@_mutation
 def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num, behalfed = None, send_web=True) :
 	"""
 	Args:
@@ -894,7 +1221,7 @@ def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num
 		boss_num: 几王
 		behalfed: 被代刀人的qq号
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None:raise GroupNotExist
 
 	behalf = None
@@ -911,7 +1238,7 @@ def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num
 		and now_cycle_boss_health[boss_num] == 0):
 		raise GroupError('只能挑战2个周目内且不跨阶段的同个boss，请等待该周目的boss全部击杀完毕')
 
-	d, _ = pcr_datetime(area = group.game_server)
+	d = pcr_today(group.game_server)
 	challenges = Clan_challenge.select().where(
 		Clan_challenge.gid == group_id,
 		Clan_challenge.qqid == challenger,
@@ -946,16 +1273,15 @@ def apply_for_challenge(self, is_continue, group_id:Groupid, qqid:QQid, boss_num
 		'msg' : None,
 	}
 	group.challenging_member_list = json.dumps(challenging_list)
-	group.save()
 
 	self.challenger_info_small(group, boss_num, info)
 	info = '\n'.join(info)
 	if send_web:
-		self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, f'申请挑战{boss_num}王成功'))
-		self._boss_status[group_id] = asyncio.get_event_loop().create_future()
+		self._notify_boss_status(group_id, group, f'申请挑战{boss_num}王成功')
 	return info
 
 #取消申请出刀
+@_mutation
 def cancel_blade(self, group_id: Groupid, qqid: QQid, boss_num=0, cancel_type=1, send_web=True):
 	"""
 	Args:
@@ -964,7 +1290,7 @@ def cancel_blade(self, group_id: Groupid, qqid: QQid, boss_num=0, cancel_type=1,
 		cancel_type: 取消类型：0取消全部 1取消特定qq号 2取消特定boss
 		send_web:是否更新web面板数据
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	ret = 0
 	if group.challenging_member_list == None:
@@ -988,9 +1314,7 @@ def cancel_blade(self, group_id: Groupid, qqid: QQid, boss_num=0, cancel_type=1,
 		group.challenging_member_list = json.dumps(challenging_list)
 
 	if send_web:
-		self._boss_status[group_id].set_result((self._boss_data_dict(group), group.boss_cycle, ret))
-		self._boss_status[group_id] = asyncio.get_event_loop().create_future()
-	group.save()
+		self._notify_boss_status(group_id, group, ret)
 	return ret
 
 #检查是否已申请出刀
@@ -1001,7 +1325,7 @@ def check_blade(self, group_id: Groupid, qqid: QQid):
 		group_id: QQ群号
 		qqid: 需要进行操作的QQ号
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	challenging_list = safe_load_json(group.challenging_member_list, {})
 	for _, infos in challenging_list.items():
@@ -1017,7 +1341,7 @@ def get_in_boss_num(self, group_id, qqid):
 		group: 公会群对象
 		qqid: 需要进行操作的QQ号
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	challenging_list = safe_load_json(group.challenging_member_list, {})
 	for boss_num, infos in challenging_list.items():
 		for challenger in infos.keys():
@@ -1026,6 +1350,7 @@ def get_in_boss_num(self, group_id, qqid):
 
 
 #SL
+@_mutation
 def save_slot(self, group_id: Groupid, qqid: QQid,
 				only_check: bool = False,
 				clean_flag: bool = False):
@@ -1039,11 +1364,11 @@ def save_slot(self, group_id: Groupid, qqid: QQid,
 		only_check: 是否只查询
 		clean_flag: 是否取消sl
 	"""
-	group = Clan_group.get_or_none(group_id=group_id)
+	group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	membership = Clan_member.get_or_none(group_id = group_id, qqid = qqid)
 	if membership is None: raise UserNotInGroup
-	today, _ = pcr_datetime(group.game_server)
+	today = pcr_today(group.game_server)
 	if clean_flag:
 		if membership.last_save_slot != today: raise UserError('您今天还没有SL过')
 		membership.last_save_slot = 0
@@ -1057,10 +1382,11 @@ def save_slot(self, group_id: Groupid, qqid: QQid,
 	membership.save()
 
 	# refresh
-	self.get_member_list(group_id, nocache = True)
+	_after_commit(('members', group_id), lambda: self.get_member_list.invalidate(group_id))
 	return 'SL用掉惹 Σ(っ °Д °;)っ'
 
 #记录伤害/清空伤害
+@_mutation
 def report_hurt(self, s, hurt, group_id:Groupid, qqid:QQid, clean_type = 0):
 	"""
 	记录/清空出刀暂停后，成员报的伤害
@@ -1072,7 +1398,7 @@ def report_hurt(self, s, hurt, group_id:Groupid, qqid:QQid, clean_type = 0):
 		qqid: 需要进行操作的QQ号
 		clean_type: 清理类型 0不清理(记录伤害) 1清特定玩家
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None: raise GroupNotExist
 	boss_num = self.get_in_boss_num(group_id, qqid)
 	if clean_type != 2 and not boss_num:
@@ -1095,7 +1421,6 @@ def report_hurt(self, s, hurt, group_id:Groupid, qqid:QQid, clean_type = 0):
 			ret_msg = '取消成功~'
 
 	group.challenging_member_list = json.dumps(challenging_member_list)
-	group.save()
 	return ret_msg
 
 #单个boss信息
@@ -1129,6 +1454,7 @@ def challenger_info_small(self, group:Clan_group, boss_num, msg:List = None):
 		msg.append(f'当前有{len(challenging_list)}人正在挑战这个boss')
 
 	if challenging_list:
+		self._preload_group_nicknames(group.group_id)
 		msg.append('--------------------')
 		for challenger, info in challenging_list.items():
 			temp_msg = f'— {self._get_nickname_by_qqid(int(challenger))}'
@@ -1148,13 +1474,18 @@ def challenger_info_small(self, group:Clan_group, boss_num, msg:List = None):
 
 #总出刀信息
 def challenger_info(self, group_id):
+	return self.challenger_info_picture(group_id).render()
+
+#总出刀信息（未生成图片）
+def challenger_info_picture(self, group_id) -> Picture:
 	"""
 	Args:
 		group: 公会信息对象
 	"""
-	group:Clan_group = Clan_group.get_or_none(group_id=group_id)
+	group:Clan_group = self._get_group(group_id)
 	if group is None : raise GroupNotExist
-	date, time = pcr_datetime(area = group.game_server)
+	self._preload_group_nicknames(group_id)
+	date = pcr_today(group.game_server)
 	challenges = Clan_challenge.select().where(
 					Clan_challenge.gid == group_id,
 					Clan_challenge.bid == group.battle_id,
@@ -1192,14 +1523,12 @@ def challenger_info(self, group_id):
 			str_list.insert((i+1)*20, '\n')
 			line += 1
 		msg[once] = ''.join(str_list)
-	back_msg = text_2_pic(self, '\n'.join(msg), 250, (len(msg)+line)*20 + 10, (255, 255, 255), "#000000", 15, (10, 5))
-	
-	return back_msg
+	return Picture(self, '\n'.join(msg), 250, (len(msg)+line)*20 + 10, (255, 255, 255), "#000000", 15, (10, 5))
 
 
 
 ##获取报告
-@timed_cached_func(max_len=64, max_age_seconds=10, ignore_self=True)
+@cached_func(64, ttl=10, ignore_self=True)
 def get_report(self,
 				group_id: Groupid,
 				battle_id: Union[str, int, None],
@@ -1217,26 +1546,29 @@ def get_report(self,
 	group = Clan_group.get_or_none(group_id=group_id)
 	if group is None: raise GroupNotExist
 	report = []
-	expressions = [
-		Clan_challenge.gid == group_id,
-	]
 	if battle_id is None:
 		battle_id = group.battle_id
-	if isinstance(battle_id, str):
-		if battle_id == 'all':
-			pass
-		else:
-			raise InputError(
-				f'unexceptd value "{battle_id}" for battle_id')
-	else:
-		expressions.append(Clan_challenge.bid == battle_id)
+	if isinstance(battle_id, str) and battle_id != 'all':
+		raise InputError(
+			f'unexceptd value "{battle_id}" for battle_id')
+	with battle_archive.challenge_sources(group_id, battle_id) as sources:
+		for model, expressions in sources:
+			report.extend(_query_report(model, group, battle_id, qqid, pcrdate, expressions))
+	return report
+
+def _query_report(model, group: Clan_group, battle_id, qqid, pcrdate, expressions):
+	# model为主库或冷存档中的出刀记录表
+	expressions.append(model.gid == group.group_id)
+	if battle_id != 'all':
+		expressions.append(model.bid == battle_id)
 	if qqid is not None:
-		expressions.append(Clan_challenge.qqid == qqid)
+		expressions.append(model.qqid == qqid)
 	if pcrdate is not None:
-		expressions.append(Clan_challenge.challenge_pcrdate == pcrdate)
-	for c in Clan_challenge.select().where(
+		expressions.append(model.challenge_pcrdate == pcrdate)
+	report = []
+	for c in model.select().where(
 		*expressions
-	):
+	).order_by(model.cid):
 		report.append({
 			'battle_id': c.bid,
 			'qqid': c.qqid,
@@ -1258,7 +1590,7 @@ def get_report(self,
 	return report
 
 #从会战记录里获取成员列表
-@timed_cached_func(max_len=64, max_age_seconds=10, ignore_self=True)
+@cached_func(64, ttl=10, ignore_self=True)
 def get_battle_member_list(self,
 							group_id: Groupid,
 							battle_id: Union[str, int, None],
@@ -1270,38 +1602,32 @@ def get_battle_member_list(self,
 	"""
 	group = Clan_group.get_or_none(group_id=group_id)
 	if group is None: raise GroupNotExist
-	expressions = [
-		Clan_challenge.gid == group_id,
-	]
 	if battle_id is None:
 		battle_id = group.battle_id
-	if isinstance(battle_id, str):
-		if battle_id == 'all':
-			pass
-		else:
-			raise InputError(
-				f'unexceptd value "{battle_id}" for battle_id')
-	else:
-		expressions.append(Clan_challenge.bid == battle_id)
-	member_list = []
-	for u in Clan_challenge.select(
-		Clan_challenge.qqid,
-		User.nickname,
-	).join(
-		User,
-		on=(Clan_challenge.qqid == User.qqid),
-		attr='user',
-	).where(
-		*expressions
-	).distinct():
-		member_list.append({
-			'qqid': u.qqid,
-			'nickname': u.user.nickname,
-		})
-	return member_list
+	if isinstance(battle_id, str) and battle_id != 'all':
+		raise InputError(
+			f'unexceptd value "{battle_id}" for battle_id')
+	members = {}
+	with battle_archive.challenge_sources(group_id, battle_id) as sources:
+		for model, expressions in sources:
+			expressions.append(model.gid == group_id)
+			if battle_id != 'all':
+				expressions.append(model.bid == battle_id)
+			for u in model.select(
+				model.qqid,
+				User.nickname,
+			).join(
+				User,
+				on=(model.qqid == User.qqid),
+				attr='user',
+			).where(
+				*expressions
+			).distinct():
+				members[u.qqid] = u.user.nickname
+	return [{'qqid': qqid, 'nickname': nickname} for qqid, nickname in members.items()]
 
 #获取并刷新成员列表
-@timed_cached_func(max_len=16, max_age_seconds=3600, ignore_self=True)
+@cached_func(16, ttl=3600, ignore_self=True)
 def get_member_list(self, group_id: Groupid) -> List[Dict[str, Any]]:
 	"""
 	获取并刷新成员列表
@@ -1327,6 +1653,22 @@ def get_member_list(self, group_id: Groupid) -> List[Dict[str, Any]]:
 		})
 	return member_list
 
+#网页调用的修改操作，在数据库线程中执行
+challenge_async = _mutation_async(challenge)
+undo_async = _mutation_async(undo)
+modify_async = _mutation_async(modify)
+drop_member_async = _mutation_async(drop_member)
+apply_for_challenge_async = _mutation_async(apply_for_challenge)
+cancel_blade_async = _mutation_async(cancel_blade)
+put_on_the_tree_async = _mutation_async(put_on_the_tree)
+take_it_of_the_tree_async = _mutation_async(take_it_of_the_tree)
+subscribe_async = _mutation_async(subscribe)
+subscribe_cancel_async = _mutation_async(subscribe_cancel)
+save_slot_async = _mutation_async(save_slot)
+clear_data_slot_async = _mutation_async(clear_data_slot)
+switch_data_slot_async = _mutation_async(switch_data_slot)
+
+
 
 
 
@@ -3,6 +3,7 @@ import string
 
 from ..exception import GroupNotExist
 from ...ybdata import Clan_challenge, Clan_group, Clan_member
+from .realize import Picture
 
 
 FILE_PATH = os.path.dirname(__file__)
@@ -13,6 +14,10 @@ def is_Chinese(word):
 
 #业绩表
 def score_table(self, group_id):
+	return self.score_table_picture(group_id).render()
+
+#业绩表（未生成图片）
+def score_table_picture(self, group_id) -> Picture:
 	'''
 	通过当期数据给成员打分
 	'''
@@ -68,9 +73,11 @@ def score_table(self, group_id):
 				member_score_dict[score_member]['small_end_blade'] += small_end_blade
 
 	member_score_dict = dict(sorted(member_score_dict.items(), key=lambda item: item[1]['score'], reverse=True))
+	self._preload_group_nicknames(group_id)
+	nicknames = self._get_nicknames_by_qqids(member_score_dict.keys())
 	back_msg = []
 	for qqid, info in member_score_dict.items():
-		name:string = list(self._get_nickname_by_qqid(qqid))
+		name:string = list(nicknames[int(qqid)])
 		while len(name) > 5:name.pop()
 		a = ''
 		if len(name) < 5:
@@ -85,4 +92,4 @@ def score_table(self, group_id):
 尾刀：{info['end_blade']}     \
 小尾刀：{info['small_end_blade']}")
 
-	return self.text_2_pic('\n'.join(back_msg), 450, len(back_msg)*20 + 10, (255, 255, 255), "#000000", 15, (10, 5))
+	return Picture(self, '\n'.join(back_msg), 450, len(back_msg)*20 + 10, (255, 255, 255), "#000000", 15, (10, 5))
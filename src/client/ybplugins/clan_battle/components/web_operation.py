@@ -1,32 +1,42 @@
 import asyncio
+import functools
 import logging
 from urllib.parse import urljoin
 
-import peewee
 from quart import Quart, jsonify, make_response, redirect, request, session, url_for
 
+from ... import cluster, log_util, metrics, ybdata
+from ...auth_util import (ROLE_ADMIN, ROLE_MEMBER, can_view_group, get_group_info,
+						get_login_user, get_membership, get_user, invalidate_group,
+						require_clan_member)
+from ...db_executor import run_in_db, run_in_reader
 from ...templating import render_template
-from ...ybdata import Clan_group, Clan_member, User
 from ..exception import ClanBattleError
-from ..util import pcr_datetime, atqq
+from ..util import pcr_datetime, pcr_today, atqq
 
 _logger = logging.getLogger(__name__)
 
+LONGPOLL_WAITERS = metrics.Gauge(
+	'yobot_longpoll_waiters', '正在等待boss状态更新的web长轮询数', ('group_id',))
+
 def register_routes(self, app: Quart):
+	@app.after_serving
+	async def stop_log_listener():
+		# 写完队列中的日志，工作进程退出时不会执行atexit
+		log_util.stop_queue(self._log_listener)
+
+	if ybdata.sharded():
+		@app.before_request
+		async def use_group_database():
+			# clan/<group_id>/下的页面使用该公会的数据库
+			ybdata.use_group((request.view_args or {}).get('group_id'))
+
 	@app.route(
 		urljoin(self.setting['public_basepath'], 'clan/<int:group_id>/'),
 		methods=['GET'])
+	@require_clan_member()
 	async def yobot_clan(group_id):
-		if 'yobot_user' not in session:
-			return redirect(url_for('yobot_login', callback=request.path))
-		user = User.get_by_id(session['yobot_user'])
-		group = Clan_group.get_or_none(group_id=group_id)
-		if group is None:
-			return await render_template('404.html', item='公会'), 404
-		is_member = Clan_member.get_or_none(
-			group_id=group_id, qqid=session['yobot_user'])
-		if (not is_member and user.authority_group >= 10):
-			return await render_template('clan/unauthorized.html')
+		is_member = get_membership(group_id, session['yobot_user']) is not None
 		return await render_template(
 			'clan/panel.html',
 			is_member=is_member,
@@ -36,17 +46,8 @@ def register_routes(self, app: Quart):
 		urljoin(self.setting['public_basepath'],
 				'clan/<int:group_id>/subscribers/'),
 		methods=['GET'])
+	@require_clan_member()
 	async def yobot_clan_subscribers(group_id):
-		if 'yobot_user' not in session:
-			return redirect(url_for('yobot_login', callback=request.path))
-		user = User.get_by_id(session['yobot_user'])
-		group = Clan_group.get_or_none(group_id=group_id)
-		if group is None:
-			return await render_template('404.html', item='公会'), 404
-		is_member = Clan_member.get_or_none(
-			group_id=group_id, qqid=session['yobot_user'])
-		if (not is_member and user.authority_group >= 10):
-			return await render_template('clan/unauthorized.html')
 		return await render_template(
 			'clan/subscribers.html',
 		)
@@ -56,14 +57,14 @@ def register_routes(self, app: Quart):
 				'clan/<int:group_id>/api/'),
 		methods=['POST'])
 	async def yobot_clan_api(group_id):
-		group = Clan_group.get_or_none(group_id=group_id)
-		if group is None:
+		group_info = get_group_info(group_id)
+		if group_info is None:
 			return jsonify(
 				code=20,
 				message='Group not exists',
 			)
 		if 'yobot_user' not in session:
-			if not(group.privacy & 0x1):
+			if not(group_info.privacy & 0x1):
 				return jsonify(
 					code=10,
 					message='Not logged in',
@@ -71,10 +72,9 @@ def register_routes(self, app: Quart):
 			user_id = 0
 		else:
 			user_id = session['yobot_user']
-			user = User.get_by_id(user_id)
-			is_member = Clan_member.get_or_none(
-				group_id=group_id, qqid=user_id)
-			if (not is_member and user.authority_group >= 10):
+			user = get_user(user_id)
+			is_member = get_membership(group_id, user_id) is not None
+			if (not is_member and user.authority_group >= ROLE_ADMIN):
 				return jsonify(
 					code=11,
 					message='Insufficient authority',
@@ -99,10 +99,36 @@ def register_routes(self, app: Quart):
 						code=10,
 						message='Not logged in',
 					)
+			if action == 'update_boss':
+				# 长轮询不需要读取数据库
+				boss_status = self._activate_group(group_id)
+				try:
+					with LONGPOLL_WAITERS.track_inprogress(group_id=group_id):
+						bossData, base_cycle, notice = await asyncio.wait_for(
+							asyncio.shield(boss_status),
+							timeout=30,
+						)
+					return jsonify(
+						code = 0,
+						bossData = bossData,
+						base_cycle = base_cycle,
+						notice = notice,
+					)
+				except asyncio.TimeoutError:
+					return jsonify(
+						code=1,
+						message='not changed',
+					)
+			group = await self.get_group_async(group_id)
+			if group is None:
+				return jsonify(
+					code=20,
+					message='Group not exists',
+				)
 			if action == 'get_member_list':
 				return jsonify(
 					code=0,
-					members=self.get_member_list(group_id),
+					members=await self.get_member_list_async(group_id),
 				)
 			elif action == 'get_data':
 				return jsonify(
@@ -116,7 +142,7 @@ def register_routes(self, app: Quart):
 					bossData=self._boss_data_dict(group),
 					base_cycle = group.boss_cycle,
 					selfData={
-						'is_admin': (is_member and user.authority_group < 100),
+						'is_admin': (is_member and user.authority_group < ROLE_MEMBER),
 						'user_id': user_id,
 					}
 				)
@@ -127,8 +153,8 @@ def register_routes(self, app: Quart):
 					base_cycle = group.boss_cycle,
 				)
 			elif action == 'get_challenge':
-				d, _ = pcr_datetime(group.game_server)
-				report = self.get_report(
+				d = pcr_today(group.game_server)
+				report = await self.get_report_async(
 					group_id,
 					None,
 					None,
@@ -140,15 +166,14 @@ def register_routes(self, app: Quart):
 					today=d,
 				)
 			elif action == 'get_user_challenge':
-				report = self.get_report(
+				report = await self.get_report_async(
 					group_id,
 					None,
 					payload['qqid'],
 					None,
 				)
-				try:
-					visited_user = User.get_by_id(payload['qqid'])
-				except peewee.DoesNotExist:
+				visited_user = await self.get_user_async(payload['qqid'])
+				if visited_user is None:
 					return jsonify(code=20, message='user not found')
 				return jsonify(
 					code=0,
@@ -159,27 +184,30 @@ def register_routes(self, app: Quart):
 						'nickname': visited_user.nickname,
 					}
 				)
-			elif action == 'update_boss':
-				try:
-					bossData, base_cycle, notice = await asyncio.wait_for(
-						asyncio.shield(
-							self._boss_status[group_id]),
-							timeout=30
-						)
-					return jsonify(
-						code = 0,
-						bossData = bossData,
-						base_cycle = base_cycle,
-						notice = notice,
-					)
-				except asyncio.TimeoutError:
-					return jsonify(
-						code=1,
-						message='not changed',
-					)
+			elif action == 'get_daily_summary':
+				# 默认为前一天
+				pcrdate = payload.get('pcrdate')
+				if pcrdate is None:
+					pcrdate = pcr_today(group.game_server) - 1
+				summary = await self.get_daily_summary_async(group, int(pcrdate))
+				return jsonify(
+					code=0,
+					summary=summary,
+				)
+			elif action == 'get_history':
+				# 不填qqid时为全公会
+				qqid = payload.get('qqid')
+				history = await self.get_member_history_async(
+					group_id,
+					None if qqid is None else int(qqid),
+				)
+				return jsonify(
+					code=0,
+					history=history,
+				)
 			elif action == 'addrecord':
 				try:
-					status = self.challenge(group_id, user_id,
+					status = await self.challenge_async(group_id, user_id,
 					payload['defeat'],
 					payload['damage'],
 					payload['behalf'],
@@ -206,7 +234,7 @@ def register_routes(self, app: Quart):
 				)
 			elif action == 'undo':
 				try:
-					status = self.undo(group_id, user_id)
+					status = await self.undo_async(group_id, user_id)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(
 						user_id, group_id, action))
@@ -233,7 +261,7 @@ def register_routes(self, app: Quart):
 					behalf = payload['behalf']
 					boss_num = payload['boss_num']
 					if behalf == user_id: behalf = None
-					status = self.apply_for_challenge(is_continue, group_id, user_id, boss_num, behalf)
+					status = await self.apply_for_challenge_async(is_continue, group_id, user_id, boss_num, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(
@@ -255,7 +283,7 @@ def register_routes(self, app: Quart):
 			elif action == 'cancelapply':
 				try:
 					behalf = payload['behalf'] and int(payload['behalf']) or user_id
-					status = self.cancel_blade(group_id, behalf)
+					status = await self.cancel_blade_async(group_id, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code=10, message=str(e))
@@ -274,7 +302,7 @@ def register_routes(self, app: Quart):
 			elif action == 'put_on_the_tree':
 				try:
 					behalf = payload['behalf'] and int(payload['behalf']) or user_id
-					status = self.put_on_the_tree(group_id, behalf)
+					status = await self.put_on_the_tree_async(group_id, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code=10, message=str(e))
@@ -293,7 +321,7 @@ def register_routes(self, app: Quart):
 			elif action == 'take_it_of_the_tree':
 				try:
 					behalf = payload['behalf'] and int(payload['behalf']) or user_id
-					status = self.take_it_of_the_tree(group_id, behalf)
+					status = await self.take_it_of_the_tree_async(group_id, behalf)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code=10, message=str(e))
@@ -313,7 +341,7 @@ def register_routes(self, app: Quart):
 				sl_member_qqid = payload['member']
 				status = payload['status']
 				try:
-					self.save_slot(group_id, sl_member_qqid, clean_flag = not status)
+					await self.save_slot_async(group_id, sl_member_qqid, clean_flag = not status)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(
@@ -339,7 +367,7 @@ def register_routes(self, app: Quart):
 			elif action == 'add_subscribe':
 				boss_num = payload['boss_num']
 				message = payload.get('message')
-				try:self.subscribe(group_id, user_id, str(boss_num))
+				try:await self.subscribe_async(group_id, user_id, str(boss_num))
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code = 10, message = str(e))
@@ -360,7 +388,7 @@ def register_routes(self, app: Quart):
 				return jsonify(code=0, notice=notice)
 			elif action == 'cancel_subscribe':
 				boss_num = payload['boss_num']
-				try:self.subscribe_cancel(group_id, str(boss_num), user_id)
+				try:await self.subscribe_cancel_async(group_id, str(boss_num), user_id)
 				except ClanBattleError as e:
 					_logger.info('网页 失败 {} {} {}'.format(user_id, group_id, action))
 					return jsonify(code = 10, message = str(e))
@@ -375,10 +403,10 @@ def register_routes(self, app: Quart):
 					)
 				return jsonify(code = 0, notice = notice)
 			elif action == 'modify':
-				if user.authority_group >= 100:
+				if user.authority_group >= ROLE_MEMBER:
 					return jsonify(code=11, message='Insufficient authority')
 				try:
-					status = self.modify(
+					status = await self.modify_async(
 						group_id,
 						cycle=payload['cycle'],
 						bossData=payload['bossData'],
@@ -401,7 +429,7 @@ def register_routes(self, app: Quart):
 					bossData=self._boss_data_dict(group),
 				)
 			elif action == 'send_remind':
-				if user.authority_group >= 100:
+				if user.authority_group >= ROLE_MEMBER:
 					return jsonify(code=11, message='Insufficient authority')
 				sender = user_id
 				private = payload.get('send_private_msg', False)
@@ -419,9 +447,9 @@ def register_routes(self, app: Quart):
 					notice='发送成功',
 				)
 			elif action == 'drop_member':
-				if user.authority_group >= 100:
+				if user.authority_group >= ROLE_MEMBER:
 					return jsonify(code=11, message='Insufficient authority')
-				count = self.drop_member(group_id, payload['memberlist'])
+				count = await self.drop_member_async(group_id, payload['memberlist'])
 				return jsonify(
 					code=0,
 					notice=f'已删除{count}条记录',
@@ -454,17 +482,8 @@ def register_routes(self, app: Quart):
 		urljoin(self.setting['public_basepath'],
 				'clan/<int:group_id>/<int:qqid>/'),
 		methods=['GET'])
+	@require_clan_member()
 	async def yobot_clan_user(group_id, qqid):
-		if 'yobot_user' not in session:
-			return redirect(url_for('yobot_login', callback=request.path))
-		user = User.get_by_id(session['yobot_user'])
-		group = Clan_group.get_or_none(group_id=group_id)
-		if group is None:
-			return await render_template('404.html', item='公会'), 404
-		is_member = Clan_member.get_or_none(
-			group_id=group_id, qqid=session['yobot_user'])
-		if (not is_member and user.authority_group >= 10):
-			return await render_template('clan/unauthorized.html')
 		return await render_template(
 			'clan/user.html',
 			qqid=qqid,
@@ -475,20 +494,18 @@ def register_routes(self, app: Quart):
 				'clan/<int:group_id>/setting/'),
 		methods=['GET'])
 	async def yobot_clan_setting(group_id):
-		if 'yobot_user' not in session:
+		user = get_login_user()
+		if user is None:
 			return redirect(url_for('yobot_login', callback=request.path))
-		user = User.get_by_id(session['yobot_user'])
-		group = Clan_group.get_or_none(group_id=group_id)
-		if group is None:
+		if get_group_info(group_id) is None:
 			return await render_template('404.html', item='公会'), 404
-		is_member = Clan_member.get_or_none(
-			group_id=group_id, qqid=session['yobot_user'])
+		is_member = get_membership(group_id, user.qqid) is not None
 		if (not is_member):
 			return await render_template(
 				'unauthorized.html',
 				limit='本公会成员',
 				uath='无')
-		if (user.authority_group >= 100):
+		if (user.authority_group >= ROLE_MEMBER):
 			return await render_template(
 				'unauthorized.html',
 				limit='公会战管理员',
@@ -506,16 +523,15 @@ def register_routes(self, app: Quart):
 				message='Not logged in',
 			)
 		user_id = session['yobot_user']
-		user = User.get_by_id(user_id)
-		group = Clan_group.get_or_none(group_id=group_id)
+		user = get_user(user_id)
+		group = await self.get_group_async(group_id)
 		if group is None:
 			return jsonify(
 				code=20,
 				message='Group not exists',
 			)
-		is_member = Clan_member.get_or_none(
-			group_id=group_id, qqid=session['yobot_user'])
-		if (user.authority_group >= 100 or not is_member):
+		is_member = get_membership(group_id, user_id) is not None
+		if (user.authority_group >= ROLE_MEMBER or not is_member):
 			return jsonify(
 				code=11,
 				message='Insufficient authority',
@@ -548,27 +564,42 @@ def register_routes(self, app: Quart):
 				group.game_server = payload['game_server']
 				group.notification = payload['notification']
 				group.privacy = payload['privacy']
-				group.save()
+				await run_in_db(group.save)
+				invalidate_group(group_id)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success')
 			elif action == 'get_data_slot_record_count':
-				counts = self.get_data_slot_record_count(group_id)
+				counts = await run_in_reader(self.get_data_slot_record_count, group_id)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success', counts=counts)
 			elif action == 'clear_data_slot':
 				battle_id = payload.get('battle_id')
-				self.clear_data_slot(group_id, battle_id)
+				await self.clear_data_slot_async(group_id, battle_id)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success')
 			elif action == 'switch_data_slot':
 				battle_id = payload['battle_id']
-				self.switch_data_slot(group_id, battle_id)
+				await self.switch_data_slot_async(group_id, battle_id)
 				_logger.info('网页 成功 {} {} {}'.format(
 					user_id, group_id, action))
 				return jsonify(code=0, message='success')
+			elif action == 'search_log':
+				# 只能查本公会的指令记录，读取压缩文件较慢，放到线程中
+				logs = await asyncio.get_event_loop().run_in_executor(None, functools.partial(
+					log_util.search,
+					cluster.worker_filenames(self.audit_log_path),
+					limit=min(int(payload.get('limit', 100)), 1000),
+					since=payload.get('since'),
+					until=payload.get('until'),
+					keyword=payload.get('keyword'),
+					group_id=group_id,
+					user_id=payload.get('user_id'),
+					command=payload.get('command'),
+				))
+				return jsonify(code=0, message='success', logs=logs)
 			else:
 				return jsonify(code=32, message='unknown action')
 		except KeyError as e:
@@ -582,17 +613,9 @@ def register_routes(self, app: Quart):
 		urljoin(self.setting['public_basepath'],
 				'clan/<int:group_id>/statistics/'),
 		methods=['GET'])
+	@require_clan_member()
 	async def yobot_clan_statistics(group_id):
-		if 'yobot_user' not in session:
-			return redirect(url_for('yobot_login', callback=request.path))
-		user = User.get_by_id(session['yobot_user'])
-		group = Clan_group.get_or_none(group_id=group_id)
-		if group is None:
-			return await render_template('404.html', item='公会'), 404
-		is_member = Clan_member.get_or_none(
-			group_id=group_id, qqid=session['yobot_user'])
-		if (not is_member and user.authority_group >= 10):
-			return await render_template('clan/unauthorized.html')
+		group = get_group_info(group_id)
 		return await render_template(
 			'clan/statistics.html',
 			allow_api=(group.privacy & 0x2),
@@ -603,17 +626,8 @@ def register_routes(self, app: Quart):
 		urljoin(self.setting['public_basepath'],
 				'clan/<int:group_id>/statistics/<int:sid>/'),
 		methods=['GET'])
+	@require_clan_member()
 	async def yobot_clan_boss(group_id, sid):
-		if 'yobot_user' not in session:
-			return redirect(url_for('yobot_login', callback=request.path))
-		user = User.get_by_id(session['yobot_user'])
-		group = Clan_group.get_or_none(group_id=group_id)
-		if group is None:
-			return await render_template('404.html', item='公会'), 404
-		is_member = Clan_member.get_or_none(
-			group_id=group_id, qqid=session['yobot_user'])
-		if (not is_member and user.authority_group >= 10):
-			return await render_template('clan/unauthorized.html')
 		return await render_template(
 			f'clan/statistics/statistics{sid}.html',
 		)
@@ -623,7 +637,7 @@ def register_routes(self, app: Quart):
 				'clan/<int:group_id>/statistics/api/'),
 		methods=['GET'])
 	async def yobot_clan_statistics_api(group_id):
-		group = Clan_group.get_or_none(group_id=group_id)
+		group = await self.get_group_async(group_id)
 		if group is None:
 			return jsonify(code=20, message='Group not exists')
 		apikey = request.args.get('apikey')
@@ -635,12 +649,10 @@ def register_routes(self, app: Quart):
 				return jsonify(code=12, message='Invalid apikey')
 		else:
 			# 内部直接访问
-			if 'yobot_user' not in session:
+			user = get_login_user()
+			if user is None:
 				return jsonify(code=10, message='Not logged in')
-			user = User.get_by_id(session['yobot_user'])
-			is_member = Clan_member.get_or_none(
-				group_id=group_id, qqid=session['yobot_user'])
-			if (not is_member and user.authority_group >= 10):
+			if not can_view_group(user, group_id):
 				return jsonify(code=11, message='Insufficient authority')
 		battle_id = request.args.get('battle_id')
 		if battle_id is None:
@@ -654,8 +666,8 @@ def register_routes(self, app: Quart):
 				battle_id = None
 			else:
 				return jsonify(code=20, message=f'unexceptd value "{battle_id}" for battle_id')
-		report = self.get_report(group_id, battle_id, None, None)
-		member_list = self.get_battle_member_list(group_id, battle_id)
+		report = await self.get_report_async(group_id, battle_id, None, None)
+		member_list = await self.get_battle_member_list_async(group_id, battle_id)
 		groupinfo = {
 			'group_id': group.group_id,
 			'group_name': group.group_name,
@@ -679,16 +691,14 @@ def register_routes(self, app: Quart):
 				'clan/<int:group_id>/progress/'),
 		methods=['GET'])
 	async def yobot_clan_progress(group_id):
-		group = Clan_group.get_or_none(group_id=group_id)
+		group = get_group_info(group_id)
 		if group is None:
 			return await render_template('404.html', item='公会'), 404
 		if not(group.privacy & 0x1):
-			if 'yobot_user' not in session:
+			user = get_login_user()
+			if user is None:
 				return redirect(url_for('yobot_login', callback=request.path))
-			user = User.get_by_id(session['yobot_user'])
-			is_member = Clan_member.get_or_none(
-				group_id=group_id, qqid=session['yobot_user'])
-			if (not is_member and user.authority_group >= 10):
+			if not can_view_group(user, group_id):
 				return await render_template('clan/unauthorized.html')
 		return await render_template(
 			'clan/progress.html',
@@ -699,16 +709,14 @@ def register_routes(self, app: Quart):
 				'clan/<int:group_id>/clan-rank/'),
 		methods=['GET'])
 	async def yobot_clan_rank(group_id):
-		group = Clan_group.get_or_none(group_id=group_id)
+		group = get_group_info(group_id)
 		if group is None:
 			return await render_template('404.html', item='公会'), 404
 		if not(group.privacy & 0x1):
-			if 'yobot_user' not in session:
+			user = get_login_user()
+			if user is None:
 				return redirect(url_for('yobot_login', callback=request.path))
-			user = User.get_by_id(session['yobot_user'])
-			is_member = Clan_member.get_or_none(
-				group_id=group_id, qqid=session['yobot_user'])
-			if (not is_member and user.authority_group >= 10):
+			if not can_view_group(user, group_id):
 				return await render_template('clan/unauthorized.html')
 		return await render_template(
 			'clan/clan-rank.html',
@@ -3,8 +3,6 @@ import time
 from functools import lru_cache
 from typing import Tuple, Union
 
-from expiringdict import ExpiringDict
-
 from .typing import Pcr_date, Pcr_time
 
 pcr_time_offset = {
@@ -37,23 +35,22 @@ def pcr_timestamp(d: Pcr_date, t: Pcr_time, area) -> int:
     return 86400*d + t - (pcr_time_offset[area]*3600)
 
 
+# 每个服务器当前的pcr日期，以及下一次日期切换（当地5点）的时间戳
+_today = {}
+
+
+def pcr_today(area) -> Pcr_date:
+    """
+    当前的pcr日期，到下一次日期切换之前直接返回记下的日期
+    """
+    now = time.time()
+    today = _today.get(area)
+    if today is None or now >= today[1]:
+        d, _ = pcr_datetime(area, int(now))
+        today = _today[area] = (d, pcr_timestamp(d + 1, 0, area))
+    return today[0]
+
+
 def atqq(qqid):
     return '[CQ:at,qq={}]'.format(qqid)
 
-
-def timed_cached_func(max_len, max_age_seconds, ignore_self=False):
-    cache = ExpiringDict(max_len, max_age_seconds)
-
-    def decorator(fn):
-        def wrapper(*args, nocache=False):  # args must be hashable
-            if ignore_self:
-                key = tuple(args[1:])
-            else:
-                key = tuple(args)
-            value = cache.get(key)
-            if nocache or value is None:
-                value = fn(*args)
-                cache[key] = value
-            return value
-        return wrapper
-    return decorator
@@ -0,0 +1,408 @@
+"""
+多进程部署
+
+main.py按workers配置fork出多个工作进程，共用同一个监听端口。
+进程之间通过数据目录下的cluster.db（sqlite）交换消息，后台线程每POLL_INTERVAL秒读取一次：
+
+- 公会状态变化（web面板的长轮询）、缓存清除和后台修改的设置广播到所有进程
+- 定时任务只在选举出的leader进程执行，leader退出后其他进程在LEASE_SECONDS秒内接替
+- go-cqhttp的反向WebSocket只会连接到其中一个进程，
+  其他进程调用api时（ClusterApi）转发给有连接的进程执行
+
+只有一个进程时（workers为1）不启用，publish不做任何事，is_leader总是True。
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Collection, Dict, List, Optional
+
+from aiocqhttp.api import AsyncApi
+from aiocqhttp.exceptions import ActionFailed, ApiNotAvailable, NetworkError
+
+from . import cache_util
+
+_logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.1     # 读取消息的间隔（秒）
+LEASE_SECONDS = 15      # leader租约时长，超时未续约时由其他进程接替
+LEASE_RENEW = 5         # 续约和心跳的间隔
+EVENT_KEEP = 60         # 消息保留的时间
+API_TIMEOUT = 60        # 转发的api调用等待结果的时间
+BUSY_TIMEOUT = 5
+_THREAD_NAME = "yobot-cluster"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cluster_event (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    worker TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cluster_event_created ON cluster_event (created);
+CREATE TABLE IF NOT EXISTS cluster_lease (
+    name TEXT PRIMARY KEY,
+    worker TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cluster_worker (
+    worker TEXT PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    connected INTEGER NOT NULL,
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cluster_claim (
+    call_id TEXT PRIMARY KEY,
+    worker TEXT NOT NULL,
+    created REAL NOT NULL
+);
+"""
+
+
+def _tuplify(value):
+    # json把元组变成了列表，缓存键需要还原
+    if isinstance(value, list):
+        return tuple(_tuplify(v) for v in value)
+    return value
+
+
+class Broker:
+    def __init__(self, path: str, worker_id: str):
+        self.path = path
+        self.worker_id = worker_id
+        self.leader = False
+        self.workers: List[Dict[str, Any]] = []  # 最近一次心跳时存活的进程
+        self.local_api: Optional["ClusterApi"] = None
+        self.published = 0
+        self.received = 0
+        self._handlers: Dict[str, List[Callable]] = {}
+        self._outbox = queue.SimpleQueue()
+        self._calls: Dict[str, asyncio.Future] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=_THREAD_NAME, daemon=True)
+        self.subscribe("api_result", self._on_api_result)
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread.ident is not None:
+            self._thread.join(timeout=5)
+
+    def subscribe(self, channel: str, handler: Callable) -> None:
+        """
+        handler在事件循环中执行，以消息的字段为关键字参数
+        """
+        self._handlers.setdefault(channel, []).append(handler)
+
+    def publish(self, channel: str, **payload) -> None:
+        """
+        广播给其他进程，可以在任意线程调用
+
+        Raises:
+            TypeError: payload不能转为json
+        """
+        self._outbox.put((channel, json.dumps(payload, ensure_ascii=False)))
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        # 只处理启动之后的消息
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM cluster_event").fetchone()[0]
+        next_renew = next_cleanup = 0
+        try:
+            while not self._stop.is_set():
+                now = time.time()
+                try:
+                    self._flush(conn, now)
+                    if now >= next_renew:
+                        self._heartbeat(conn, now)
+                        next_renew = now + LEASE_RENEW
+                    last_id = self._poll(conn, last_id)
+                    if now >= next_cleanup:
+                        self._cleanup(conn, now)
+                        next_cleanup = now + EVENT_KEEP
+                except sqlite3.Error as e:
+                    _logger.warning("集群消息读写失败：{}".format(e))
+                self._stop.wait(POLL_INTERVAL)
+            self._flush(conn, time.time())
+            # 正常退出时交出leader，其他进程不需要等待租约过期
+            conn.execute(
+                "DELETE FROM cluster_lease WHERE name = 'leader' AND worker = ?",
+                (self.worker_id,))
+            conn.execute("DELETE FROM cluster_worker WHERE worker = ?", (self.worker_id,))
+        finally:
+            conn.close()
+
+    def _flush(self, conn: sqlite3.Connection, now: float) -> None:
+        rows = []
+        while True:
+            try:
+                channel, payload = self._outbox.get_nowait()
+            except queue.Empty:
+                break
+            rows.append((self.worker_id, channel, payload, now))
+        if not rows:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO cluster_event (worker, channel, payload, created) "
+                "VALUES (?, ?, ?, ?)", rows)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        self.published += len(rows)
+
+    def _heartbeat(self, conn: sqlite3.Connection, now: float) -> None:
+        connected = bool(self.local_api and self.local_api.connected())
+        conn.execute(
+            "INSERT OR REPLACE INTO cluster_worker (worker, pid, connected, heartbeat) "
+            "VALUES (?, ?, ?, ?)", (self.worker_id, os.getpid(), connected, now))
+        # 租约过期或本来就是自己时取得leader
+        conn.execute(
+            "INSERT INTO cluster_lease (name, worker, expires) VALUES ('leader', ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET worker = excluded.worker, expires = excluded.expires "
+            "WHERE cluster_lease.worker = excluded.worker OR cluster_lease.expires < ?",
+            (self.worker_id, now + LEASE_SECONDS, now))
+        leader = conn.execute(
+            "SELECT worker FROM cluster_lease WHERE name = 'leader'").fetchone()[0]
+        if (leader == self.worker_id) != self.leader:
+            _logger.info("进程{}{}leader".format(
+                self.worker_id, "成为" if not self.leader else "不再是"))
+        self.leader = leader == self.worker_id
+        self.workers = [
+            {"worker": w, "pid": pid, "connected": bool(c), "heartbeat": int(h)}
+            for w, pid, c, h in conn.execute(
+                "SELECT worker, pid, connected, heartbeat FROM cluster_worker "
+                "WHERE heartbeat > ? ORDER BY worker", (now - LEASE_SECONDS,))
+        ]
+
+    def _poll(self, conn: sqlite3.Connection, last_id: int) -> int:
+        for event_id, worker, channel, payload in conn.execute(
+                "SELECT id, worker, channel, payload FROM cluster_event "
+                "WHERE id > ? ORDER BY id", (last_id,)).fetchall():
+            last_id = event_id
+            if worker == self.worker_id:
+                continue
+            self.received += 1
+            data = json.loads(payload)
+            if channel == "api_call":
+                self._claim_call(conn, data)
+            else:
+                self._loop.call_soon_threadsafe(self._dispatch, channel, data)
+        return last_id
+
+    def _cleanup(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM cluster_event WHERE created < ?", (now - EVENT_KEEP,))
+        conn.execute("DELETE FROM cluster_claim WHERE created < ?", (now - EVENT_KEEP,))
+        conn.execute("DELETE FROM cluster_worker WHERE heartbeat < ?", (now - 3600,))
+
+    def _dispatch(self, channel: str, data: Dict[str, Any]) -> None:
+        for handler in self._handlers.get(channel, ()):
+            try:
+                handler(**data)
+            except Exception as e:
+                _logger.exception("处理集群消息{}失败：{}".format(channel, e))
+
+    def _claim_call(self, conn: sqlite3.Connection, data: Dict[str, Any]) -> None:
+        # 有连接的进程都可能收到，先登记的执行；指定了账号时只由连接了这个账号的进程执行
+        if self.local_api is None or not self.local_api.connected():
+            return
+        self_id = data["params"].get("self_id")
+        if self_id is not None and str(self_id) not in self.local_api.accounts():
+            return
+        claimed = conn.execute(
+            "INSERT OR IGNORE INTO cluster_claim (call_id, worker, created) VALUES (?, ?, ?)",
+            (data["id"], self.worker_id, time.time())).rowcount
+        if claimed:
+            asyncio.run_coroutine_threadsafe(self._execute_call(**data), self._loop)
+
+    async def _execute_call(self, id, action, params):
+        try:
+            result = await self.local_api.call_local(action, **params)
+        except ActionFailed as e:
+            self.publish("api_result", id=id, failed=e.result)
+        except Exception as e:
+            self.publish("api_result", id=id, error=repr(e))
+        else:
+            self.publish("api_result", id=id, result=result)
+
+    def _on_api_result(self, id, result=None, failed=None, error=None):
+        future = self._calls.pop(id, None)
+        if future is None or future.done():
+            return
+        if failed is not None:
+            future.set_exception(ActionFailed(failed))
+        elif error is not None:
+            future.set_exception(NetworkError(error))
+        else:
+            future.set_result(result)
+
+    async def call_remote(self, action: str, **params) -> Any:
+        if not any(w["connected"] for w in self.workers if w["worker"] != self.worker_id):
+            raise ApiNotAvailable
+        call_id = uuid.uuid4().hex
+        future = asyncio.get_event_loop().create_future()
+        self._calls[call_id] = future
+        try:
+            self.publish("api_call", id=call_id, action=action, params=params)
+            return await asyncio.wait_for(future, API_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise ApiNotAvailable
+        finally:
+            self._calls.pop(call_id, None)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "worker": self.worker_id,
+            "leader": self.leader,
+            "workers": self.workers,
+            "published": self.published,
+            "received": self.received,
+        }
+
+
+class ClusterApi(AsyncApi):
+    """
+    本进程有go-cqhttp连接时直接调用，否则转发给有连接的进程
+    """
+
+    def __init__(self, api: AsyncApi, accounts: Callable[[], Collection[str]]):
+        """
+        Args:
+            accounts: 返回本进程已连接账号的函数
+        """
+        super().__init__()
+        self._api = api
+        self.accounts = accounts
+        if _broker is not None:
+            _broker.local_api = self
+
+    def connected(self) -> bool:
+        return bool(self.accounts())
+
+    async def call_local(self, action: str, **params) -> Any:
+        return await self._api.call_action(action, **params)
+
+    async def call_action(self, action: str, **params) -> Any:
+        if _broker is None or self.connected():
+            return await self.call_local(action, **params)
+        try:
+            return await self.call_local(action, **params)
+        except ApiNotAvailable:
+            return await _broker.call_remote(action, **params)
+
+
+_broker: Optional[Broker] = None
+_worker_index = 0
+_workers = 1
+
+
+def init(dirname: str, index: int, workers: int) -> None:
+    """
+    在工作进程中创建yobot之前调用
+
+    Args:
+        dirname: 数据目录，cluster.db放在这里
+        index: 工作进程序号，从0开始
+        workers: 工作进程数
+    """
+    global _broker, _worker_index, _workers
+    _worker_index = index
+    _workers = workers
+    _broker = Broker(os.path.join(dirname, "cluster.db"),
+                     "w{}:{}".format(index, os.getpid()))
+    cache_util.add_invalidate_hook(_publish_invalidate)
+    _broker.subscribe("invalidate", _on_invalidate)
+
+
+async def start() -> None:
+    # 作为quart的before_serving，在事件循环中启动
+    if _broker is not None:
+        _broker.start(asyncio.get_event_loop())
+
+
+async def stop() -> None:
+    if _broker is not None:
+        await asyncio.get_event_loop().run_in_executor(None, _broker.stop)
+
+
+def enabled() -> bool:
+    return _broker is not None
+
+
+def is_leader() -> bool:
+    """
+    是否执行定时任务，未启用时总是True
+    """
+    return _broker is None or _broker.leader
+
+
+def publish(channel: str, **payload) -> None:
+    if _broker is not None:
+        _broker.publish(channel, **payload)
+
+
+def subscribe(channel: str, handler: Callable) -> None:
+    if _broker is not None:
+        _broker.subscribe(channel, handler)
+
+
+def worker_id() -> Optional[str]:
+    """
+    本进程的名称，未启用时为None
+    """
+    return _broker and _broker.worker_id
+
+
+def status() -> Optional[Dict[str, Any]]:
+    return _broker and _broker.status()
+
+
+def worker_filename(path: str) -> str:
+    """
+    每个进程写自己的日志文件，避免多个进程同时轮转同一个文件
+
+    第一个进程使用原文件名，其他进程为`<文件名>.w<序号><扩展名>`
+    """
+    if _worker_index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return "{}.w{}{}".format(root, _worker_index, ext)
+
+
+def worker_filenames(path: str) -> List[str]:
+    """
+    所有进程的日志文件
+    """
+    root, ext = os.path.splitext(path)
+    return [path] + ["{}.w{}{}".format(root, i, ext) for i in range(1, _workers)]
+
+
+def _publish_invalidate(name: str, prefix: tuple) -> None:
+    try:
+        publish("invalidate", name=name, prefix=prefix)
+    except TypeError:
+        # 缓存键不能转为json时让其他进程清空整个缓存
+        publish("invalidate", name=name, prefix=None)
+
+
+def _on_invalidate(name, prefix):
+    cache_util.invalidate_local(name, None if prefix is None else _tuplify(prefix))
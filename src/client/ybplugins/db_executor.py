@@ -0,0 +1,119 @@
+"""
+数据库专用线程
+
+web处理函数中的查询、群聊指令和网页的修改操作放到这些线程执行，避免数据库I/O阻塞事件循环。
+
+- run_in_db：只有一个线程，在这里执行的操作之间不会并发，可以写入。
+  其中需要事件循环的操作（唤醒future、发送消息）用call_in_loop、spawn转回事件循环
+- run_in_reader：统计、报告等只读查询，使用独立的只读连接（sqlite设置query_only），
+  WAL模式下可以与报刀的写入同时进行
+"""
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import ybdata
+
+_THREAD_NAME = 'yobot-db'
+_READER_THREAD_NAME = 'yobot-reader'
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=_THREAD_NAME)
+_reader_executor = None
+
+_reader_threads = 2
+_mmap_size = 0
+_reader_local = threading.local()
+_loop_local = threading.local()  # 数据库线程中正在执行的操作来自哪个事件循环
+
+
+def configure(setting):
+    """
+    Args:
+        setting: 全局配置，读取db_read_threads、db_mmap_size
+    """
+    global _reader_threads, _mmap_size
+    _reader_threads = max(1, setting.get('db_read_threads', 2))
+    _mmap_size = setting.get('db_mmap_size', 0)
+
+
+def _call(loop, fn, args, kwargs):
+    _loop_local.loop = loop
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _loop_local.loop = None
+        ybdata.release_connection()
+
+
+def call_in_loop(callback, *args) -> None:
+    """
+    在事件循环中执行callback，不等待结果
+
+    在run_in_db、run_in_reader执行的函数中调用时交给发起调用的事件循环，
+    否则（已经在事件循环中）立即执行
+    """
+    loop = getattr(_loop_local, 'loop', None)
+    if loop is None:
+        callback(*args)
+    else:
+        loop.call_soon_threadsafe(callback, *args)
+
+
+def spawn(coro) -> None:
+    """
+    在事件循环中运行协程（asyncio.ensure_future），可以在数据库线程中调用
+    """
+    call_in_loop(asyncio.ensure_future, coro)
+
+
+def _prepare_reader_connection():
+    # 连接是线程独占的，pragma只影响这个线程；连接重新打开后要再设置一次
+    # 按公会分库时每个数据库各有一个连接，在fn所在的公会上下文中取
+    if ybdata.sqlite_path() is None:
+        return
+    prepared = getattr(_reader_local, 'conns', None)
+    if prepared is None:
+        prepared = _reader_local.conns = {}
+    db = ybdata._db.obj
+    conn = db.connection()
+    if prepared.get(db) is conn:
+        return
+    conn.execute('PRAGMA query_only = 1')
+    if _mmap_size > 0:
+        conn.execute('PRAGMA mmap_size = {}'.format(int(_mmap_size)))
+    prepared[db] = conn
+
+
+def _call_reader(loop, fn, args, kwargs):
+    _prepare_reader_connection()
+    return _call(loop, fn, args, kwargs)
+
+
+async def run_in_db(fn, *args, **kwargs):
+    """
+    在数据库线程中执行fn并等待结果
+
+    fn中不能直接使用事件循环（如创建future），要用call_in_loop；也不能访问quart的request和session
+    """
+    # 复制上下文，数据库线程中的查询也计入发起的请求（sql_profiler）
+    ctx = contextvars.copy_context()
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _executor, ctx.run, _call, loop, fn, args, kwargs)
+
+
+async def run_in_reader(fn, *args, **kwargs):
+    """
+    在只读连接上执行fn并等待结果，fn中写入数据库会出错
+
+    限制同run_in_db
+    """
+    global _reader_executor
+    if _reader_executor is None:
+        _reader_executor = ThreadPoolExecutor(
+            max_workers=_reader_threads, thread_name_prefix=_READER_THREAD_NAME)
+    ctx = contextvars.copy_context()
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _reader_executor, ctx.run, _call_reader, loop, fn, args, kwargs)
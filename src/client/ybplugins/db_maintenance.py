@@ -0,0 +1,241 @@
+"""
+sqlite数据库的定时维护：在线备份、WAL检查点、PRAGMA optimize、增量vacuum
+
+按公会分库时，每个公会的数据库也一起维护；已结束会战的冷存档只在备份时复制
+
+都使用独立的sqlite3连接，在线程池中执行，不占用事件循环和数据库线程
+"""
+import asyncio
+import datetime
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional
+
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+
+from . import battle_archive, ybdata
+
+_logger = logging.getLogger(__name__)
+
+BACKUP_PAGES = 1024         # 非WAL数据库每步复制的页数，两步之间让出锁
+BACKUP_SLEEP = 0.05         # 两步之间的间隔（秒）
+BACKUP_RESTARTS = 3         # 分步复制被写入打断重来的次数，超过后一次复制完
+VACUUM_PAGES = 2048         # 每次增量vacuum最多回收的页数
+BUSY_TIMEOUT = 10           # 等待其他连接释放锁的时间（秒）
+SHARD_BACKUP_SUFFIX = '.shards'  # 公会数据库的备份文件夹
+ARCHIVE_BACKUP_SUFFIX = '.archive'  # 冷存档的备份文件夹
+
+
+class _BackupRestarted(Exception):
+    pass
+
+
+def _file_size(path) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class DBMaintenance:
+    Passive = False
+    Active = True
+    Request = False
+
+    def __init__(self,
+                 glo_setting,
+                 *args, **kwargs):
+        self.setting = glo_setting
+        self.backup_dir = os.path.join(glo_setting['dirname'], 'backup')
+        # 最近一次各项维护的结果，{名称: {耗时、大小等}}
+        self.last_reports: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def db_path(self) -> Optional[str]:
+        return ybdata.sqlite_path()
+
+    def _db_files(self) -> List[str]:
+        # 主库在前，按公会分库时之后是每个公会的数据库
+        return [self.db_path] + [
+            ybdata.shard_file(group_id) for group_id in ybdata.shard_groups()]
+
+    def _connect(self, path: Optional[str] = None) -> sqlite3.Connection:
+        return sqlite3.connect(path or self.db_path, timeout=BUSY_TIMEOUT,
+                               isolation_level=None)
+
+    def _backup_file(self, source: str, target: str) -> None:
+        src = self._connect(source)
+        dst = sqlite3.connect(target + '.tmp')
+        try:
+            if src.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+                # WAL模式下读取不阻塞写入，一步复制完，
+                # 分步复制时其他连接每次写入都会让备份从头开始
+                src.backup(dst, pages=-1)
+            else:
+                self._stepped_backup(src, dst)
+        finally:
+            dst.close()
+            src.close()
+        # 复制完成后再改名，不会留下不完整的备份
+        os.replace(target + '.tmp', target)
+
+    def _stepped_backup(self, src: sqlite3.Connection, dst: sqlite3.Connection) -> None:
+        restarts = 0
+        last_remaining = None
+
+        def progress(status, remaining, total):
+            nonlocal restarts, last_remaining
+            if last_remaining is not None and remaining > last_remaining:
+                restarts += 1
+                if restarts > BACKUP_RESTARTS:
+                    raise _BackupRestarted()
+            last_remaining = remaining
+
+        try:
+            src.backup(dst, pages=BACKUP_PAGES, progress=progress, sleep=BACKUP_SLEEP)
+        except _BackupRestarted:
+            _logger.info('备份被写入打断{}次，改为一次复制'.format(restarts))
+            src.backup(dst, pages=-1)
+
+    def _report(self, name: str, start: float, **info) -> Dict[str, Any]:
+        info['seconds'] = round(time.perf_counter() - start, 3)
+        info['time'] = int(time.time())
+        self.last_reports[name] = info
+        _logger.info('数据库维护 {} {}'.format(name, info))
+        return info
+
+    def backup(self) -> Dict[str, Any]:
+        """
+        使用sqlite3的backup接口在线备份，分步复制，备份期间不阻塞写入
+
+        按公会分库时，公会的数据库备份到同名的`.shards`文件夹，
+        冷存档备份到同名的`.archive`文件夹
+        """
+        start = time.perf_counter()
+        os.makedirs(self.backup_dir, exist_ok=True)
+        filename = 'yobotdata_{}.db'.format(
+            datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+        target = os.path.join(self.backup_dir, filename)
+        self._backup_file(self.db_path, target)
+        size = _file_size(target)
+        shards = self._db_files()[1:]
+        if shards:
+            shard_dir = target + SHARD_BACKUP_SUFFIX
+            os.makedirs(shard_dir, exist_ok=True)
+            for path in shards:
+                shard_target = os.path.join(shard_dir, os.path.basename(path))
+                self._backup_file(path, shard_target)
+                size += _file_size(shard_target)
+        archives = battle_archive.archive_files()
+        if archives:
+            archive_dir = target + ARCHIVE_BACKUP_SUFFIX
+            os.makedirs(archive_dir, exist_ok=True)
+            for path in archives:
+                archive_target = os.path.join(archive_dir, os.path.basename(path))
+                self._backup_file(path, archive_target)
+                size += _file_size(archive_target)
+        removed = self._remove_old_backups()
+        return self._report('backup', start,
+                            file=filename,
+                            shards=len(shards),
+                            archives=len(archives),
+                            size=size,
+                            removed=removed)
+
+    def _remove_old_backups(self) -> int:
+        keep = self.setting.get('db_backup_keep', 7)
+        backups = sorted(
+            f for f in os.listdir(self.backup_dir)
+            if f.startswith('yobotdata_') and f.endswith('.db'))
+        old = backups[:-keep] if keep > 0 else []
+        for f in old:
+            os.remove(os.path.join(self.backup_dir, f))
+            shutil.rmtree(os.path.join(self.backup_dir, f + SHARD_BACKUP_SUFFIX),
+                          ignore_errors=True)
+            shutil.rmtree(os.path.join(self.backup_dir, f + ARCHIVE_BACKUP_SUFFIX),
+                          ignore_errors=True)
+        return len(old)
+
+    def checkpoint(self) -> Dict[str, Any]:
+        """
+        把WAL写回数据库文件并截断WAL
+        """
+        start = time.perf_counter()
+        busy = log_pages = checkpointed = wal_before = wal_after = 0
+        for path in self._db_files():
+            wal_path = path + '-wal'
+            wal_before += _file_size(wal_path)
+            conn = self._connect(path)
+            try:
+                result = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+            finally:
+                conn.close()
+            busy += result[0]
+            log_pages += result[1]
+            checkpointed += result[2]
+            wal_after += _file_size(wal_path)
+        return self._report('checkpoint', start,
+                            busy=bool(busy),
+                            log_pages=log_pages,
+                            checkpointed_pages=checkpointed,
+                            wal_size_before=wal_before,
+                            wal_size_after=wal_after)
+
+    def optimize(self) -> Dict[str, Any]:
+        """
+        PRAGMA optimize更新统计信息，之后回收空闲页
+
+        只有auto_vacuum为INCREMENTAL的数据库才能增量回收，
+        旧数据库需要停机执行一次`PRAGMA auto_vacuum=INCREMENTAL; VACUUM;`
+        """
+        start = time.perf_counter()
+        files = self._db_files()
+        size_before = sum(_file_size(path) for path in files)
+        freelist = freelist_after = 0
+        for path in files:
+            conn = self._connect(path)
+            try:
+                # 0x10002：新连接没有查询记录，检查所有表（旧版本sqlite忽略高位）
+                conn.execute('PRAGMA optimize=0x10002')
+                auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+                freelist += conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if auto_vacuum == 2:
+                    conn.execute('PRAGMA incremental_vacuum({})'.format(VACUUM_PAGES))
+                freelist_after += conn.execute('PRAGMA freelist_count').fetchone()[0]
+            finally:
+                conn.close()
+            if path == self.db_path:
+                main_auto_vacuum = auto_vacuum
+        return self._report('optimize', start,
+                            incremental_vacuum=(main_auto_vacuum == 2),
+                            freelist_pages_before=freelist,
+                            freelist_pages_after=freelist_after,
+                            size_before=size_before,
+                            size_after=sum(_file_size(path) for path in files))
+
+    def _in_thread(self, fn):
+        async def job():
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, fn)
+            except Exception as e:
+                _logger.exception('数据库维护失败：{}'.format(e))
+        return job
+
+    def jobs(self):
+        if self.db_path is None:
+            # mysql/postgresql由数据库服务自行维护
+            return ()
+        jobs = ((CronTrigger(hour=4, minute=50), self._in_thread(self.optimize)),)
+        checkpoint_minutes = self.setting.get('db_checkpoint_minutes', 30)
+        if checkpoint_minutes > 0:
+            jobs += ((IntervalTrigger(minutes=checkpoint_minutes),
+                      self._in_thread(self.checkpoint)),)
+        backup_hours = self.setting.get('db_backup_hours', 24)
+        if backup_hours > 0:
+            jobs += ((IntervalTrigger(hours=backup_hours),
+                      self._in_thread(self.backup)),)
+        return jobs
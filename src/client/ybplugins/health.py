@@ -0,0 +1,91 @@
+"""
+健康检查
+
+`<public_basepath>health`返回事件循环延迟、数据库和定时任务的状态、等待发送的消息数
+（多进程部署时还有各个进程和leader），供容器的存活检查使用。数据库或定时任务不可用时返回503。
+事件循环阻塞时这个请求也无法响应，检查超时即说明机器人已经卡住。
+"""
+import asyncio
+import time
+from typing import Any, Dict
+from urllib.parse import urljoin
+
+from quart import Quart, jsonify
+
+from . import cluster, metrics, ybdata
+from .db_executor import run_in_db
+
+DB_TIMEOUT = 5  # 等待数据库的时间（秒）
+
+
+class Health:
+    Passive = False
+    Active = False
+    Request = True
+
+    def __init__(self,
+                 glo_setting: Dict[str, Any],
+                 scheduler=None,
+                 *args, **kwargs):
+        self.setting = glo_setting
+        self.scheduler = scheduler
+
+    async def check_database(self) -> Dict[str, Any]:
+        # 在数据库线程中执行，写入卡住时也会超时
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(
+                run_in_db(lambda: ybdata._db.execute_sql("SELECT 1").fetchone()),
+                timeout=DB_TIMEOUT)
+        except Exception as e:
+            return {"ok": False, "error": repr(e)}
+        return {"ok": True, "ms": round((time.perf_counter() - start) * 1000, 1)}
+
+    def check_scheduler(self) -> Dict[str, Any]:
+        if self.scheduler is None:
+            return {"ok": True, "running": False, "jobs": 0}
+        jobs = self.scheduler.get_jobs()
+        # 没有定时任务时不会启动
+        return {
+            "ok": bool(self.scheduler.running or not jobs),
+            "running": bool(self.scheduler.running),
+            "jobs": len(jobs),
+        }
+
+    async def status(self) -> Dict[str, Any]:
+        """
+        status为error时数据库或定时任务不可用；
+        最近事件循环延迟的p95超过loop_lag_warn_ms时为degraded
+        """
+        database = await self.check_database()
+        scheduler = self.check_scheduler()
+        lag = metrics.LAG_MONITOR.stats()
+        threshold = metrics.LAG_MONITOR.threshold
+        if not (database["ok"] and scheduler["ok"]):
+            status = "error"
+        elif threshold > 0 and lag.get("p95_ms", 0) > threshold * 1000:
+            status = "degraded"
+        else:
+            status = "ok"
+        result = {
+            "status": status,
+            "loop_lag": lag,
+            "database": database,
+            "scheduler": scheduler,
+            "outbound": {
+                "api_calls_in_progress": metrics.API_IN_PROGRESS.get(),
+                "pending_messages": metrics.PENDING_MESSAGES.get(),
+            },
+        }
+        if cluster.enabled():
+            result["cluster"] = cluster.status()
+        return result
+
+    def register_routes(self, app: Quart):
+
+        @app.route(
+            urljoin(self.setting["public_basepath"], "health"),
+            methods=["GET"])
+        async def yobot_health():
+            result = await self.status()
+            return jsonify(result), (503 if result["status"] == "error" else 200)
@@ -0,0 +1,209 @@
+"""
+日志工具
+
+- 日志记录放入队列，由后台线程写入文件和控制台，事件循环不等待磁盘I/O
+- 文件按大小和日期轮转，旧文件用gzip压缩
+- log_context中的字段（群号、QQ号、指令等）会附加到其中产生的每条记录，
+  JsonFormatter把它们写成一行一个json，可以用search按字段查找
+"""
+import atexit
+import contextlib
+import contextvars
+import datetime
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+# 结构化字段，出现在记录中时写入json
+STRUCTURED_FIELDS = ("group_id", "user_id", "command", "latency_ms", "result")
+
+_context: "contextvars.ContextVar[Optional[Dict[str, Any]]]" = contextvars.ContextVar(
+    "yobot_log_context", default=None)
+
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """
+    with块中产生的日志记录附加这些字段（嵌套时合并）
+    """
+    token = _context.set({**(_context.get() or {}), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    把log_context的字段写入记录，需要在产生记录的线程中执行
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        fields = _context.get()
+        if fields:
+            for key, value in fields.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key in STRUCTURED_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data["exc_info"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+def _gzip_rotator(source: str, dest: str) -> None:
+    with open(source, "rb") as sf, gzip.open(dest, "wb") as df:
+        shutil.copyfileobj(sf, df)
+    os.remove(source)
+
+
+class CompressedRotatingFileHandler(RotatingFileHandler):
+    """
+    超过max_bytes或日期变化时轮转，旧文件为`<文件名>.1.gz`、`<文件名>.2.gz`……
+    """
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding="utf-8", delay=True)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = _gzip_rotator
+        self._date = self._file_date()
+
+    def _file_date(self) -> datetime.date:
+        try:
+            return datetime.date.fromtimestamp(os.path.getmtime(self.baseFilename))
+        except OSError:
+            return datetime.date.today()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if (self.backupCount > 0 and datetime.date.today() != self._date
+                and os.path.exists(self.baseFilename)
+                and os.path.getsize(self.baseFilename) > 0):
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self._date = datetime.date.today()
+
+
+def rotating_file_handler(filename: str, setting: Dict[str, Any]) -> CompressedRotatingFileHandler:
+    """
+    Args:
+        filename: 日志文件路径
+        setting: 全局配置，读取log_max_size_mb、log_backup_count
+    """
+    return CompressedRotatingFileHandler(
+        filename,
+        max_bytes=int(setting.get("log_max_size_mb", 10) * 1024 * 1024),
+        backup_count=setting.get("log_backup_count", 14),
+    )
+
+
+def attach_queue(loggers: Iterable[logging.Logger],
+                 handlers: Iterable[logging.Handler]) -> QueueListener:
+    """
+    loggers的记录经队列交给后台线程，由handlers处理
+
+    程序退出时会等待队列中的记录写完
+    """
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    for logger in loggers:
+        logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_queue, listener)
+    return listener
+
+
+def stop_queue(listener: QueueListener) -> None:
+    """
+    写完队列中的记录后停止后台线程，可以重复调用
+
+    多进程部署时工作进程用os._exit退出，不会执行atexit，需要在退出前调用
+    """
+    if listener._thread is not None:
+        listener.stop()
+
+
+def _log_files(path: str) -> List[str]:
+    # 当前文件在前，轮转的文件按编号从新到旧
+    files = [path] if os.path.exists(path) else []
+    i = 1
+    while os.path.exists("{}.{}.gz".format(path, i)):
+        files.append("{}.{}.gz".format(path, i))
+        i += 1
+    return files
+
+
+def _read_lines(filename: str) -> List[str]:
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rt", encoding="utf-8", errors="replace") as f:
+        return f.readlines()
+
+
+def search(path: Union[str, List[str]],
+           limit: int = 100,
+           since: Optional[str] = None,
+           until: Optional[str] = None,
+           keyword: Optional[str] = None,
+           **fields) -> List[Dict[str, Any]]:
+    """
+    在json日志（包括已压缩的旧文件）中查找，结果从新到旧
+
+    Args:
+        path: JsonFormatter写入的日志文件，多进程部署时为各个进程的文件列表
+        limit: 最多返回的条数
+        since, until: ISO格式的时间范围，如"2021-05-01"、"2021-05-01T05:00"
+        keyword: 消息中包含的文字
+        fields: 字段需要相等，如group_id=123456
+    """
+    if not isinstance(path, str):
+        results = [r for p in path
+                   for r in search(p, limit, since, until, keyword, **fields)]
+        results.sort(key=lambda r: r.get("time", ""), reverse=True)
+        return results[:limit]
+    fields = {k: v for k, v in fields.items() if v is not None}
+    results = []
+    for filename in _log_files(path):
+        for line in reversed(_read_lines(filename)):
+            try:
+                data = json.loads(line)
+            except ValueError:
+                continue
+            if since and data.get("time", "") < since:
+                # 文件内按时间顺序写入，更早的记录都不满足
+                return results
+            if until and data.get("time", "") > until:
+                continue
+            if keyword and keyword not in data.get("message", ""):
+                continue
+            if any(str(data.get(k)) != str(v) for k, v in fields.items()):
+                continue
+            results.append(data)
+            if len(results) >= limit:
+                return results
+    return results
@@ -1,15 +1,20 @@
+import atexit
 import json
 import os
+import threading
 import time
 from hashlib import sha256
-from typing import Dict, Union
+from typing import Dict, Optional, Tuple, Union
 from urllib.parse import urljoin
 
 from aiocqhttp.api import Api
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from quart import (Quart, Response, jsonify, make_response, redirect, request,
                    send_from_directory, session, url_for)
 
+from . import ybdata
+from .auth_util import ROLE_MEMBER, get_login_user, invalidate_user
 from .templating import render_template, template_folder
 from .web_util import rand_string
 from .ybdata import MAX_TRY_TIMES, Clan_group, Clan_member, User, User_login
@@ -32,6 +37,71 @@ def _add_salt_and_hash(raw: str, salt: str):
     return sha256((raw + salt).encode()).hexdigest()
 
 
+class _LoginRecordBuffer:
+    """
+    缓存上次登录时间和地址，定时合并写入数据库
+    同一个(qqid, cookie)在两次写入之间只保留最新的一条
+    """
+
+    def __init__(self):
+        self.interval = 0  # 写入间隔（秒），0为立即写入
+        self._logins: Dict[Tuple[int, str], Tuple[int, str]] = {}
+        self._users: Dict[int, Tuple[int, str]] = {}
+        self._lock = threading.Lock()
+
+    def record_login(self, qqid, auth_cookie: str, login_time: int, ipaddr: str):
+        with self._lock:
+            self._logins[(int(qqid), auth_cookie)] = (login_time, ipaddr)
+        if self.interval <= 0:
+            self.flush()
+
+    def record_user(self, qqid, login_time: int, ipaddr: str):
+        with self._lock:
+            self._users[int(qqid)] = (login_time, ipaddr)
+        if self.interval <= 0:
+            self.flush()
+
+    def last_user_login(self, qqid) -> Optional[Tuple[int, str]]:
+        with self._lock:
+            return self._users.get(int(qqid))
+
+    def flush(self) -> int:
+        with self._lock:
+            logins, self._logins = self._logins, {}
+            users, self._users = self._users, {}
+        if not (logins or users):
+            return 0
+        queries = [
+            User_login.update({
+                User_login.last_login_time: login_time,
+                User_login.last_login_ipaddr: ipaddr,
+            }).where(
+                User_login.qqid == qqid,
+                User_login.auth_cookie == auth_cookie,
+                User_login.last_login_time < login_time,
+            ) for (qqid, auth_cookie), (login_time, ipaddr) in logins.items()
+        ] + [
+            User.update({
+                User.last_login_time: login_time,
+                User.last_login_ipaddr: ipaddr,
+            }).where(
+                User.qqid == qqid,
+                User.last_login_time < login_time,
+            ) for qqid, (login_time, ipaddr) in users.items()
+        ]
+        with User._meta.database.atomic():
+            for query in queries:
+                try:
+                    query.execute()
+                except (OSError, ValueError):
+                    # IPField无法保存的地址（如ipv6），跳过这一条
+                    continue
+        return len(logins) + len(users)
+
+
+_login_records = _LoginRecordBuffer()
+
+
 class Login:
     Passive = True
     Active = True
@@ -43,11 +113,24 @@ class Login:
                  *args, **kwargs):
         self.setting = glo_setting
         self.api = bot_api
+        _login_records.interval = glo_setting.get('login_record_interval', 60)
+        atexit.register(_login_records.flush)
 
     def jobs(self):
         trigger = CronTrigger(hour=5)
         return ((trigger, self.drop_expired_logins),)
 
+    def process_jobs(self):
+        # 登录记录缓存在各个进程中，每个进程写入自己的
+        if _login_records.interval > 0:
+            return ((IntervalTrigger(seconds=_login_records.interval),
+                     self.flush_login_records),)
+        return ()
+
+    def flush_login_records(self):
+        # 定时任务的返回值会被当作要发送的消息，这里不返回写入的记录数
+        _login_records.flush()
+
     def drop_expired_logins(self):
         # 清理过期cookie
         now = int(time.time())
@@ -130,6 +213,7 @@ class Login:
         user.login_code_expire_time = int(time.time()) + 60
         user.deleted = False
         user.save()
+        invalidate_user(user.qqid)
 
         # 链接登录
         url = urljoin(
@@ -170,6 +254,7 @@ class Login:
         user.deleted = False
         user.must_change_password = True
         user.save()
+        invalidate_user(user.qqid)
         # 踢掉过去的登录
         User_login.delete().where(
             User_login.qqid == ctx['user_id'],
@@ -261,10 +346,9 @@ class Login:
         if userlogin.auth_cookie_expire_time < now:
             raise ExceptionWithAdvice('登录已过期', advice)
 
-        userlogin.last_login_time = now
-        userlogin.last_login_ipaddr = request.headers.get(
-            'X-Real-IP', request.remote_addr)
-        userlogin.save()
+        _login_records.record_login(
+            qqid, salty_cookie, now,
+            request.headers.get('X-Real-IP', request.remote_addr))
 
         return user
 
@@ -274,10 +358,13 @@ class Login:
         为某用户设置session中的授权信息
         并自动修改中的上次登录的信息
         :param user: 用户模型
-        :param save_user: 是否自动执行user.save()
+        :param save_user: 是否记录本次登录（合并写入数据库）
         :param res: 如果需要自动更新cookie，请传入返回的response
         """
         now = int(time.time())
+        last_login = _login_records.last_user_login(user.qqid)
+        if last_login is not None and last_login[0] > user.last_login_time:
+            user.last_login_time, user.last_login_ipaddr = last_login
         session['yobot_user'] = user.qqid
         session['csrf_token'] = rand_string(16)
         session['last_login_time'] = user.last_login_time
@@ -296,10 +383,16 @@ class Login:
             res.set_cookie(LOGIN_AUTH_COOKIE_NAME,
                            new_cookie, max_age=EXPIRED_TIME)
         if save_user:
-            user.save()
+            _login_records.record_user(
+                user.qqid, user.last_login_time, user.last_login_ipaddr)
 
     def register_routes(self, app: Quart):
 
+        @app.after_serving
+        async def flush_login_records_on_shutdown():
+            # 多进程部署时工作进程用os._exit退出，不会执行atexit
+            _login_records.flush()
+
         @app.route(
             urljoin(self.setting['public_basepath'], 'login/'),
             methods=['GET', 'POST'])
@@ -406,19 +499,21 @@ class Login:
         async def yobot_user():
             if 'yobot_user' not in session:
                 return redirect(url_for('yobot_login', callback=request.path))
-            clan_groups = Clan_member.select(
-                Clan_member.group_id,
-                Clan_group.group_name,
-            ).join(
-                Clan_group,
-                on=(Clan_member.group_id == Clan_group.group_id),
-                attr='info',
-            ).where(
-                Clan_member.qqid == session['yobot_user']
-            )
+            clan_groups = []
+            for _ in ybdata.each_database():
+                clan_groups.extend(Clan_member.select(
+                    Clan_member.group_id,
+                    Clan_group.group_name,
+                ).join(
+                    Clan_group,
+                    on=(Clan_member.group_id == Clan_group.group_id),
+                    attr='info',
+                ).where(
+                    Clan_member.qqid == session['yobot_user']
+                ))
             return await render_template(
                 'user.html',
-                user=User.get_by_id(session['yobot_user']),
+                user=get_login_user(),
                 clan_groups=[{
                     'group_id': g.group_id,
                     'group_name': (getattr(getattr(g, 'info', None), 'group_name', None) or g.group_id)
@@ -431,8 +526,9 @@ class Login:
         async def yobot_user_info(qqid):
             if 'yobot_user' not in session:
                 return redirect(url_for('yobot_login', callback=request.path))
+            visitor = get_login_user()
             if session['yobot_user'] == qqid:
-                visited_user_info = User.get_by_id(session['yobot_user'])
+                visited_user_info = visitor
             else:
                 visited_user = User.get_or_none(User.qqid == qqid)
                 if visited_user is None:
@@ -441,7 +537,7 @@ class Login:
             return await render_template(
                 'user-info.html',
                 user=visited_user_info,
-                visitor=User.get_by_id(session['yobot_user']),
+                visitor=visitor,
             )
 
         @app.route(
@@ -451,8 +547,8 @@ class Login:
         async def yobot_user_info_api(qqid):
             if 'yobot_user' not in session:
                 return jsonify(code=10, message='未登录')
-            user = User.get_by_id(session['yobot_user'])
-            if user.qqid != qqid and user.authority_group >= 100:
+            user = get_login_user()
+            if user.qqid != qqid and user.authority_group >= ROLE_MEMBER:
                 return jsonify(code=11, message='权限不足')
             user_data = User.get_or_none(User.qqid == qqid)
             if user_data is None:
@@ -474,6 +570,7 @@ class Login:
                 return jsonify(code=32, message='消息体内容错误')
             user_data.nickname = new_nickname
             user_data.save()
+            invalidate_user(qqid)
             return jsonify(code=0, message='success')
 
         @app.route(
@@ -0,0 +1,431 @@
+"""
+运行指标
+
+在`<public_basepath>metrics`以Prometheus文本格式提供，不依赖外部服务；
+也可以定时把快照追加到数据目录下的metrics文件夹，供离线分析。
+
+各模块在自己的文件中定义用到的指标：
+
+    COMMANDS = metrics.Counter('yobot_commands_total', '处理的指令数', ('command',))
+    COMMANDS.inc(command='报刀')
+"""
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+from urllib.parse import urljoin
+
+from aiocqhttp.api import Api
+from apscheduler.triggers.interval import IntervalTrigger
+from quart import Quart, Response, request
+
+from . import cluster
+from .cache_util import cache_stats
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_INTERVAL = 0.5  # 事件循环延迟的采样间隔（秒）
+LAG_WINDOW = 600    # 保留最近的采样数（5分钟）
+
+_registry: Dict[str, "_Metric"] = {}
+_collectors: List[Callable[[], Iterable[Tuple[str, str, str, list]]]] = []
+
+# 一个样本：(指标名, {标签: 值}, 数值)
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, Any] = {}
+        _registry[name] = self
+
+    def _key(self, labels: Dict[str, Any]) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError("{}的标签应为{}".format(self.name, self.labelnames))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def _labels(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def remove(self, **labels) -> None:
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return [(self.name, self._labels(k), v) for k, v in self._values.items()]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    @contextlib.contextmanager
+    def track_inprogress(self, **labels):
+        """
+        进入时加一，退出时减一
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                # [各桶计数（不累计）, 总和, 次数]
+                data = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[0][i] += 1
+                    break
+            data[1] += value
+            data[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        记录with块的耗时（秒），出错时也记录
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            items = [(k, list(d[0]), d[1], d[2]) for k, d in self._values.items()]
+        result = []
+        for key, counts, total, count in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                result.append((self.name + "_bucket",
+                               dict(labels, le=_format_value(bound)), cumulative))
+            result.append((self.name + "_bucket", dict(labels, le="+Inf"), count))
+            result.append((self.name + "_sum", labels, total))
+            result.append((self.name + "_count", labels, count))
+        return result
+
+
+def collector(fn: Callable[[], Iterable[Tuple[str, str, str, list]]]):
+    """
+    登记在输出时才计算的指标
+
+    fn返回[(指标名, 类型, 说明, [({标签: 值}, 数值), ]), ]
+    """
+    _collectors.append(fn)
+    return fn
+
+
+def _families() -> List[Tuple[str, str, str, List[Sample]]]:
+    families = [(m.name, m.type, m.documentation, m.samples())
+                for m in list(_registry.values())]
+    for fn in _collectors:
+        try:
+            for name, type_, documentation, values in fn():
+                families.append((name, type_, documentation,
+                                 [(name, labels, value) for labels, value in values]))
+        except Exception as e:
+            _logger.exception("统计指标{}失败：{}".format(fn.__name__, e))
+    return families
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render_text() -> str:
+    """
+    Prometheus文本格式（0.0.4）
+    """
+    lines = []
+    for name, type_, documentation, samples in _families():
+        lines.append("# HELP {} {}".format(
+            name, documentation.replace("\\", "\\\\").replace("\n", "\\n")))
+        lines.append("# TYPE {} {}".format(name, type_))
+        for sample_name, labels, value in samples:
+            if labels:
+                label_text = ",".join('{}="{}"'.format(k, _escape(str(v)))
+                                      for k, v in labels.items())
+                lines.append("{}{{{}}} {}".format(
+                    sample_name, label_text, _format_value(value)))
+            else:
+                lines.append("{} {}".format(sample_name, _format_value(value)))
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> Dict[str, Any]:
+    """
+    所有指标的当前值，可以转为json
+    """
+    return {
+        "time": time.time(),
+        "metrics": {
+            name: {
+                "type": type_,
+                "samples": [{"name": n, "labels": labels, "value": value}
+                            for n, labels, value in samples],
+            }
+            for name, type_, _, samples in _families()
+        },
+    }
+
+
+def export(path: str) -> None:
+    """
+    把当前快照追加到文件，一行一个json
+    """
+    line = json.dumps(snapshot(), ensure_ascii=False)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+@collector
+def _cache_metrics():
+    stats = cache_stats()
+    return [
+        ("yobot_cache_hits_total", "counter", "缓存命中次数",
+         [({"cache": s["name"]}, s["hits"]) for s in stats]),
+        ("yobot_cache_misses_total", "counter", "缓存未命中次数",
+         [({"cache": s["name"]}, s["misses"]) for s in stats]),
+        ("yobot_cache_hit_ratio", "gauge", "缓存命中率",
+         [({"cache": s["name"]}, s["hit_ratio"]) for s in stats]),
+        ("yobot_cache_entries", "gauge", "缓存条目数",
+         [({"cache": s["name"]}, s["size"]) for s in stats]),
+    ]
+
+
+API_SECONDS = Histogram(
+    "yobot_api_call_seconds", "调用go-cqhttp接口的耗时", ("action",))
+API_ERRORS = Counter(
+    "yobot_api_call_errors_total", "调用go-cqhttp接口失败的次数", ("action",))
+RENDER_SECONDS = Histogram(
+    "yobot_render_seconds", "生成图片和渲染页面的耗时", ("kind",))
+LOOP_LAG = Gauge(
+    "yobot_event_loop_lag_seconds", "最近一次采样的事件循环延迟")
+LOOP_LAG_HISTOGRAM = Histogram(
+    "yobot_event_loop_lag_seconds_distribution", "事件循环延迟的分布",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5))
+API_IN_PROGRESS = Gauge(
+    "yobot_api_calls_in_progress", "正在等待go-cqhttp返回的接口调用数")
+PENDING_MESSAGES = Gauge(
+    "yobot_pending_messages", "定时任务中等待发送的消息数")
+ACCOUNT_MESSAGES = Counter(
+    "yobot_account_messages_total", "各个账号发送的消息数", ("account",))
+ACCOUNT_THROTTLED_SECONDS = Counter(
+    "yobot_account_throttled_seconds_total", "各个账号因发送速率限制等待的时间", ("account",))
+
+
+class InstrumentedApi(Api):
+    """
+    包装机器人接口，统计每个接口的耗时和失败次数
+    """
+
+    def __init__(self, api: Api):
+        self._api = api
+
+    async def call_action(self, action: str, **params) -> Any:
+        start = time.perf_counter()
+        try:
+            with API_IN_PROGRESS.track_inprogress():
+                return await self._api.call_action(action, **params)
+        except Exception:
+            API_ERRORS.inc(action=action)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, action=action)
+
+
+class LoopLagMonitor:
+    """
+    测量事件循环的调度延迟
+
+    协程每LAG_INTERVAL秒醒来一次，醒来晚了多少就是延迟；
+    另有一个看门狗线程，事件循环阻塞超过阈值时，记录事件循环线程正在执行的代码
+    """
+
+    def __init__(self, threshold: float = 0.5):
+        self.threshold = threshold  # 秒，为0时不记录
+        self.samples = deque(maxlen=LAG_WINDOW)
+        self._heartbeat = time.monotonic()
+        self._reported = None       # 已经记录过堆栈的心跳
+        self._loop_thread = None
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self._loop_thread = threading.get_ident()
+        if self.threshold > 0:
+            threading.Thread(target=self._watch, name="yobot-loop-watchdog",
+                             daemon=True).start()
+        while True:
+            start = loop.time()
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = max(0.0, loop.time() - start - LAG_INTERVAL)
+            self._heartbeat = time.monotonic()
+            self.samples.append(lag)
+            LOOP_LAG.set(lag)
+            LOOP_LAG_HISTOGRAM.observe(lag)
+            if lag > self.threshold > 0:
+                _logger.warning("事件循环延迟{:.0f}ms".format(lag * 1000))
+
+    def _watch(self):
+        while True:
+            time.sleep(min(self.threshold / 2, LAG_INTERVAL))
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - LAG_INTERVAL
+            if blocked <= self.threshold or self._reported == heartbeat:
+                continue
+            # 每次阻塞只记录一次
+            self._reported = heartbeat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            _logger.warning("事件循环已阻塞{:.0f}ms，正在执行：\n{}".format(
+                blocked * 1000, "".join(traceback.format_stack(frame))))
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        最近LAG_WINDOW次采样的统计，单位为毫秒
+        """
+        samples = sorted(self.samples)
+        if not samples:
+            return {"samples": 0}
+
+        def percentile(p):
+            return round(samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000, 1)
+        return {
+            "samples": len(samples),
+            "current_ms": round(self.samples[-1] * 1000, 1),
+            "max_ms": round(samples[-1] * 1000, 1),
+            "p50_ms": percentile(50),
+            "p95_ms": percentile(95),
+            "p99_ms": percentile(99),
+        }
+
+
+LAG_MONITOR = LoopLagMonitor()
+
+
+class Metrics:
+    Passive = False
+    Active = True
+    Request = True
+
+    def __init__(self,
+                 glo_setting: Dict[str, Any],
+                 *args, **kwargs):
+        self.setting = glo_setting
+        self.export_dir = os.path.join(glo_setting["dirname"], "metrics")
+        LAG_MONITOR.threshold = glo_setting.get("loop_lag_warn_ms", 500) / 1000
+        self._lag_task = None
+
+    def _authorized(self) -> bool:
+        token = self.setting.get("metrics_token", "")
+        if not token:
+            # 没有设置token时只允许本机访问
+            return request.remote_addr in ("127.0.0.1", "::1", "localhost")
+        auth = request.headers.get("Authorization", "")
+        return auth == "Bearer " + token or request.args.get("token") == token
+
+    def export_file(self) -> str:
+        os.makedirs(self.export_dir, exist_ok=True)
+        # 指标是各个进程自己的，多进程部署时分别导出
+        path = cluster.worker_filename(os.path.join(self.export_dir, "metrics-{}.jsonl".format(
+            datetime.date.today().strftime("%Y%m%d"))))
+        export(path)
+        return path
+
+    def jobs(self):
+        return ()
+
+    def process_jobs(self):
+        minutes = self.setting.get("metrics_export_minutes", 0)
+        if minutes <= 0:
+            return ()
+
+        def export_job():
+            try:
+                self.export_file()
+            except Exception as e:
+                _logger.exception("导出指标失败：{}".format(e))
+        return ((IntervalTrigger(minutes=minutes), export_job),)
+
+    def register_routes(self, app: Quart):
+
+        @app.before_serving
+        async def start_loop_lag_monitor():
+            self._lag_task = asyncio.ensure_future(LAG_MONITOR.run())
+
+        @app.route(
+            urljoin(self.setting["public_basepath"], "metrics"),
+            methods=["GET"])
+        async def yobot_metrics():
+            if not self._authorized():
+                return "403 Forbidden", 403
+            return Response(render_text(),
+                            content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -4,8 +4,12 @@ import os
 from urllib.parse import urljoin
 
 from playhouse.shortcuts import model_to_dict
-from quart import Quart, jsonify, redirect, request, session, url_for
+from quart import Quart, jsonify, request, session
 
+from .auth_util import (ROLE_ADMIN, ROLE_OWNER, get_login_user, invalidate_group,
+                        invalidate_user, require_role)
+from . import cluster, sql_profiler, stack_sampler, ybdata
+from .db_executor import run_in_db, run_in_reader
 from .templating import render_template
 from .ybdata import Clan_group, User
 
@@ -31,6 +35,11 @@ class Setting:
                  *args, **kwargs):
         self.setting = glo_setting
         self.boss_id_name = boss_id_name
+        cluster.subscribe('setting', self._apply_setting)
+
+    def _apply_setting(self, setting):
+        # 其他进程在后台修改了设置，启动时读取的设置仍然要重启后生效
+        self.setting.update(setting)
 
     def _get_users_json(self, req_querys: dict):
         querys = []
@@ -65,44 +74,32 @@ class Setting:
             'data': [model_to_dict(u, only=_returned_query_fileds) for u in users],
         })
 
+    def _profiler_status(self, status):
+        if status is not None and status['file']:
+            status['url'] = urljoin(
+                self.setting['public_address'],
+                '{}output/{}'.format(self.setting['public_basepath'], status['file']))
+        if status is not None:
+            # 采样只在处理请求的进程中进行
+            status['worker'] = cluster.worker_id()
+        return status
+
     def register_routes(self, app: Quart):
 
         @app.route(
             urljoin(self.setting['public_basepath'], 'admin/setting/'),
             methods=['GET'])
+        @require_role(ROLE_OWNER)
         async def yobot_setting():
-            if 'yobot_user' not in session:
-                return redirect(url_for('yobot_login', callback=request.path))
-            user = User.get_by_id(session['yobot_user'])
-            if user.authority_group >= 10:
-                if not user.authority_group >= 100:
-                    uathname = '公会战管理员'
-                else:
-                    uathname = '成员'
-                return await render_template(
-                    'unauthorized.html',
-                    limit='主人',
-                    uath=uathname,
-                )
             return await render_template(
                 'admin/setting.html',
             )
 
         @app.route(
             urljoin(self.setting['public_basepath'], 'admin/setting/api/'),
-            methods=['GET', 'PUT'])
+            methods=['GET', 'PUT', 'POST'])
+        @require_role(ROLE_ADMIN, api=True)
         async def yobot_setting_api():
-            if 'yobot_user' not in session:
-                return jsonify(
-                    code=10,
-                    message='Not logged in',
-                )
-            user = User.get_by_id(session['yobot_user'])
-            if user.authority_group >= 100:
-                return jsonify(
-                    code=11,
-                    message='Insufficient authority',
-                )
             if request.method == 'GET':
                 settings = self.setting.copy()
                 boss_id_name = self.boss_id_name.copy()
@@ -131,6 +128,7 @@ class Setting:
                         message='Invalid payload',
                     )
                 self.setting.update(new_setting)
+                cluster.publish('setting', setting=new_setting)
                 save_setting = self.setting.copy()
                 del save_setting['dirname']
                 del save_setting['verinfo']
@@ -142,42 +140,59 @@ class Setting:
                     code=0,
                     message='success',
                 )
+            elif request.method == 'POST':
+                # 采样分析，只有主人可以使用
+                if get_login_user().authority_group > ROLE_OWNER:
+                    return jsonify(
+                        code=11,
+                        message='Insufficient authority',
+                    )
+                req = await request.get_json()
+                if req is None:
+                    return jsonify(
+                        code=30,
+                        message='Invalid payload',
+                    )
+                if req.get('csrf_token') != session['csrf_token']:
+                    return jsonify(
+                        code=15,
+                        message='Invalid csrf_token',
+                    )
+                action = req.get('action')
+                if action == 'start_profiler':
+                    try:
+                        status = stack_sampler.start(
+                            req.get('seconds', 30),
+                            req.get('interval_ms', 10) / 1000,
+                            os.path.join(self.setting['dirname'], 'output'),
+                        )
+                    except (RuntimeError, TypeError, ValueError) as e:
+                        return jsonify(code=31, message=str(e))
+                    return jsonify(code=0, profiler=self._profiler_status(status))
+                if action == 'stop_profiler':
+                    status = await asyncio.get_event_loop().run_in_executor(
+                        None, stack_sampler.stop)
+                    return jsonify(code=0, profiler=self._profiler_status(status))
+                if action == 'get_profiler':
+                    return jsonify(
+                        code=0,
+                        profiler=self._profiler_status(stack_sampler.status()),
+                    )
+                return jsonify(code=32, message='unknown action')
 
         @app.route(
             urljoin(self.setting['public_basepath'], 'admin/pool-setting/'),
             methods=['GET'])
+        @require_role(ROLE_OWNER)
         async def yobot_pool_setting():
-            if 'yobot_user' not in session:
-                return redirect(url_for('yobot_login', callback=request.path))
-            user = User.get_by_id(session['yobot_user'])
-            if user.authority_group >= 10:
-                if not user.authority_group >= 100:
-                    uathname = '公会战管理员'
-                else:
-                    uathname = '成员'
-                return await render_template(
-                    'unauthorized.html',
-                    limit='主人',
-                    uath=uathname,
-                )
             return await render_template('admin/pool-setting.html')
 
         @app.route(
             urljoin(self.setting['public_basepath'],
                     'admin/pool-setting/api/'),
             methods=['GET', 'PUT'])
+        @require_role(ROLE_OWNER, api=True)
         async def yobot_pool_setting_api():
-            if 'yobot_user' not in session:
-                return jsonify(
-                    code=10,
-                    message='Not logged in',
-                )
-            user = User.get_by_id(session['yobot_user'])
-            if user.authority_group >= 10:
-                return jsonify(
-                    code=11,
-                    message='Insufficient authority',
-                )
             if request.method == 'GET':
                 with open(os.path.join(self.setting['dirname'], 'pool3.json'),
                           'r', encoding='utf-8') as f:
@@ -211,37 +226,16 @@ class Setting:
         @app.route(
             urljoin(self.setting['public_basepath'], 'admin/users/'),
             methods=['GET'])
+        @require_role(ROLE_OWNER)
         async def yobot_users_managing():
-            if 'yobot_user' not in session:
-                return redirect(url_for('yobot_login', callback=request.path))
-            user = User.get_by_id(session['yobot_user'])
-            if user.authority_group >= 10:
-                if not user.authority_group >= 100:
-                    uathname = '公会战管理员'
-                else:
-                    uathname = '成员'
-                return await render_template(
-                    'unauthorized.html',
-                    limit='主人',
-                    uath=uathname,
-                )
             return await render_template('admin/users.html')
 
         @app.route(
             urljoin(self.setting['public_basepath'], 'admin/users/api/'),
             methods=['POST'])
+        @require_role(ROLE_OWNER, api=True)
         async def yobot_users_api():
-            if 'yobot_user' not in session:
-                return jsonify(
-                    code=10,
-                    message='Not logged in',
-                )
-            user = User.get_by_id(session['yobot_user'])
-            if user.authority_group >= 10:
-                return jsonify(
-                    code=11,
-                    message='Insufficient authority',
-                )
+            user = get_login_user()
             try:
                 req = await request.get_json()
                 if req is None:
@@ -256,8 +250,7 @@ class Setting:
                     )
                 action = req['action']
                 if action == 'get_data':
-                    return await asyncio.get_event_loop().run_in_executor(
-                        None,
+                    return await run_in_reader(
                         self._get_users_json,
                         req['querys'],
                     )
@@ -282,6 +275,7 @@ class Setting:
                     for key in data.keys():
                         setattr(m_user, key, data[key])
                     m_user.save()
+                    invalidate_user(m_user.qqid)
                     return jsonify(code=0, message='success')
                 elif action == 'delete_user':
                     user = User.get_or_none(qqid=req['data']['qqid'])
@@ -292,6 +286,7 @@ class Setting:
                     user.password = None
                     user.deleted = True
                     user.save()
+                    invalidate_user(user.qqid)
                     return jsonify(code=0, message='success')
                 else:
                     return jsonify(code=32, message='unknown action')
@@ -301,37 +296,15 @@ class Setting:
         @app.route(
             urljoin(self.setting['public_basepath'], 'admin/groups/'),
             methods=['GET'])
+        @require_role(ROLE_OWNER)
         async def yobot_groups_managing():
-            if 'yobot_user' not in session:
-                return redirect(url_for('yobot_login', callback=request.path))
-            user = User.get_by_id(session['yobot_user'])
-            if user.authority_group >= 10:
-                if not user.authority_group >= 100:
-                    uathname = '公会战管理员'
-                else:
-                    uathname = '成员'
-                return await render_template(
-                    'unauthorized.html',
-                    limit='主人',
-                    uath=uathname,
-                )
             return await render_template('admin/groups.html')
 
         @app.route(
             urljoin(self.setting['public_basepath'], 'admin/groups/api/'),
             methods=['POST'])
+        @require_role(ROLE_OWNER, api=True)
         async def yobot_groups_api():
-            if 'yobot_user' not in session:
-                return jsonify(
-                    code=10,
-                    message='Not logged in',
-                )
-            user = User.get_by_id(session['yobot_user'])
-            if user.authority_group >= 10:
-                return jsonify(
-                    code=11,
-                    message='Insufficient authority',
-                )
             try:
                 req = await request.get_json()
                 if req is None:
@@ -347,26 +320,70 @@ class Setting:
                 action = req['action']
                 if action == 'get_data':
                     groups = []
-                    for group in Clan_group.select().where(
-                        Clan_group.deleted == False,
-                    ):
-                        groups.append({
-                            'group_id': group.group_id,
-                            'group_name': group.group_name,
-                            'game_server': group.game_server,
-                        })
+                    for _ in ybdata.each_database():
+                        for group in Clan_group.select().where(
+                            Clan_group.deleted == False,
+                        ):
+                            groups.append({
+                                'group_id': group.group_id,
+                                'group_name': group.group_name,
+                                'game_server': group.game_server,
+                            })
                     return jsonify(code=0, data=groups)
                 if action == 'drop_group':
-                    User.update({
-                        User.clan_group_id: None,
-                    }).where(
-                        User.clan_group_id == req['group_id'],
-                    ).execute()
-                    Clan_group.delete().where(
-                        Clan_group.group_id == req['group_id'],
-                    ).execute()
+                    group_id = req['group_id']
+
+                    def drop_group():
+                        User.update({
+                            User.clan_group_id: None,
+                        }).where(
+                            User.clan_group_id == group_id,
+                        ).execute()
+                        with ybdata.group_scope(group_id):
+                            Clan_group.delete().where(
+                                Clan_group.group_id == group_id,
+                            ).execute()
+                    # 公会数据只在数据库线程中写入
+                    await run_in_db(drop_group)
+                    invalidate_group(group_id)
                     return jsonify(code=0, message='ok')
                 else:
                     return jsonify(code=32, message='unknown action')
             except KeyError as e:
                 return jsonify(code=31, message=str(e))
+
+        @app.route(
+            urljoin(self.setting['public_basepath'], 'admin/sql-profile/'),
+            methods=['GET'])
+        @require_role(ROLE_OWNER)
+        async def yobot_sql_profile():
+            return await render_template('admin/sql-profile.html')
+
+        @app.route(
+            urljoin(self.setting['public_basepath'], 'admin/sql-profile/api/'),
+            methods=['POST'])
+        @require_role(ROLE_OWNER, api=True)
+        async def yobot_sql_profile_api():
+            req = await request.get_json()
+            if req is None:
+                return jsonify(
+                    code=30,
+                    message='Invalid payload',
+                )
+            if req.get('csrf_token') != session['csrf_token']:
+                return jsonify(
+                    code=15,
+                    message='Invalid csrf_token',
+                )
+            action = req.get('action')
+            if action == 'get_data':
+                return jsonify(
+                    code=0,
+                    enabled=sql_profiler.enabled(),
+                    data=sql_profiler.summary(),
+                    worker=cluster.worker_id(),
+                )
+            if action == 'reset':
+                sql_profiler.reset()
+                return jsonify(code=0, message='ok')
+            return jsonify(code=32, message='unknown action')
@@ -0,0 +1,193 @@
+"""
+SQL查询分析（调试用）
+
+按HTTP请求和聊天指令统计数据库语句的条数、耗时，以及同一语句（去掉参数后）
+的重复次数，用于发现循环中逐行查询（N+1）的代码。
+超过阈值的请求/指令会记录到日志，汇总结果在管理页面`admin/sql-profile/`查看，
+多进程部署时每个进程分别统计，页面只显示处理请求的进程的结果。
+
+配置项sql_profiler为false时只有一次ContextVar读取的开销。
+"""
+import contextlib
+import contextvars
+import logging
+import re
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+_logger = logging.getLogger(__name__)
+
+MAX_FINGERPRINT_LENGTH = 300  # 保存的语句长度上限
+MAX_SCOPES = 500              # 最多统计的请求/指令种类
+
+_enabled = False
+_max_queries = 50
+_max_repeats = 10
+
+_current: "contextvars.ContextVar[Optional[QueryProfile]]" = contextvars.ContextVar(
+    "yobot_sql_profile", default=None)
+
+_summary: Dict[str, Dict[str, Any]] = {}
+_summary_lock = threading.Lock()
+
+_in_list = re.compile(r"\((?:\s*(?:\?|%s)\s*,)+\s*(?:\?|%s)\s*\)")
+_spaces = re.compile(r"\s+")
+
+
+def configure(setting):
+    """
+    Args:
+        setting: 全局配置，读取sql_profiler、sql_profiler_max_queries、sql_profiler_max_repeats
+    """
+    global _enabled, _max_queries, _max_repeats
+    _enabled = bool(setting.get("sql_profiler", False))
+    _max_queries = setting.get("sql_profiler_max_queries", 50)
+    _max_repeats = setting.get("sql_profiler_max_repeats", 10)
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def fingerprint(sql: str) -> str:
+    """
+    去掉参数个数的差异，IN (?, ?, ?)和IN (?, ?)视为同一语句
+    """
+    sql = _spaces.sub(" ", sql.strip())
+    sql = _in_list.sub("(?...)", sql)
+    return sql[:MAX_FINGERPRINT_LENGTH]
+
+
+class QueryProfile:
+    """
+    一个请求或指令中执行的语句
+
+    数据库线程中的查询也会记录到发起它的请求，所以要加锁
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queries = 0
+        self.seconds = 0.0
+        self.fingerprints: Counter = Counter()
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def record(self, sql: str, seconds: float) -> None:
+        fp = fingerprint(sql)
+        with self._lock:
+            if self.finished:
+                # 请求结束后，它创建的后台任务执行的查询不再计入
+                return
+            self.queries += 1
+            self.seconds += seconds
+            self.fingerprints[fp] += 1
+
+    def worst_repeat(self):
+        """
+        Returns:
+            (重复最多的语句, 次数)，没有查询时为(None, 0)
+        """
+        with self._lock:
+            common = self.fingerprints.most_common(1)
+        return common[0] if common else (None, 0)
+
+
+def record(sql: str, seconds: float) -> None:
+    """
+    由数据库在每条语句执行后调用
+    """
+    profile = _current.get()
+    if profile is not None:
+        profile.record(sql, seconds)
+
+
+def start(name: str):
+    """
+    开始统计，返回用于finish的token；未启用时返回None
+    """
+    if not _enabled:
+        return None
+    profile = QueryProfile(name)
+    return profile, _current.set(profile)
+
+
+def finish(token) -> Optional[QueryProfile]:
+    if token is None:
+        return None
+    profile, var_token = token
+    try:
+        _current.reset(var_token)
+    except ValueError:
+        # 在其他上下文中结束（如quart的teardown），只需清除
+        _current.set(None)
+    with profile._lock:
+        profile.finished = True
+    _add_to_summary(profile)
+    return profile
+
+
+@contextlib.contextmanager
+def profile(name: str):
+    """
+    with块中执行的语句计入name
+    """
+    token = start(name)
+    try:
+        yield
+    finally:
+        finish(token)
+
+
+def _add_to_summary(profile: QueryProfile) -> None:
+    fp, repeats = profile.worst_repeat()
+    offender = profile.queries > _max_queries or repeats > _max_repeats
+    if offender:
+        _logger.warning("{}执行了{}条语句，耗时{:.1f}ms，重复最多的语句执行了{}次：{}".format(
+            profile.name, profile.queries, profile.seconds * 1000, repeats, fp))
+    with _summary_lock:
+        item = _summary.get(profile.name)
+        if item is None:
+            if len(_summary) >= MAX_SCOPES:
+                return
+            item = _summary[profile.name] = {
+                "name": profile.name,
+                "count": 0,
+                "queries": 0,
+                "max_queries": 0,
+                "seconds": 0.0,
+                "max_seconds": 0.0,
+                "offenders": 0,
+                "worst_statement": None,
+                "worst_repeats": 0,
+            }
+        item["count"] += 1
+        item["queries"] += profile.queries
+        item["max_queries"] = max(item["max_queries"], profile.queries)
+        item["seconds"] += profile.seconds
+        item["max_seconds"] = max(item["max_seconds"], profile.seconds)
+        if offender:
+            item["offenders"] += 1
+        if repeats > item["worst_repeats"]:
+            item["worst_statement"] = fp
+            item["worst_repeats"] = repeats
+
+
+def summary() -> List[Dict[str, Any]]:
+    """
+    各请求/指令的统计，平均语句数多的在前
+    """
+    with _summary_lock:
+        items = [dict(item) for item in _summary.values()]
+    for item in items:
+        item["avg_queries"] = item["queries"] / item["count"]
+        item["avg_ms"] = item["seconds"] * 1000 / item["count"]
+        item["max_ms"] = item["max_seconds"] * 1000
+    items.sort(key=lambda i: (i["avg_queries"], i["worst_repeats"]), reverse=True)
+    return items
+
+
+def reset() -> None:
+    with _summary_lock:
+        _summary.clear()
@@ -0,0 +1,150 @@
+"""
+采样分析器
+
+在运行中的进程里按固定间隔采集所有线程的调用栈，不需要重启到cProfile下。
+结果写成折叠栈格式（一行一个调用栈：`线程;函数;函数 次数`），
+可以直接交给flamegraph.pl、speedscope等生成火焰图。
+
+采样在后台线程中进行，只读取各线程当前的栈帧，间隔10ms时开销很小。
+多进程部署时只采样处理这次请求的进程，状态中的worker是进程名称。
+"""
+import collections
+import datetime
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Optional
+
+_logger = logging.getLogger(__name__)
+
+MAX_SECONDS = 300       # 一次最多采样的时间
+MIN_INTERVAL = 0.001    # 最小采样间隔（秒）
+_THREAD_NAME = "yobot-stack-sampler"
+
+_lock = threading.Lock()
+_current: Optional["Sampler"] = None  # 正在进行或最近一次的采样
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return "{} ({}:{})".format(
+        code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class Sampler:
+    def __init__(self, seconds: float, interval: float, output_dir: str):
+        self.seconds = seconds
+        self.interval = interval
+        self.output_dir = output_dir
+        self.started = time.time()
+        self.samples = 0
+        self.filename = None
+        self.error = None
+        self.stacks: collections.Counter = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=_THREAD_NAME, daemon=True)
+
+    def _sample(self, me: int, names: Dict[int, str]) -> None:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def _run(self):
+        me = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        next_sample = time.monotonic()
+        names_time = 0
+        try:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                if now - names_time > 1:
+                    # 线程名每秒更新一次
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                    names_time = now
+                self._sample(me, names)
+                next_sample += self.interval
+                self._stop.wait(max(0, next_sample - time.monotonic()))
+            self.filename = self._write()
+            _logger.info("采样分析完成，{}次采样，保存到{}".format(self.samples, self.filename))
+        except Exception as e:
+            self.error = repr(e)
+            _logger.exception("采样分析失败：{}".format(e))
+
+    def _write(self) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        filename = "profile-{}.folded".format(
+            datetime.datetime.fromtimestamp(self.started).strftime("%Y%m%d-%H%M%S"))
+        with open(os.path.join(self.output_dir, filename), "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+        return filename
+
+    @property
+    def running(self) -> bool:
+        return self._thread.is_alive()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "started": int(self.started),
+            "seconds": self.seconds,
+            "interval_ms": round(self.interval * 1000, 1),
+            "samples": self.samples,
+            "file": self.filename,
+            "error": self.error,
+        }
+
+
+def start(seconds: float, interval: float, output_dir: str) -> Dict[str, Any]:
+    """
+    开始采样，seconds秒后把结果写入output_dir
+
+    Args:
+        seconds: 采样时间，不超过MAX_SECONDS
+        interval: 采样间隔（秒）
+
+    Raises:
+        RuntimeError: 已经在采样
+    """
+    global _current
+    seconds = min(max(float(seconds), 0.1), MAX_SECONDS)
+    interval = max(float(interval), MIN_INTERVAL)
+    with _lock:
+        if _current is not None and _current.running:
+            raise RuntimeError("正在采样，{}秒后结束".format(
+                int(_current.started + _current.seconds - time.time())))
+        _current = Sampler(seconds, interval, output_dir)
+        _current._thread.start()
+    return _current.status()
+
+
+def stop() -> Optional[Dict[str, Any]]:
+    """
+    提前结束采样，已采集的结果同样会写入文件
+    """
+    with _lock:
+        sampler = _current
+    if sampler is None:
+        return None
+    sampler._stop.set()
+    if sampler._thread.ident is not None:
+        sampler._thread.join()
+    return sampler.status()
+
+
+def status() -> Optional[Dict[str, Any]]:
+    """
+    正在进行或最近一次采样的状态，没有采样过时为None
+    """
+    return _current and _current.status()
@@ -3,6 +3,8 @@ import os
 import jinja2
 from quart import session, url_for 
 
+from . import metrics
+
 static_folder = os.path.abspath(os.path.join(
     os.path.dirname(__file__), '../public/static'))
 template_folder = os.path.abspath(os.path.join(
@@ -26,5 +28,6 @@ _env.globals['url_for'] = _vertioned_url_for
 
 
 async def render_template(template, **context):
-    t = _env.get_template(template)
-    return await t.render_async(**context)
+    with metrics.RENDER_SECONDS.time(kind='template'):
+        t = _env.get_template(template)
+        return await t.render_async(**context)
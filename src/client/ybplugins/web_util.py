@@ -7,6 +7,7 @@ import aiohttp
 import requests
 from quart import Quart, jsonify, request, send_file, session
 
+from .cache_util import cached_func
 from .yobot_exceptions import ServerError
 
 _rand_string_chaset = (string.ascii_uppercase +
@@ -21,22 +22,7 @@ def rand_string(n=16):
     )
 
 
-def async_cached_func(maxsize=64):
-    cache = {}
-
-    def decorator(fn):
-        async def wrapper(*args, nocache=False):  # args must be hashable
-            key = tuple(args)
-            if nocache or (key not in cache):
-                if len(cache) >= maxsize:
-                    del cache[cache.keys().next()]
-                cache[key] = await fn(*args)
-            return cache[key]
-        return wrapper
-    return decorator
-
-
-@async_cached_func(128)
+@cached_func(128, ttl=86400)
 async def _ip_location(ip):
     async with aiohttp.request("GET", url=f'http://freeapi.ipip.net/{ip}') as response:
         if response.status != 200:
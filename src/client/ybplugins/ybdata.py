@@ -1,20 +1,117 @@
+import collections
+import contextlib
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
 from peewee import *
-from playhouse.migrate import SqliteMigrator, migrate
+from peewee import Context, Node
+from playhouse.db_url import parse
+from playhouse.migrate import Operation, SchemaMigrator, SqliteMigrator
+from playhouse.pool import PooledMySQLDatabase, PooledPostgresqlDatabase
 
+from . import metrics, sql_profiler
 from .web_util import rand_string
 
-db_mode = True  # True为本地（原），Flase为为改为mysql（需要在第15行配置使用）
-
-_version = 1  # 目前版本
 MAX_TRY_TIMES = 5
 
-if db_mode:
-    _db = SqliteDatabase(None)
-else:
-    _db = MySQLDatabase(
-        "", host="", user="", passwd="", port=3306
-        # 第一个填写你的数据库名
-    )
+_logger = logging.getLogger(__name__)
+
+
+class _ShardRouter(DatabaseProxy):
+    """
+    在group_scope中时转到该公会的数据库，否则是主库
+
+    所有模型都绑定到这个代理，启用分库后查询按当前上下文选择数据库
+    """
+    __slots__ = ("_global",)
+
+    @property
+    def obj(self):
+        shard = _current_shard.get()
+        return self._global if shard is None else shard
+
+    @obj.setter
+    def obj(self, value):
+        self._global = value
+
+    @property
+    def global_database(self):
+        return self._global
+
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+
+
+# 当前上下文使用的公会数据库，None为主库
+# contextvars会随db_executor和asyncio任务传递
+_current_shard: "contextvars.ContextVar[Optional[Database]]" = contextvars.ContextVar(
+    "yobot_db_shard", default=None)
+
+# 实际使用的数据库在init时根据配置决定
+_db = _ShardRouter()
+
+QUERY_SECONDS = metrics.Histogram(
+    "yobot_db_query_seconds", "数据库语句的执行耗时", ("statement",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+QUERY_ERRORS = metrics.Counter(
+    "yobot_db_query_errors_total", "数据库语句执行出错的次数", ("statement",))
+
+
+class _TimedDatabase:
+    # 按语句类型（SELECT、INSERT等）统计次数和耗时，并交给sql_profiler
+    def execute_sql(self, sql, *args, **kwargs):
+        statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ""
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        except Exception:
+            QUERY_ERRORS.inc(statement=statement)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            QUERY_SECONDS.observe(elapsed, statement=statement)
+            sql_profiler.record(sql, elapsed)
+
+
+class TimedSqliteDatabase(_TimedDatabase, SqliteDatabase):
+    # 事务开始时就取得写锁：数据库线程之外还有事件循环中的写入（登录记录等），多进程部署时还有其他进程，
+    # 普通的BEGIN先读后写时，其他连接先提交会直接失败（SQLITE_BUSY，不会等待重试）
+    # 只读连接（db_executor的run_in_reader）不能取得写锁，仍使用普通的BEGIN
+    lock_type = "IMMEDIATE"
+
+    def begin(self, lock_type=None):
+        if lock_type is None and self.lock_type is not None and not self.connection().execute(
+                "PRAGMA query_only").fetchone()[0]:
+            lock_type = self.lock_type
+        return super().begin(lock_type)
+
+
+class _ShardDatabase(TimedSqliteDatabase):
+    # 一个公会的数据库，每个连接都ATTACH主库
+    def __init__(self, filename, global_filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.global_filename = global_filename
+
+    def _add_conn_hooks(self, conn):
+        super()._add_conn_hooks(conn)
+        conn.execute("ATTACH DATABASE ? AS " + GLOBAL_SCHEMA, (self.global_filename,))
+
+    def execute_sql(self, sql, *args, **kwargs):
+        _touch_shard(self)
+        return super().execute_sql(sql, *args, **kwargs)
+
+
+class TimedPooledMySQLDatabase(_TimedDatabase, PooledMySQLDatabase):
+    pass
+
+
+class TimedPooledPostgresqlDatabase(_TimedDatabase, PooledPostgresqlDatabase):
+    pass
 
 
 class _BaseModel(Model):
@@ -132,16 +229,58 @@ class Clan_challenge(_BaseModel):
     challenge_damage = BigIntegerField()  # 对boss造成的伤害
     is_continue = BooleanField()  # 是否是补偿刀
     message = TextField(null=True)  # 信息
-    behalf = IntegerField(null=True)  # 代刀人
+    behalf = BigIntegerField(null=True)  # 代刀人
 
     class Meta:
         indexes = (
-            (("bid", "gid"), False),
             (("qqid", "challenge_pcrdate"), False),
             (("bid", "gid", "challenge_pcrdate"), False),
+            (("gid", "bid", "qqid", "challenge_pcrdate"), False),  # 出刀次数检查
+            (("gid", "bid", "cid"), False),  # 上一个出刀记录
         )
 
 
+# 已移到冷存档的会战，这些档案号的出刀记录不在主库中
+class Clan_challenge_archive(_BaseModel):
+    group_id = BigIntegerField()
+    battle_id = IntegerField()  # 档案号
+    record_count = IntegerField(default=0)
+    archive_time = BigIntegerField(default=0)
+
+    class Meta:
+        primary_key = CompositeKey("group_id", "battle_id")
+
+
+# 每个成员每天的出刀汇总，pcr日期切换后由前一天的出刀记录生成
+class Clan_daily(_BaseModel):
+    gid = BigIntegerField()  # 公会qq群号
+    bid = IntegerField()  # 档案号
+    challenge_pcrdate = IntegerField()  # 日期
+    qqid = BigIntegerField()  # 成员qq号
+    challenges = IntegerField(default=0)  # 出刀记录数
+    blades = IntegerField(default=0)  # 完整刀数（非尾刀和补偿刀）
+    damage = BigIntegerField(default=0)  # 总伤害
+    sl = IntegerField(default=0)  # 当天是否SL
+
+    class Meta:
+        primary_key = CompositeKey("gid", "challenge_pcrdate", "bid", "qqid")
+
+
+# 每个成员每期会战对每个boss的出刀汇总，报刀和撤销时同步更新，冷存档后仍然保留
+class Clan_member_history(_BaseModel):
+    gid = BigIntegerField()  # 公会qq群号
+    bid = IntegerField()  # 档案号
+    qqid = BigIntegerField()  # 成员qq号
+    boss_num = SmallIntegerField()  # 几王
+    challenges = IntegerField(default=0)  # 出刀记录数
+    blades = IntegerField(default=0)  # 完整刀数（非尾刀和补偿刀）
+    damage = BigIntegerField(default=0)  # 总伤害
+    first_pcrdate = IntegerField(default=0)  # 第一次出刀的日期
+
+    class Meta:
+        primary_key = CompositeKey("gid", "bid", "qqid", "boss_num")
+
+
 class Character(_BaseModel):
     chid = IntegerField(primary_key=True)
     name = CharField(max_length=64)
@@ -158,45 +297,527 @@ class DB_schema(_BaseModel):
     value = TextField()
 
 
-def init(sqlite_filename):
-    if db_mode:
-        _db.init(
-            database=sqlite_filename,
-            pragmas={
-                "journal_mode": "wal",
-                "cache_size": -1024 * 64,
-            },
-        )
+_tables = [
+    DB_schema,
+    Admin_key,
+    User,
+    User_login,
+    Clan_group,
+    Clan_member,
+    Clan_group_backups,
+    Clan_challenge,
+    Clan_challenge_archive,
+    Clan_daily,
+    Clan_member_history,
+    Character,
+]
+
+# 分库时放在公会数据库中的表，及其群号字段
+_shard_keys = {
+    Clan_group: "group_id",
+    Clan_member: "group_id",
+    Clan_group_backups: "group_id",
+    Clan_challenge: "gid",
+    Clan_daily: "gid",
+    Clan_member_history: "gid",
+}
+
+
+def member_history_insert(model, *expressions):
+    """
+    按(公会, 档案号, 成员, boss)汇总出刀记录，写入Clan_member_history
+
+    Args:
+        model: 出刀记录表（主库或冷存档）
+        expressions: 附加条件
+    """
+    blade = Case(None, [((model.boss_health_remain > 0) | (model.is_continue == True), 1)], 0)
+    query = model.select(
+        model.gid,
+        model.bid,
+        model.qqid,
+        model.boss_num,
+        fn.COUNT(model.cid),
+        fn.SUM(blade),
+        fn.SUM(model.challenge_damage),
+        fn.MIN(model.challenge_pcrdate),
+    ).group_by(model.gid, model.bid, model.qqid, model.boss_num)
+    if expressions:
+        query = query.where(*expressions)
+    return Clan_member_history.insert_from(query, [
+        Clan_member_history.gid,
+        Clan_member_history.bid,
+        Clan_member_history.qqid,
+        Clan_member_history.boss_num,
+        Clan_member_history.challenges,
+        Clan_member_history.blades,
+        Clan_member_history.damage,
+        Clan_member_history.first_pcrdate,
+    ])
+
+
+# 公会数据库中补建这些表后，从已有数据生成
+_shard_backfills = {
+    Clan_member_history: lambda: member_history_insert(Clan_challenge),
+}
+
+
+_SQLITE_PRAGMAS = {
+    # 必须在建表和开启wal之前设置，只对新建的数据库生效
+    "auto_vacuum": "incremental",
+    "journal_mode": "wal",
+    "cache_size": -1024 * 64,
+}
+
+
+def _create_database(sqlite_filename, config):
+    """
+    根据配置创建数据库连接
+
+    Args:
+        sqlite_filename: sqlite数据库文件路径，仅sqlite使用
+        config: 全局配置，读取db_backend、db_url、db_pool_size、db_stale_timeout
+    """
+    backend = config.get("db_backend", "sqlite").lower()
+    if backend == "sqlite":
+        # sqlite每个线程一个连接即可，不需要连接池
+        return TimedSqliteDatabase(sqlite_filename, pragmas=_SQLITE_PRAGMAS)
+
+    if not config.get("db_url"):
+        raise ValueError("使用{}数据库需要填写db_url".format(backend))
+    params = parse(config["db_url"])
+    pool_params = {
+        "max_connections": config.get("db_pool_size", 8),
+        "stale_timeout": config.get("db_stale_timeout", 300),
+    }
+    if backend == "mysql":
+        params.setdefault("charset", "utf8mb4")
+        return TimedPooledMySQLDatabase(**params, **pool_params)
+    if backend in ("postgres", "postgresql"):
+        return TimedPooledPostgresqlDatabase(**params, **pool_params)
+    raise ValueError("不支持的数据库类型：{}".format(backend))
+
+
+def sqlite_path():
+    """
+    sqlite数据库文件路径，不是sqlite时返回None
+    """
+    if isinstance(_db.global_database, SqliteDatabase):
+        return _db.global_database.database
+    return None
+
+
+def is_pooled() -> bool:
+    return not isinstance(_db.global_database, SqliteDatabase)
+
+
+def release_connection():
+    """
+    把当前连接归还连接池，下次查询时会自动取出连接
+
+    连接长期不归还会被数据库服务端断开，所以每个请求结束后都要调用，sqlite不需要
+    """
+    if is_pooled() and not _db.is_closed() and not _db.in_transaction():
+        _db.close()
+
+
+# 按公会分库（db_shard_by_group），只支持sqlite
+#
+# _shard_keys中的表放在`shards/clan_<群号>.db`，用户、登录等仍在主库。
+# 公会数据库的连接会ATTACH主库，不带库名的表名先在公会数据库中查找，
+# 找不到时使用主库的表，所以User与Clan_member的连表查询不需要改写。
+# 没有数据库文件的公会（还没有拆分，或不存在）使用主库，可以逐步拆分。
+#
+# 公会数据的写入（群聊指令、网页的修改操作、成员同步、日期切换、冷存档、删除公会）
+# 都在db_executor的数据库线程中依次执行，分库只让各公会的WAL和检查点互不影响，不增加并发写入；
+# 登录记录、用户设置等只写主库的操作仍在事件循环中，靠BEGIN IMMEDIATE等待写锁。
+# 同时写入公会数据库和主库的事务，在WAL模式下只保证每个文件各自的原子性
+SHARD_DIRNAME = "shards"
+GLOBAL_SCHEMA = "yobot_global"
+_SPLIT_SCHEMA = "yobot_shard"
+
+_shard_dir: Optional[str] = None
+_shard_open_limit = 32
+_shards: Dict[int, _ShardDatabase] = {}
+_shards_lock = threading.RLock()
+_open_shards = threading.local()
+
+
+def sharded() -> bool:
+    return _shard_dir is not None
+
+
+def shard_file(group_id) -> str:
+    return os.path.join(_shard_dir, "clan_{}.db".format(int(group_id)))
+
+
+def shard_groups() -> List[int]:
+    """
+    已经有数据库文件的公会
+    """
+    if not sharded() or not os.path.isdir(_shard_dir):
+        return []
+    return sorted(
+        int(match.group(1)) for match in (
+            re.fullmatch(r"clan_(\d+)\.db", name) for name in os.listdir(_shard_dir))
+        if match)
+
+
+def _touch_shard(db):
+    # 每个线程最多保持_shard_open_limit个公会数据库的连接，关闭最久没有使用的
+    opened = getattr(_open_shards, "lru", None)
+    if opened is None:
+        opened = _open_shards.lru = collections.OrderedDict()
+    opened[db] = None
+    opened.move_to_end(db)
+    while len(opened) > _shard_open_limit:
+        oldest = next(iter(opened))
+        if oldest.in_transaction():
+            break
+        del opened[oldest]
+        oldest.close()
+
+
+def _in_main(group_id: int) -> bool:
+    # 公会还在主库中（没有拆分）
+    token = _current_shard.set(None)
+    try:
+        return Clan_group.select().where(Clan_group.group_id == group_id).exists()
+    finally:
+        _current_shard.reset(token)
+
+
+def _open_shard(group_id: int) -> _ShardDatabase:
+    # 需要持有_shards_lock，数据库文件不存在时新建；
+    # 每个进程第一次打开时补建缺少的表（新版本添加的表）
+    os.makedirs(_shard_dir, exist_ok=True)
+    db = _ShardDatabase(shard_file(group_id), _db.global_database.database, pragmas=_SQLITE_PRAGMAS)
+    token = _current_shard.set(db)
+    try:
+        existing = set(db.get_tables())
+        db.create_tables(list(_shard_keys), safe=True)
+        for model, backfill in _shard_backfills.items():
+            if model._meta.table_name not in existing:
+                backfill().execute()
+    finally:
+        _current_shard.reset(token)
+    _shards[group_id] = db
+    return db
+
+
+def _get_shard(group_id: int, create: bool) -> Optional[_ShardDatabase]:
+    with _shards_lock:
+        db = _shards.get(group_id)
+        if db is None and (os.path.exists(shard_file(group_id))
+                           or create and not _in_main(group_id)):
+            db = _open_shard(group_id)
+        return db
+
+
+@contextlib.contextmanager
+def group_scope(group_id, create: bool = False):
+    """
+    with块中公会战的表使用group_id的数据库，未启用分库时不做任何事
+
+    Args:
+        group_id: QQ群号
+        create: 公会没有数据库文件时新建（创建公会时使用），
+            否则使用主库，不存在的公会不会留下空文件
+    """
+    if not sharded():
+        yield
+        return
+    token = _current_shard.set(_get_shard(int(group_id), create))
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+
+def use_group(group_id) -> None:
+    """
+    当前上下文中之后的查询都使用group_id的数据库，group_id为None时使用主库
+
+    用于web请求开始时，每个请求在自己的上下文中处理，请求结束后即失效
+    """
+    if sharded():
+        _current_shard.set(None if group_id is None else _get_shard(int(group_id), False))
+
+
+def each_database() -> Iterator[Optional[int]]:
+    """
+    依次切换到主库和每个公会的数据库，用于跨公会的查询：
+
+        for _ in ybdata.each_database():
+            groups.extend(Clan_group.select())
+
+    未启用分库时只有主库
+
+    Yields:
+        公会数据库的群号，主库为None
+    """
+    token = _current_shard.set(None)
+    try:
+        yield None
+    finally:
+        _current_shard.reset(token)
+    for group_id in shard_groups():
+        with group_scope(group_id):
+            yield group_id
+
+
+def split_group(group_id) -> Dict[str, int]:
+    """
+    把一个公会的数据从主库移到它自己的数据库，需要停止yobot后执行
+
+    先在公会数据库中提交副本，再从主库删除。两步之间中断时公会数据库已经完整，
+    再次执行不会重新复制，只删除主库中的残留
+
+    Returns:
+        {表名: 复制的记录数, }
+    """
+    if not sharded():
+        raise ValueError("需要开启db_shard_by_group")
+    group_id = int(group_id)
+    with _shards_lock:
+        shard = _shards.get(group_id) or _open_shard(group_id)
+    with group_scope(group_id):
+        copied = Clan_group.select().where(Clan_group.group_id == group_id).exists()
+    main = _db.global_database
+    counts = {}
+    token = _current_shard.set(None)
+    try:
+        if not copied:
+            # ATTACH不能在事务中执行
+            main.execute_sql(
+                "ATTACH DATABASE ? AS " + _SPLIT_SCHEMA, (shard.database,))
+            try:
+                with main.atomic():
+                    for model, key in _shard_keys.items():
+                        table = model._meta.table_name
+                        columns = ", ".join(
+                            '"{}"'.format(f.column_name) for f in model._meta.sorted_fields)
+                        counts[table] = main.execute_sql(
+                            'INSERT INTO {0}."{1}" ({2}) SELECT {2} FROM main."{1}" '
+                            'WHERE "{3}" = ?'.format(_SPLIT_SCHEMA, table, columns, key),
+                            (group_id,)).rowcount
+            finally:
+                main.execute_sql("DETACH DATABASE " + _SPLIT_SCHEMA)
+        with main.atomic():
+            for model, key in _shard_keys.items():
+                model.delete().where(getattr(model, key) == group_id).execute()
+    finally:
+        _current_shard.reset(token)
+    return counts
+
+
+def split_all() -> Iterator[tuple]:
+    """
+    拆分主库中的所有公会
+
+    Yields:
+        (群号, {表名: 记录数, }, 耗时秒数)
+    """
+    token = _current_shard.set(None)
+    try:
+        group_ids = [g for g, in Clan_group.select(Clan_group.group_id).tuples()]
+    finally:
+        _current_shard.reset(token)
+    for group_id in group_ids:
+        start = time.perf_counter()
+        counts = split_group(group_id)
+        yield group_id, counts, time.perf_counter() - start
+
+
+# 数据库迁移，按版本号顺序执行
+# 每个迁移函数接收migrator，返回playhouse.migrate的操作或sql语句（Context）列表
+# 迁移只在主库执行，公会数据库打开时按模型补建缺少的表（有_shard_backfills的同时生成数据），
+# 以后修改_shard_keys中已有的表时，需要在each_database中对每个公会数据库执行
+_migrations: List[tuple] = []  # [(版本, 说明, 迁移函数), ]
+
+
+def migration(version: int, description: str):
+    """
+    登记一个数据库迁移，新建的数据库直接按模型建表，不执行迁移
+
+    Args:
+        version: 迁移后的数据库版本，必须比已有的迁移大
+        description: 迁移说明
+    """
+    def decorator(fn):
+        assert not _migrations or version > _migrations[-1][0]
+        _migrations.append((version, description, fn))
+        return fn
+    return decorator
+
+
+@migration(2, "添加出刀次数检查的索引")
+def _add_challenge_quota_index(migrator):
+    return [
+        migrator.add_index(
+            "clan_challenge", ("gid", "bid", "qqid", "challenge_pcrdate"), False),
+    ]
+
+
+@migration(3, "添加查询上一个出刀记录的索引，删除被覆盖的(bid, gid)索引")
+def _add_previous_challenge_index(migrator):
+    operations = [
+        migrator.add_index("clan_challenge", ("gid", "bid", "cid"), False),
+    ]
+    indexes = migrator.database.get_indexes("clan_challenge")
+    if any(index.name == "clan_challenge_bid_gid" for index in indexes):
+        operations.append(
+            migrator.drop_index("clan_challenge", "clan_challenge_bid_gid"))
+    return operations
+
+
+@migration(4, "添加冷存档登记表")
+def _add_challenge_archive_table(migrator):
+    schema = Clan_challenge_archive._schema
+    return [schema._create_table(safe=True), *schema._create_indexes(safe=True)]
+
+
+@migration(5, "添加每日出刀汇总表")
+def _add_daily_table(migrator):
+    schema = Clan_daily._schema
+    return [schema._create_table(safe=True), *schema._create_indexes(safe=True)]
+
+
+@migration(6, "添加成员历史汇总表，由出刀记录生成")
+def _add_member_history_table(migrator):
+    schema = Clan_member_history._schema
+    return [
+        schema._create_table(safe=True),
+        *schema._create_indexes(safe=True),
+        member_history_insert(Clan_challenge),
+    ]
+
+
+@migration(7, "代刀人改为64位整数")
+def _widen_challenge_behalf(migrator):
+    # sqlite的INTEGER本来就是64位，不需要重建表
+    if isinstance(migrator, SqliteMigrator):
+        return []
+    return [
+        migrator.alter_column_type(
+            "clan_challenge", "behalf", BigIntegerField(null=True)),
+    ]
+
+
+_version = _migrations[-1][0]  # 目前版本
+
+
+def init(sqlite_filename, config=None, dry_run=False):
+    """
+    连接数据库，建表或升级到最新版本
+
+    Args:
+        sqlite_filename: sqlite数据库文件路径
+        config: 全局配置
+        dry_run: 只打印需要执行的迁移，不修改数据库
+    """
+    global _shard_dir, _shard_open_limit
+    config = config or {}
+    _db.initialize(_create_database(sqlite_filename, config))
+    _logger.info("数据库：{}".format(type(_db.obj).__name__))
+    if config.get("db_shard_by_group"):
+        if is_pooled():
+            raise ValueError("db_shard_by_group只支持sqlite数据库")
+        _shard_dir = os.path.join(
+            os.path.dirname(os.path.abspath(sqlite_filename)), SHARD_DIRNAME)
+        _shard_open_limit = max(1, config.get("db_shard_open_limit", 32))
+        _logger.info("按公会分库：{}".format(_shard_dir))
 
-    old_version = 1
     if not DB_schema.table_exists():
-        DB_schema.create_table()
-        DB_schema.create(key="version", value=str(_version))
+        old_version = 1
+        if not User.table_exists():
+            # 新数据库
+            if dry_run:
+                print("新数据库，将直接建表")
+                return
+            _db.create_tables(_tables, safe=True)
+            old_version = _version
+        elif dry_run:
+            print("将创建DB_schema表")
+        if not dry_run:
+            DB_schema.create_table()
+            DB_schema.create(key="version", value=str(old_version))
     else:
         old_version = int(DB_schema.get(key="version").value)
 
-    if not User.table_exists():
-        Admin_key.create_table()
-        User.create_table()
-        User_login.create_table()
-        Clan_group.create_table()
-        Clan_member.create_table()
-        Clan_group_backups.create_table()
-        Clan_challenge.create_table()
-        Character.create_table()
-        old_version = _version
     if old_version > _version:
         print("数据库版本高于程序版本，请升级yobot")
         raise SystemExit()
     if old_version < _version:
-        print("正在升级数据库")
-        db_upgrade(old_version)
-        print("数据库升级完毕")
-
-
-def db_upgrade(old_version):
-    migrator = SqliteMigrator(_db)
-    if old_version < 2:
-        pass
-
-    DB_schema.replace(key="version", value=str(_version)).execute()
+        print("正在升级数据库" if not dry_run else "需要执行的迁移：")
+        db_upgrade(old_version, dry_run)
+        if not dry_run:
+            print("数据库升级完毕")
+    elif dry_run:
+        print("数据库已是最新版本")
+    release_connection()
+
+
+def _operation_sql(operation) -> List[str]:
+    # 生成迁移操作的sql语句，不执行
+    def collect(result):
+        if isinstance(result, (Node, Context)):
+            sql, params = _db.get_sql_context().sql(result).query()
+            yield sql if not params else "{} {}".format(sql, params)
+        elif isinstance(result, Operation):
+            yield from collect(getattr(result.migrator, result.method)(
+                *result.args, with_context=True, **result.kwargs))
+        elif isinstance(result, (list, tuple)):
+            for item in result:
+                yield from collect(item)
+    return list(collect(operation))
+
+
+def _analyze():
+    if isinstance(_db.obj, MySQLDatabase):
+        _db.execute_sql("ANALYZE TABLE {}".format(
+            ", ".join("`{}`".format(m._meta.table_name) for m in _tables)))
+    else:
+        _db.execute_sql("ANALYZE")
+
+
+def db_upgrade(old_version, dry_run=False) -> List[tuple]:
+    """
+    依次执行版本高于old_version的迁移，每个迁移完成后立即记录版本号
+
+    Returns:
+        [(版本, 说明, 耗时秒数), ]
+    """
+    # 根据数据库类型选择SqliteMigrator、MySQLMigrator或PostgresqlMigrator
+    migrator = SchemaMigrator.from_database(_db.obj)
+    done = []
+    for version, description, fn in _migrations:
+        if version <= old_version:
+            continue
+        operations = fn(migrator)
+        if dry_run:
+            print("[{}] {}".format(version, description))
+            for operation in operations:
+                for sql in _operation_sql(operation):
+                    print("    " + sql)
+            continue
+        start = time.perf_counter()
+        # mysql的DDL会隐式提交，只有sqlite和postgresql能整体回滚
+        with _db.atomic():
+            for operation in operations:
+                if isinstance(operation, Operation):
+                    operation.run()
+                else:
+                    _db.execute(operation)
+            # replace语句postgresql不支持
+            DB_schema.update(value=str(version)).where(
+                DB_schema.key == "version").execute()
+        elapsed = time.perf_counter() - start
+        print("[{}] {}，耗时{:.2f}秒".format(version, description, elapsed))
+        done.append((version, description, elapsed))
+    if done:
+        # 更新索引统计信息，让查询优化器用上新索引
+        start = time.perf_counter()
+        _analyze()
+        print("ANALYZE，耗时{:.2f}秒".format(time.perf_counter() - start))
+    return done
@@ -9,30 +9,33 @@ import socket
 import sys
 from io import BytesIO
 from functools import reduce
-from typing import Any, Callable, Dict, Iterable, List, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 from urllib.parse import urljoin
 
 import requests
 from aiocqhttp.api import Api
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from opencc import OpenCC
-from quart import Quart, make_response, request, send_file
+from quart import Quart, g, make_response, request, send_file
 
 if __package__:
-    from .ybplugins import (clan_battle, homepage,
-                            login, marionette, settings,
-                            switcher, templating, web_util, ybdata,
+    from .ybplugins import (battle_archive, clan_battle, db_executor, db_maintenance,
+                            health, homepage, login, marionette, metrics, settings,
+                            sql_profiler, switcher, templating, web_util, ybdata,
                             yobot_msg, custom, group_leave)
 else:
-    from ybplugins import (clan_battle, homepage,
-                           login, marionette, settings,
-                           switcher, templating, web_util, ybdata,
+    from ybplugins import (battle_archive, clan_battle, db_executor, db_maintenance,
+                           health, homepage, login, marionette, metrics, settings,
+                           sql_profiler, switcher, templating, web_util, ybdata,
                            yobot_msg, custom, group_leave)
 
 # 本项目构建的框架非常粗糙，不建议各位把时间浪费本项目上
 # 如果想开发自己的机器人，建议直接使用 nonebot 框架
 # https://nonebot.cqp.moe/
 
+MESSAGE_SECONDS = metrics.Histogram(
+    "yobot_message_handle_seconds", "处理一条消息的耗时", ("message_type",))
+
 
 class Yobot:
     Version = "[v4.0.2]"
@@ -112,7 +115,28 @@ class Yobot:
             verinfo = get_version(self.Version, self.Version_id)
             print(verinfo['ver_name'])
         # initialize database
-        ybdata.init(os.path.join(dirname, 'yobotdata_new.db'))
+        ybdata.init(os.path.join(dirname, 'yobotdata_new.db'), self.glo_setting)
+        battle_archive.init(dirname)
+        # 升级前已存档的会战没有成员历史汇总
+        battle_archive.backfill_history()
+        db_executor.configure(self.glo_setting)
+        sql_profiler.configure(self.glo_setting)
+        if sql_profiler.enabled():
+            # 按路由统计每个请求执行的语句
+            @quart_app.before_request
+            async def start_sql_profile():
+                rule = request.url_rule.rule if request.url_rule else "unmatched"
+                g.sql_profile = sql_profiler.start(
+                    "{} {}".format(request.method, rule))
+
+            @quart_app.teardown_request
+            async def finish_sql_profile(exc):
+                sql_profiler.finish(g.pop("sql_profile", None))
+        if ybdata.is_pooled():
+            # 请求结束后把连接归还连接池
+            @quart_app.teardown_request
+            async def release_db_connection(exc):
+                ybdata.release_connection()
 
         # enable gzip
         if self.glo_setting["web_gzip"] > 0:
@@ -249,7 +273,7 @@ class Yobot:
         })
         kwargs = {
             "glo_setting": self.glo_setting,
-            "bot_api": bot_api,
+            "bot_api": metrics.InstrumentedApi(bot_api),
             "scheduler": scheduler,
             "app": quart_app,
             "boss_id_name": self.boss_id_name
@@ -265,6 +289,9 @@ class Yobot:
             settings.Setting(**kwargs),
             web_util.WebUtil(**kwargs),
             clan_battle.ClanBattle(**kwargs),
+            db_maintenance.DBMaintenance(**kwargs),
+            metrics.Metrics(**kwargs),
+            health.Health(**kwargs),
         ]
         self.plug_passive = [p for p in plug_all if p.Passive]
         self.plug_active = [p for p in plug_all if p.Active]
@@ -283,10 +310,25 @@ class Yobot:
         jobs = [p.jobs() for p in self.plug_active]
         return reduce(lambda x, y: x+y, jobs)
 
+    def process_jobs(self) -> List[Tuple[Any, Callable[[], Iterable[Dict[str, Any]]]]]:
+        """
+        多进程部署时每个进程都要执行的定时任务，`jobs`中的任务只在leader执行
+        """
+        jobs = [tuple(p.process_jobs()) for p in self.plug_active
+                if hasattr(p, "process_jobs")]
+        return reduce(lambda x, y: x+y, jobs, ())
+
     async def proc_async(self, msg: dict, *args, **kwargs) -> str:
         '''
         receive a message and return a reply
         '''
+        try:
+            with MESSAGE_SECONDS.time(message_type=msg["message_type"]):
+                return await self._proc_async(msg, *args, **kwargs)
+        finally:
+            ybdata.release_connection()
+
+    async def _proc_async(self, msg: dict, *args, **kwargs) -> str:
         # prefix
         if self.glo_setting.get("preffix_on", False):
             preffix = self.glo_setting.get("preffix_string", "")
@@ -366,6 +408,20 @@ class Yobot:
 
         return reply_msg
 
+    async def handle_msg_async(self, context: dict) -> Optional[dict]:
+        '''
+        aiocqhttp的消息事件处理函数，有回复时返回快速操作
+        '''
+        if context["message_type"] == "group" or context["message_type"] == "private":
+            reply = await self.proc_async(context)
+        else:
+            reply = None
+        if isinstance(reply, str) and reply != "":
+            return {'reply': reply,
+                    'at_sender': False}
+        else:
+            return None
+
     def execute(self, cmd: str, *args, **kwargs):
         if cmd == "update":
             res = self.plug_passive[0].execute(0x30)